@@ -0,0 +1,81 @@
+import argparse
+import statistics
+import time
+
+import stub_aws
+
+
+# end-to-end latency of snapshot events with the sync and the async engine,
+# against a stub that sleeps on every RDS call. each database already has
+# more copies than the retention limit in two target regions, so every event
+# makes a source describe, a copy, a retention scan and several deletes per
+# region. both engines must make the same calls and keep the same copies.
+REGIONS = ('us-west-2', 'eu-west-1')
+
+
+def run(args, engine):
+    instances = ['db-%04d' % i for i in range(args.instances)]
+    stub_aws.configure_environment(
+        rds_instances=','.join(instances),
+        dest_region=','.join(REGIONS),
+        automated_snapshot_maximum_copies=str(args.copies)
+    )
+    aws = stub_aws.StubAws(latency=args.latency).install()
+    import lambda_function
+    lambda_function.ENGINE = engine
+
+    events = []
+    for instance in instances:
+        for day in range(args.existing):
+            for region in REGIONS:
+                aws.add_copy(region, instance, day)
+        snapshot = aws.add_automated_snapshot('us-east-1', instance, args.existing)
+        events.append(stub_aws.snapshot_event(snapshot))
+    aws.reset_calls()
+
+    latencies = []
+    with stub_aws.quiet():
+        for event in events:
+            started = time.perf_counter()
+            lambda_function.process_event(event)
+            latencies.append(time.perf_counter() - started)
+
+    kept = sorted(
+        (region, snapshot['DBSnapshotIdentifier'])
+        for region in REGIONS for snapshot in aws.snapshots['instance'][region].values()
+    )
+    return {
+        'latencies': latencies,
+        'calls': aws.call_count(),
+        'deleted': aws.call_count('DeleteDBSnapshot'),
+        'kept': kept
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--instances', type=int, default=40)
+    parser.add_argument('--existing', type=int, default=10)
+    parser.add_argument('--copies', type=int, default=7)
+    parser.add_argument('--latency', type=float, default=0.02)
+    args = parser.parse_args()
+
+    print('%6s %7s %10s %10s %10s %9s' % ('engine', 'events', 'mean (ms)', 'p50 (ms)', 'max (ms)', 'rds calls'))
+    results = {}
+    for engine in ('sync', 'async'):
+        result = results[engine] = run(args, engine)
+        latencies = [seconds * 1000 for seconds in result['latencies']]
+        print('%6s %7d %10.1f %10.1f %10.1f %9d' % (
+            engine, len(latencies), statistics.mean(latencies), statistics.median(latencies),
+            max(latencies), result['calls']))
+
+    if results['sync']['kept'] != results['async']['kept']:
+        raise SystemExit('the engines kept different copies')
+    if results['sync']['calls'] != results['async']['calls']:
+        raise SystemExit('the engines made a different number of RDS calls')
+    print('both engines deleted %d copies and kept the same %d' % (
+        results['async']['deleted'], len(results['async']['kept'])))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+import argparse
+import json
+import time
+
+import stub_aws
+
+
+# compares events/sec of one lambda_handler invocation per event with
+# lambda_batch_handler receiving SQS batches, against a stub that adds a fixed
+# latency to every RDS call. --invocation-overhead models the per-invocation
+# cost lambda adds on top of the handler itself. the throttled check makes
+# every source describe throttle and expects each record of the batch back in
+# batchItemFailures, so none is dropped as if its database were unprotected.
+def build_events(aws, count, instances):
+    events = []
+    for i in range(count):
+        snapshot = aws.add_automated_snapshot('us-east-1', 'db-%d' % (i % instances), i)
+        events.append(stub_aws.snapshot_event(snapshot))
+    return events
+
+
+def setup(args):
+    stub_aws.configure_environment(
+        rds_instances=','.join('db-%d' % i for i in range(args.instances)),
+        automated_snapshot_maximum_copies=str(args.maximum_copies)
+    )
+    return stub_aws.StubAws(latency=args.latency).install()
+
+
+def run_single(args):
+    aws = setup(args)
+    import lambda_function
+    events = build_events(aws, args.events, args.instances)
+
+    started = time.perf_counter()
+    with stub_aws.quiet():
+        for event in events:
+            time.sleep(args.invocation_overhead)
+            lambda_function.lambda_handler(event, None)
+    return time.perf_counter() - started, 0
+
+
+def run_batch(args):
+    aws = setup(args)
+    import lambda_function
+    events = build_events(aws, args.events, args.instances)
+    records = [
+        {'messageId': str(i), 'body': json.dumps(event, default=str)}
+        for i, event in enumerate(events)
+    ]
+
+    failed = 0
+    started = time.perf_counter()
+    with stub_aws.quiet():
+        for i in range(0, len(records), args.batch_size):
+            time.sleep(args.invocation_overhead)
+            response = lambda_function.lambda_batch_handler({'Records': records[i:i + args.batch_size]}, None)
+            failed += len(response['batchItemFailures'])
+    return time.perf_counter() - started, failed
+
+
+def check_throttled(args):
+    stub_aws.configure_environment(rds_instances=','.join('db-%d' % i for i in range(args.instances)))
+    aws = stub_aws.StubAws(throttle_rate=1.0, throttled_operations=('DescribeDBSnapshots',)).install()
+    import lambda_function
+    events = build_events(aws, args.batch_size, args.instances)
+    records = [
+        {'messageId': str(i), 'body': json.dumps(event, default=str)}
+        for i, event in enumerate(events)
+    ]
+    with stub_aws.quiet():
+        response = lambda_function.lambda_batch_handler({'Records': records}, None)
+    return len(records), len(response['batchItemFailures'])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--events', type=int, default=200)
+    parser.add_argument('--instances', type=int, default=20)
+    parser.add_argument('--batch-size', type=int, default=10)
+    parser.add_argument('--maximum-copies', type=int, default=7)
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--invocation-overhead', type=float, default=0.005)
+    args = parser.parse_args()
+
+    print('%8s %8s %10s %12s %8s' % ('mode', 'events', 'elapsed', 'events/sec', 'failed'))
+    for mode, run in (('single', run_single), ('batch', run_batch)):
+        elapsed, failed = run(args)
+        print('%8s %8d %9.2fs %12.1f %8d' % (mode, args.events, elapsed, args.events / elapsed, failed))
+
+    records, failed = check_throttled(args)
+    print('throttled source describes: %d of %d records reported as failed' % (failed, records))
+    if failed != records:
+        raise SystemExit('records whose source describe failed were not reported for retry')
+
+
+if __name__ == '__main__':
+    main()
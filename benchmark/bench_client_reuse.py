@@ -0,0 +1,40 @@
+import argparse
+import time
+
+import stub_aws
+
+
+# replays N snapshot events through lambda_handler in one process and checks
+# that every (service, region) client was only created once.
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--events', type=int, default=200)
+    args = parser.parse_args()
+
+    stub_aws.configure_environment(rds_instances='db-0,db-1,db-2')
+    aws = stub_aws.StubAws().install()
+
+    import lambda_function
+
+    events = []
+    for i in range(args.events):
+        snapshot = aws.add_automated_snapshot('us-east-1', 'db-%d' % (i % 3), i)
+        events.append(stub_aws.snapshot_event(snapshot))
+
+    started = time.perf_counter()
+    with stub_aws.quiet():
+        for event in events:
+            lambda_function.lambda_handler(event, None)
+    elapsed = time.perf_counter() - started
+
+    print('events: %d, elapsed: %.3fs' % (len(events), elapsed))
+    for (service, region), count in sorted(aws.clients_created.items(), key=str):
+        print('client %s/%s created %d time(s)' % (service, region, count))
+
+    duplicated = [key for key, count in aws.clients_created.items() if count != 1]
+    if duplicated:
+        raise SystemExit('clients created more than once: %s' % duplicated)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+# cold start cost, measured in fresh interpreters: the time to import
+# lambda_function, the time of a first event that the raw event pre-filter
+# drops, and the time of a first copy event against the stub. the skip run
+# installs no client factory, so any client creation, or a module load of
+# boto3 or the RDS code, shows up as a regression, as does asyncio in a sync
+# copy. --max-import-ms and --max-skip-ms turn the medians into a gate for CI.
+HERE = os.path.dirname(os.path.abspath(__file__))
+LAMBDA_MODULES = ('rds_instance', 'rds_cluster', 'reconcile', 'copy_scheduler', 'copy_tracker',
+                  'retention', 'target_regions', 'aws_clients', 'sns_client', 'async_engine',
+                  'idempotency', 'snapshot_index', 'selection')
+
+
+def child(mode):
+    sys.path.insert(0, os.path.join(HERE, '..', 'lambda-function'))
+    started = time.perf_counter()
+    if mode == 'eager':
+        for module in LAMBDA_MODULES:
+            __import__(module)
+    import lambda_function
+    imported = time.perf_counter() - started
+
+    event_seconds = None
+    if mode == 'skip':
+        events = [
+            {'detail-type': 'RDS DB Snapshot Event', 'region': 'us-east-1',
+             'detail': {'EventCategories': ['creation'], 'Message': 'Creating automated snapshot',
+                        'SourceIdentifier': 'rds:db-0001-2020-06-01-00-00'}},
+            {'detail-type': 'RDS DB Instance Event', 'region': 'us-east-1',
+             'detail': {'EventCategories': ['availability'], 'Message': 'DB instance restarted'}}
+        ]
+        os.environ['rds_instances'] = 'db-0001'
+        started = time.perf_counter()
+        for event in events:
+            lambda_function.process_event(event)
+        event_seconds = time.perf_counter() - started
+    elif mode == 'copy':
+        sys.path.insert(0, HERE)
+        import stub_aws
+        stub_aws.configure_environment(rds_instances='db-0001')
+        aws = stub_aws.StubAws().install()
+        snapshot = aws.add_automated_snapshot('us-east-1', 'db-0001', 0)
+        event = stub_aws.snapshot_event(snapshot)
+        started = time.perf_counter()
+        with stub_aws.quiet():
+            lambda_function.process_event(event)
+        event_seconds = time.perf_counter() - started
+
+    print(json.dumps({
+        'import': imported,
+        'event': event_seconds,
+        'loaded': [module for module in LAMBDA_MODULES + ('asyncio', 'boto3', 'botocore') if module in sys.modules]
+    }))
+
+
+def measure(mode, runs):
+    results = []
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, __file__, '--child', mode])
+        results.append(json.loads(output.decode().splitlines()[-1]))
+    return {
+        'import': statistics.median(result['import'] for result in results) * 1000,
+        'event': statistics.median(result['event'] for result in results) * 1000 if results[0]['event'] is not None else None,
+        'loaded': results[-1]['loaded']
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=7)
+    parser.add_argument('--max-import-ms', type=float, default=None)
+    parser.add_argument('--max-skip-ms', type=float, default=None)
+    parser.add_argument('--child', default=None)
+    args = parser.parse_args()
+    if args.child:
+        return child(args.child)
+
+    results = dict((mode, measure(mode, args.runs)) for mode in ('eager', 'lazy', 'skip', 'copy'))
+    print('%6s %11s %10s  %s' % ('run', 'import ms', 'event ms', 'modules loaded'))
+    for mode in ('eager', 'lazy', 'skip', 'copy'):
+        result = results[mode]
+        print('%6s %11.2f %10s  %s' % (
+            mode, result['import'], '-' if result['event'] is None else '%.2f' % result['event'],
+            ', '.join(result['loaded']) or '-'))
+
+    failures = []
+    # sns_client comes with lambda_function for the error digest; a skipped
+    # event must not load anything more
+    extra = [module for module in results['skip']['loaded'] if module not in results['lazy']['loaded']]
+    if extra:
+        failures.append('skipped events loaded ' + ', '.join(extra))
+    # the default copy path is sync and must not pay for asyncio
+    extra = [module for module in results['copy']['loaded'] if module in ('async_engine', 'asyncio')]
+    if extra:
+        failures.append('sync copy events loaded ' + ', '.join(extra))
+    if args.max_import_ms is not None and results['lazy']['import'] > args.max_import_ms:
+        failures.append('import took %.2f ms, budget %.2f ms' % (results['lazy']['import'], args.max_import_ms))
+    if args.max_skip_ms is not None and results['skip']['event'] > args.max_skip_ms:
+        failures.append('skipped events took %.2f ms, budget %.2f ms' % (results['skip']['event'], args.max_skip_ms))
+    if failures:
+        raise SystemExit('\n'.join(failures))
+
+
+if __name__ == '__main__':
+    main()
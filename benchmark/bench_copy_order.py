@@ -0,0 +1,118 @@
+import argparse
+import os
+import random
+import statistics
+import tempfile
+
+import stub_aws
+
+
+# time to protected per database when a whole fleet finishes its backup at
+# once: a few large warehouses, many ordinary databases and a handful of
+# critical ones, arriving in random order, against --quota copy slots. a copy
+# takes --copy-base-seconds plus --copy-seconds-per-gb of allocated storage.
+# the queue starts copies in arrival order or in copy order (copy_priorities,
+# then the smallest snapshot first). time is simulated as in
+# bench_copy_scheduler; a database is protected when its copy is available.
+# --per-database also prints each database's time to protected in both orders.
+PRIORITIES = 'critical-*=0,warehouse-*=9'
+
+GROUPS = (
+    # (name prefix, count argument, smallest GiB, largest GiB)
+    ('critical', 'critical', 20, 200),
+    ('db', 'databases', 20, 2000),
+    ('warehouse', 'warehouses', 5000, 10000)
+)
+
+
+def fleet(args):
+    rng = random.Random(args.seed)
+    databases = []
+    for prefix, count, smallest, largest in GROUPS:
+        for i in range(getattr(args, count)):
+            databases.append(('%s-%03d' % (prefix, i), rng.randint(smallest, largest)))
+    rng.shuffle(databases)
+    return databases
+
+
+def run(args, order):
+    databases = fleet(args)
+    stub_aws.configure_environment(
+        rds_instances='*',
+        automated_snapshot_maximum_copies='7',
+        max_concurrent_copies=str(args.quota),
+        copy_priorities=PRIORITIES,
+        copy_queue_path=os.path.join(tempfile.mkdtemp(), 'pending_copies.db')
+    )
+    aws = stub_aws.StubAws(
+        copy_quota=args.quota, copy_base_seconds=args.copy_base_seconds,
+        copy_seconds_per_gb=args.copy_seconds_per_gb
+    ).install()
+    import copy_scheduler
+    import lambda_function
+    copy_scheduler.reset()
+    copy_scheduler.MAX_CONCURRENT_COPIES = args.quota
+    copy_scheduler.COPY_ORDER = order
+
+    with stub_aws.quiet():
+        for database, allocated_storage in databases:
+            snapshot = aws.add_automated_snapshot('us-east-1', database, 0, allocated_storage=allocated_storage)
+            lambda_function.lambda_handler(stub_aws.snapshot_event(snapshot), None)
+        while aws.copies_in_progress('us-west-2') or copy_scheduler.get_scheduler().pending('us-west-2'):
+            aws.advance(args.tick)
+            lambda_function.drain_handler({}, None)
+
+    os.remove(os.environ['copy_queue_path'])
+    protected = {}
+    for region, snapshot_identifier, clock in aws.completed_copies:
+        protected[snapshot_identifier[len('rds-'):-len('-2020-06-01-00-00-autocopied')]] = clock
+    return protected
+
+
+def summary(protected, prefix):
+    minutes = sorted(seconds / 60.0 for database, seconds in protected.items() if database.startswith(prefix + '-'))
+    return len(minutes), statistics.median(minutes), minutes[int(0.9 * (len(minutes) - 1))], minutes[-1]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--critical', type=int, default=10)
+    parser.add_argument('--databases', type=int, default=80)
+    parser.add_argument('--warehouses', type=int, default=5)
+    parser.add_argument('--quota', type=int, default=5)
+    parser.add_argument('--copy-base-seconds', type=float, default=60.0)
+    parser.add_argument('--copy-seconds-per-gb', type=float, default=0.5)
+    parser.add_argument('--tick', type=float, default=30.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--per-database', action='store_true')
+    args = parser.parse_args()
+
+    print('time to protected in minutes, %s' % PRIORITIES)
+    print('%8s %10s %4s %8s %8s %8s' % ('order', 'group', 'dbs', 'p50', 'p90', 'max'))
+    results = {}
+    for order in ('arrival', 'priority'):
+        protected = results[order] = run(args, order)
+        for prefix, count, smallest, largest in GROUPS:
+            print('%8s %10s %4d %8.0f %8.0f %8.0f' % ((order, prefix) + summary(protected, prefix)))
+
+    if args.per_database:
+        print('')
+        print('%14s %8s %10s %10s %8s' % ('database', 'GiB', 'arrival', 'priority', 'change'))
+        for database, allocated_storage in sorted(fleet(args)):
+            arrival = results['arrival'].get(database)
+            priority = results['priority'].get(database)
+            if arrival is None or priority is None:
+                print('%14s %8d %10s %10s %8s' % (database, allocated_storage, '-', '-', '-'))
+                continue
+            print('%14s %8d %10.0f %10.0f %+8.0f' % (
+                database, allocated_storage, arrival / 60.0, priority / 60.0, (priority - arrival) / 60.0))
+
+    expected = args.critical + args.databases + args.warehouses
+    if any(len(protected) != expected for protected in results.values()):
+        raise SystemExit('not every database was protected')
+    if summary(results['priority'], 'critical')[3] > summary(results['arrival'], 'critical')[3]:
+        raise SystemExit('copy order protected the critical databases later than arrival order')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+import argparse
+import os
+import tempfile
+
+import stub_aws
+
+
+# a whole fleet finishes its automated backup at the same time while the
+# target region only accepts --quota copies in progress. without the
+# scheduler the copies over the quota fail and are lost; with it they wait in
+# the pending queue and start as slots free up. time is simulated: every tick
+# advances the stub clock and runs the scheduled drain handler once. in the
+# scheduled run, the step after the first queued copy starts fails once: it
+# must be notified while the copies started with it still get theirs.
+def run(args, scheduled):
+    stub_aws.configure_environment(
+        rds_instances=','.join('db-%04d' % i for i in range(args.instances)),
+        automated_snapshot_maximum_copies='7',
+        max_concurrent_copies=str(args.quota)
+    )
+    queue_path = None
+    if scheduled:
+        queue_path = os.path.join(tempfile.mkdtemp(), 'pending_copies.db')
+        os.environ['copy_queue_path'] = queue_path
+    else:
+        os.environ.pop('copy_queue_path', None)
+
+    aws = stub_aws.StubAws(copy_quota=args.quota, copy_base_seconds=args.copy_seconds).install()
+    import copy_scheduler
+    import lambda_function
+    copy_scheduler.reset()
+    copy_scheduler.MAX_CONCURRENT_COPIES = args.quota
+    clean_copies = copy_scheduler._clean_copies
+    failing = ['db-%04d' % args.quota]
+    cleaned = []
+
+    def flaky_clean_copies(handler, request):
+        if request['source_snapshot_info']['db_instance_identifier'] in failing:
+            failing.remove(request['source_snapshot_info']['db_instance_identifier'])
+            raise RuntimeError('step after copy ' + request['target_snapshot_identifier'] + ' failed')
+        clean_copies(handler, request)
+        cleaned.append(request['target_snapshot_identifier'])
+    if scheduled:
+        copy_scheduler._clean_copies = flaky_clean_copies
+
+    lost = 0
+    with stub_aws.quiet():
+        for i in range(args.instances):
+            snapshot = aws.add_automated_snapshot('us-east-1', 'db-%04d' % i, 0)
+            try:
+                lambda_function.lambda_handler(stub_aws.snapshot_event(snapshot), None)
+            except SystemExit as e:
+                if e.code not in (None, 0):
+                    lost += 1
+
+        utilization = []
+        while True:
+            in_progress = aws.copies_in_progress('us-west-2')
+            pending = copy_scheduler.get_scheduler().pending('us-west-2') if scheduled else 0
+            if not in_progress and not pending:
+                break
+            utilization.append(in_progress / float(args.quota))
+            aws.advance(args.tick)
+            if scheduled:
+                lambda_function.drain_handler({}, None)
+
+    copy_scheduler._clean_copies = clean_copies
+    if queue_path:
+        os.remove(queue_path)
+    return {
+        'completed': len(aws.completed_copies),
+        'lost': lost,
+        'cleaned': len(cleaned),
+        'notified': len(aws.published),
+        'makespan': aws.clock,
+        'utilization': sum(utilization) / len(utilization) if utilization else 0.0
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--instances', type=int, default=200)
+    parser.add_argument('--quota', type=int, default=20)
+    parser.add_argument('--copy-seconds', type=float, default=600.0)
+    parser.add_argument('--tick', type=float, default=30.0)
+    args = parser.parse_args()
+
+    print('%10s %10s %6s %14s %13s' % ('mode', 'completed', 'lost', 'makespan (s)', 'slot usage'))
+    for mode, scheduled in (('direct', False), ('scheduled', True)):
+        result = run(args, scheduled)
+        print('%10s %10d %6d %14.0f %12.0f%%' % (
+            mode, result['completed'], result['lost'], result['makespan'], 100 * result['utilization']))
+
+    # every copy but the one whose step failed got it, and only that one was notified
+    if result['lost'] or result['cleaned'] != args.instances - 1 or result['notified'] != 1:
+        raise SystemExit('a failing step after a queued copy started was not isolated: %d of %d steps ran, %d notified'
+                         % (result['cleaned'], args.instances - 1, result['notified']))
+    print('a failing step after a queued copy was notified, the other %d copies got theirs' % result['cleaned'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import statistics
+import tempfile
+
+import stub_aws
+
+
+# a fleet of databases of different sizes starts its copies at once and the
+# scheduled tracker follows them until they are done. reports the describe
+# calls a poll cycle makes next to one describe per copy, the copy metrics
+# the tracker emits, and checks that the deferred retention left exactly
+# automated_snapshot_maximum_copies copies of every database. the retention
+# of the first database fails once, as with a throttled describe: it must be
+# notified and retried by the next poll, without losing the other copies of
+# that poll or emitting its metrics twice.
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--instances', type=int, default=300)
+    parser.add_argument('--copies', type=int, default=7)
+    parser.add_argument('--copy-seconds', type=float, default=120.0)
+    parser.add_argument('--seconds-per-gb', type=float, default=2.0)
+    parser.add_argument('--tick', type=float, default=60.0)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    instances = ['db-%04d' % i for i in range(args.instances)]
+    stub_aws.configure_environment(
+        rds_instances=','.join(instances),
+        automated_snapshot_maximum_copies=str(args.copies)
+    )
+    tracker_path = os.path.join(tempfile.mkdtemp(), 'in_flight_copies.db')
+    os.environ['copy_tracker_path'] = tracker_path
+    os.environ.pop('copy_queue_path', None)
+
+    aws = stub_aws.StubAws(copy_base_seconds=args.copy_seconds, copy_seconds_per_gb=args.seconds_per_gb).install()
+    import copy_scheduler
+    import copy_tracker
+    import lambda_function
+    copy_scheduler.reset()
+    copy_tracker.reset()
+    copy_tracker.now = lambda: aws.clock
+    handler_for = copy_tracker._handler_for
+    failing = [instances[0]]
+
+    def flaky_handler_for(record):
+        if record['source_snapshot_info']['db_instance_identifier'] in failing:
+            failing.remove(record['source_snapshot_info']['db_instance_identifier'])
+            raise RuntimeError('retention of ' + record['target_snapshot_identifier'] + ' failed')
+        return handler_for(record)
+    copy_tracker._handler_for = flaky_handler_for
+
+    rng = random.Random(args.seed)
+    snapshots = []
+    for instance in instances:
+        allocated_storage = rng.choice((20, 100, 500, 1000, 4000))
+        for i in range(args.copies):
+            aws.add_automated_snapshot('us-east-1', instance, i, allocated_storage=allocated_storage)
+            aws.add_copy('us-west-2', instance, i, allocated_storage=allocated_storage)
+        snapshots.append(aws.add_automated_snapshot('us-east-1', instance, args.copies, allocated_storage=allocated_storage))
+
+    with stub_aws.quiet():
+        for snapshot in snapshots:
+            lambda_function.lambda_handler(stub_aws.snapshot_event(snapshot), None)
+    aws.published = []
+
+    status_describes = []
+    metrics = []
+    polls = 0
+    while True:
+        aws.advance(args.tick)
+        aws.reset_calls()
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            result = lambda_function.track_handler({}, None)
+        polls += 1
+        metrics.extend(json.loads(line) for line in output.getvalue().splitlines() if line.startswith('{"copy_completed"'))
+        if not result['completed']:
+            # nothing finished, so every call was the status poll itself
+            status_describes.append(aws.call_count('DescribeDBSnapshots'))
+        if not aws.copies_in_progress('us-west-2') and not result['completed']:
+            break
+    os.remove(tracker_path)
+
+    per_db = {}
+    for snapshot in aws.snapshots['instance']['us-west-2'].values():
+        per_db[snapshot['DBInstanceIdentifier']] = per_db.get(snapshot['DBInstanceIdentifier'], 0) + 1
+    wrong = [instance for instance in instances if per_db.get(instance) != args.copies]
+    if wrong:
+        raise SystemExit('%d databases do not keep %d copies' % (len(wrong), args.copies))
+    if failing or len(aws.published) != 1:
+        raise SystemExit('the failed retention was not notified exactly once')
+    if len(set(metric['copy_completed'] for metric in metrics)) != len(metrics) or len(metrics) != len(snapshots):
+        raise SystemExit('expected one copy metric per copy, got %d for %d copies' % (len(metrics), len(snapshots)))
+
+    throughput = [metric['throughput_gb_per_minute'] for metric in metrics]
+    durations = [metric['duration_seconds'] for metric in metrics]
+    print('%d copies tracked over %d polls of %.0fs, %d copy metrics emitted' % (
+        len(snapshots), polls, args.tick, len(metrics)))
+    print('describe calls per status poll: %.1f (one per copy: %d)' % (
+        statistics.mean(status_describes), len(snapshots)))
+    print('copy duration p50 %.0fs max %.0fs, throughput p50 %.1f GB/min' % (
+        statistics.median(durations), max(durations), statistics.median(throughput)))
+    print('every database keeps %d copies after the deferred retention, one failed retention was notified and retried' % args.copies)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+import argparse
+import time
+
+import stub_aws
+
+
+# lowers retention from 35 to 7 copies and times the deletion of the expired
+# copies for several worker pool sizes, against a stub that injects per-call
+# latency and Throttling errors on deletes.
+def run(workers, args):
+    stub_aws.configure_environment(
+        rds_instances='db-bench',
+        automated_snapshot_maximum_copies=str(args.maximum_copies),
+        delete_max_workers=str(workers)
+    )
+    aws = stub_aws.StubAws(
+        latency=args.latency,
+        throttle_rate=args.throttle_rate,
+        throttled_operations=['DeleteDBSnapshot']
+    ).install()
+    for i in range(args.copies):
+        aws.add_copy('us-west-2', 'db-bench', i)
+
+    import rds_instance
+    import retention
+    retention.DELETE_MAX_WORKERS = workers
+    rdsi = rds_instance.RdsInstance('us-east-1')
+    aws.reset_calls()
+
+    started = time.perf_counter()
+    with stub_aws.quiet():
+        result = rdsi.test_function('db-bench')
+    return aws, result, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--copies', type=int, default=35)
+    parser.add_argument('--maximum-copies', type=int, default=7)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--throttle-rate', type=float, default=0.2)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 8, 16])
+    args = parser.parse_args()
+
+    print('%8s %9s %8s %10s %10s' % ('workers', 'deleted', 'failed', 'throttled', 'elapsed'))
+    for workers in args.workers:
+        aws, result, elapsed = run(workers, args)
+        print('%8d %9d %8d %10d %9.2fs' % (
+            workers, len(result['deleted']), len(result['failed']),
+            sum(aws.throttled.values()), elapsed))
+
+
+if __name__ == '__main__':
+    main()
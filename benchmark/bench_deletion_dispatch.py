@@ -0,0 +1,80 @@
+import argparse
+
+import stub_aws
+
+
+# counts the RDS calls of deletion events. deletions are routed by detail
+# type, or by the ARN resource type, so a cluster deletion makes exactly one
+# call per target region: the delete of its copy. events that carry neither
+# pay a describe of the copy until one is found, and its kind is cached per
+# database. in the copy gone case, retention deleted the first copy of each
+# cluster before its deletion event, which must not route the next one as an
+# instance.
+def deletion_event(snapshot, kind, detail_type=True, arn=True):
+    message = 'Deleted automated snapshot'
+    event = stub_aws.snapshot_event(snapshot, kind=kind, message=message, category='deletion')
+    if not detail_type:
+        event['detail-type'] = 'RDS Snapshot Event'
+    if not arn:
+        event['detail']['SourceArn'] = ''
+    return event
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--databases', type=int, default=50)
+    args = parser.parse_args()
+
+    stub_aws.configure_environment(
+        rds_instances=','.join('db-%04d' % i for i in range(args.databases)),
+        rds_clusters='cluster-*,gone-*'
+    )
+    aws = stub_aws.StubAws().install()
+    import lambda_function
+
+    cases = (
+        ('instance', 'detail type', True, True),
+        ('cluster', 'detail type', True, True),
+        ('cluster', 'arn only', False, True),
+        ('cluster', 'neither', False, False),
+        ('instance', 'neither', False, False),
+        ('cluster', 'copy gone', False, False),
+    )
+    print('%10s %12s %8s %16s %14s' % ('kind', 'routed by', 'events', 'rds calls/event', 'copies left'))
+    failures = []
+    for index, (kind, routed_by, detail_type, arn) in enumerate(cases):
+        # the copy gone clusters are not yet in the cache of the neither case
+        prefix = 'db' if kind == 'instance' else 'gone' if routed_by == 'copy gone' else 'cluster'
+        events = []
+        for i in range(args.databases):
+            database = '%s-%04d' % (prefix, i)
+            # two snapshots per database, so the cache is hit by the second
+            for day in (2 * index, 2 * index + 1):
+                snapshot = aws.add_automated_snapshot('us-east-1', database, day, kind=kind)
+                if routed_by != 'copy gone' or day % 2:
+                    aws.add_copy('us-west-2', database, day, kind=kind)
+                aws.remove(kind, 'us-east-1', snapshot[stub_aws.KINDS[kind]['id']])
+                events.append(deletion_event(snapshot, kind, detail_type, arn))
+
+        aws.reset_calls()
+        with stub_aws.quiet():
+            for event in events:
+                lambda_function.process_event(event)
+        calls = aws.call_count()
+        left = aws.count_snapshots('us-west-2', kind)
+        print('%10s %12s %8d %16.2f %14d' % (kind, routed_by, len(events), calls / float(len(events)), left))
+        if left:
+            failures.append('%s %s: %d copies were not deleted' % (kind, routed_by, left))
+        # a cluster copy is found by the first describe, an instance copy by
+        # the second
+        describes = {'detail type': 0, 'arn only': 0, 'copy gone': None}.get(
+            routed_by, 1 if kind == 'cluster' else 2)
+        if describes is not None and calls != len(events) + describes * args.databases:
+            failures.append('%s %s: %d calls for %d events, expected %d describes per database'
+                            % (kind, routed_by, calls, len(events), describes))
+    if failures:
+        raise SystemExit('\n'.join(failures))
+
+
+if __name__ == '__main__':
+    main()
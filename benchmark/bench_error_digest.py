@@ -0,0 +1,112 @@
+import argparse
+import json
+import time
+
+import stub_aws
+
+
+# SNS publishes during a throttling storm: every retention delete is
+# throttled, so each event reports one failure per expired copy. outside a
+# handler each failure is published on its own; under lambda_handler the
+# failures of an event go out as one digest, and under lambda_batch_handler
+# the failures of the whole batch do. the timer check runs a handler that
+# outlives its flush margin and makes sure the digest was sent before it
+# returned.
+class Context:
+    def __init__(self, remaining_ms):
+        self.deadline = time.time() + remaining_ms / 1000.0
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - time.time()) * 1000)
+
+
+def setup(args):
+    instances = ['db-%04d' % i for i in range(args.instances)]
+    stub_aws.configure_environment(
+        rds_instances=','.join(instances),
+        automated_snapshot_maximum_copies=str(args.copies),
+        delete_max_attempts='1',
+        error_digest_flush_margin_ms='3000'
+    )
+    aws = stub_aws.StubAws(throttle_rate=1.0, throttled_operations=('DeleteDBSnapshot',)).install()
+    events = []
+    for instance in instances:
+        for day in range(args.existing):
+            aws.add_copy('us-west-2', instance, day)
+        events.append(stub_aws.snapshot_event(aws.add_automated_snapshot('us-east-1', instance, args.existing)))
+    aws.reset_calls()
+    return aws, events
+
+
+def run(args, mode):
+    aws, events = setup(args)
+    import lambda_function
+    started = time.perf_counter()
+    with stub_aws.quiet():
+        if mode == 'per failure':
+            for event in events:
+                lambda_function.process_event(event)
+        elif mode == 'per event':
+            for event in events:
+                lambda_function.lambda_handler(event, None)
+        else:
+            records = [{'messageId': str(i), 'body': json.dumps(event)} for i, event in enumerate(events)]
+            lambda_function.lambda_batch_handler({'Records': records}, None)
+    return {
+        'seconds': time.perf_counter() - started,
+        'throttled': sum(aws.throttled.values()),
+        'published': len(aws.published)
+    }
+
+
+def check_timer(args):
+    # the flush margin is 3000 ms, so a context with 3200 ms left flushes
+    # after about 0.2 s, while the handler is still running
+    aws, events = setup(args)
+    import lambda_function
+    import sns_client
+    published_while_running = []
+
+    @sns_client.digested('timeout_check')
+    def handler(event, context):
+        lambda_function.process_event(event)
+        time.sleep(0.5)
+        published_while_running.append(len(aws.published))
+
+    with stub_aws.quiet():
+        handler(events[0], Context(3200))
+    return published_while_running[0], len(aws.published)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--instances', type=int, default=50)
+    parser.add_argument('--existing', type=int, default=10)
+    parser.add_argument('--copies', type=int, default=7)
+    args = parser.parse_args()
+
+    print('%12s %7s %10s %10s %11s' % ('reported', 'events', 'throttled', 'published', 'seconds'))
+    results = {}
+    for mode in ('per failure', 'per event', 'per batch'):
+        result = results[mode] = run(args, mode)
+        print('%12s %7d %10d %10d %11.3f' % (
+            mode, args.instances, result['throttled'], result['published'], result['seconds']))
+
+    failures = []
+    if results['per failure']['published'] != results['per failure']['throttled']:
+        failures.append('expected one publish per failure outside a handler')
+    if results['per event']['published'] != args.instances:
+        failures.append('expected one digest per event')
+    if results['per batch']['published'] != 1:
+        failures.append('expected one digest per batch')
+
+    while_running, total = check_timer(args)
+    print('timer flush: %d digest sent before the handler returned, %d in total' % (while_running, total))
+    if while_running != 1 or total != 1:
+        failures.append('the timer did not flush the digest exactly once before the timeout')
+    if failures:
+        raise SystemExit('\n'.join(failures))
+
+
+if __name__ == '__main__':
+    main()
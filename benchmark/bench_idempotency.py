@@ -0,0 +1,125 @@
+import argparse
+import datetime
+import os
+import random
+import tempfile
+
+import stub_aws
+
+
+# every snapshot reaches the function three times: its creation event, its
+# backup event and one redelivery, in random order. compares the RDS calls
+# and SNS notifications with the idempotency cache off, with the in-process
+# cache only, and with a SQLite store where every delivery lands in a fresh
+# container, so only the durable store can recognise the repeats. the
+# re-create check deletes a manual snapshot and creates it again under the
+# same name and arn: its second copy must still be made.
+def run(args, mode):
+    stub_aws.configure_environment(rds_instances=','.join('db-%04d' % i for i in range(args.snapshots)))
+    os.environ.pop('idempotency_path', None)
+    store_path = None
+    if mode == 'durable':
+        store_path = os.path.join(tempfile.mkdtemp(), 'copied_snapshots.db')
+        os.environ['idempotency_path'] = store_path
+
+    aws = stub_aws.StubAws().install()
+    import idempotency
+    import lambda_function
+    idempotency.IDEMPOTENCY_TTL_SECONDS = 0 if mode == 'off' else 86400
+
+    deliveries = []
+    for i in range(args.snapshots):
+        snapshot = aws.add_automated_snapshot('us-east-1', 'db-%04d' % i, 0)
+        deliveries.append(stub_aws.snapshot_event(snapshot, category='creation'))
+        deliveries.append(stub_aws.snapshot_event(snapshot, category='backup'))
+        deliveries.append(stub_aws.snapshot_event(snapshot, category='creation'))
+    random.Random(args.seed).shuffle(deliveries)
+    aws.reset_calls()
+
+    failed = 0
+    with stub_aws.quiet():
+        for event in deliveries:
+            if mode == 'durable':
+                idempotency.reset()
+            try:
+                lambda_function.process_event(event)
+            except SystemExit as e:
+                if e.code not in (None, 0):
+                    failed += 1
+
+    if store_path:
+        os.remove(store_path)
+    return {
+        'deliveries': len(deliveries),
+        'describe': aws.call_count('DescribeDBSnapshots', 'us-east-1'),
+        'copy': aws.call_count('CopyDBSnapshot'),
+        'calls': aws.call_count(),
+        'published': len(aws.published),
+        'failed': failed,
+        'copies': aws.count_snapshots('us-west-2')
+    }
+
+
+def run_recreated(mode):
+    stub_aws.configure_environment(rds_instances='db-manual')
+    os.environ.pop('idempotency_path', None)
+    store_path = None
+    if mode == 'durable':
+        store_path = os.path.join(tempfile.mkdtemp(), 'copied_snapshots.db')
+        os.environ['idempotency_path'] = store_path
+
+    aws = stub_aws.StubAws().install()
+    import idempotency
+    import lambda_function
+    idempotency.IDEMPOTENCY_TTL_SECONDS = 86400
+
+    copies = []
+    with stub_aws.quiet():
+        for day in range(2):
+            snapshot = aws.add_snapshot(
+                'us-east-1', 'db-manual', 'pre-upgrade', stub_aws.BASE_TIME + datetime.timedelta(days=day),
+                snapshot_type='manual')
+            for category in ('creation', 'backup'):
+                if mode == 'durable':
+                    idempotency.reset()
+                lambda_function.process_event(
+                    stub_aws.snapshot_event(snapshot, message='Manual snapshot created', category=category))
+            copies.append(aws.count_snapshots('us-west-2'))
+            aws.complete_copies()
+            # the snapshot is deleted, and its copy with it
+            aws.remove('instance', 'us-east-1', 'pre-upgrade')
+            if mode == 'durable':
+                idempotency.reset()
+            lambda_function.process_event(
+                stub_aws.snapshot_event(snapshot, message='Deleted manual snapshot', category='deletion'))
+
+    if store_path:
+        os.remove(store_path)
+    return copies, aws.call_count('CopyDBSnapshot')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--snapshots', type=int, default=300)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    print('%10s %11s %10s %8s %10s %8s %8s' % ('mode', 'deliveries', 'describe', 'copy', 'rds calls', 'sns', 'copies'))
+    for mode in ('off', 'in-process', 'durable'):
+        result = run(args, mode)
+        print('%10s %11d %10d %8d %10d %8d %8d' % (
+            mode, result['deliveries'], result['describe'], result['copy'], result['calls'],
+            result['published'], result['copies']))
+        if result['copies'] != args.snapshots or result['failed']:
+            raise SystemExit('%s: %d copies, %d failed deliveries' % (mode, result['copies'], result['failed']))
+
+    for mode in ('in-process', 'durable'):
+        copies, copy_calls = run_recreated(mode)
+        print('%s: manual snapshot re-created under the same arn, copies after each creation %s, %d copy calls' % (
+            mode, copies, copy_calls))
+        if copies != [1, 1] or copy_calls != 2:
+            raise SystemExit('%s: the re-created manual snapshot was not copied once' % mode)
+
+
+if __name__ == '__main__':
+    main()
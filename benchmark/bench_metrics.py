@@ -0,0 +1,94 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+
+import stub_aws
+
+
+# replays the same copy events with emit_metrics off and on, each in a fresh
+# process since the switch is read at import. reports the time per event,
+# checks that the off mode leaves the handlers without the metrics wrapper and prints nothing,
+# checks that every dimension is a string, also for a client made without a
+# region, and shows the handler breakdown document of the last invocation.
+def child(args):
+    instances = ['db-%04d' % i for i in range(args.events)]
+    stub_aws.configure_environment(rds_instances=','.join(instances))
+    aws = stub_aws.StubAws(latency=args.latency).install()
+    import aws_clients
+    import lambda_function
+    import metrics
+
+    snapshots = []
+    for instance in instances:
+        for i in range(args.copies):
+            aws.add_automated_snapshot('us-east-1', instance, i)
+            aws.add_copy('us-west-2', instance, i)
+        snapshots.append(aws.add_automated_snapshot('us-east-1', instance, args.copies))
+
+    output = io.StringIO()
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(output):
+        # a client without a region, as sns_client makes; flushed by the first event
+        aws_clients.get_client('sns').publish(TopicArn='topic', Message='metrics check')
+        for snapshot in snapshots:
+            lambda_function.lambda_handler(stub_aws.snapshot_event(snapshot), None)
+    elapsed = time.perf_counter() - started
+
+    documents = [json.loads(line) for line in output.getvalue().splitlines() if line.startswith('{"_aws"')]
+    handler_documents = [document for document in documents if 'Handler' in document]
+    print(json.dumps({
+        'elapsed': elapsed,
+        # the error digest always wraps the handlers, the metrics wrapper only when on
+        'wrapped': lambda_function.lambda_handler.__code__.co_filename == metrics.__file__,
+        'documents': len(documents),
+        'bad_dimensions': sorted(set(
+            '%s=%r' % (dimension, document[dimension]) for document in documents
+            for dimension in document['_aws']['CloudWatchMetrics'][0]['Dimensions'][0]
+            if not isinstance(document[dimension], str)
+        )),
+        'last': handler_documents[-1] if handler_documents else None
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--events', type=int, default=300)
+    parser.add_argument('--copies', type=int, default=7)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--child', action='store_true')
+    args = parser.parse_args()
+    if args.child:
+        return child(args)
+
+    results = {}
+    for mode in ('no', 'yes'):
+        environment = dict(os.environ, emit_metrics=mode)
+        output = subprocess.check_output(
+            [sys.executable, __file__, '--child', '--events', str(args.events),
+             '--copies', str(args.copies), '--latency', str(args.latency)],
+            env=environment)
+        results[mode] = json.loads(output.decode().splitlines()[-1])
+
+    if results['no']['wrapped'] or results['no']['documents']:
+        raise SystemExit('emit_metrics=no still instruments the handlers')
+    if results['yes']['bad_dimensions']:
+        raise SystemExit('dimensions that are not strings: ' + ', '.join(results['yes']['bad_dimensions']))
+
+    print('%12s %12s %14s %12s' % ('emit_metrics', 'elapsed', 'ms per event', 'documents'))
+    for mode in ('no', 'yes'):
+        result = results[mode]
+        print('%12s %11.2fs %14.3f %12d' % (
+            mode, result['elapsed'], 1000 * result['elapsed'] / args.events, result['documents']))
+
+    last = results['yes']['last']
+    print('last handler document: %.2f ms, %d API calls, AWS time by operation %s' % (
+        last['Duration'], last['ApiCalls'], json.dumps(last['AwsCallTimeByOperation'])))
+
+
+if __name__ == '__main__':
+    main()
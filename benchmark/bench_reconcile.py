@@ -0,0 +1,76 @@
+import argparse
+import random
+import time
+
+import stub_aws
+
+
+# simulates a fleet where some copies were never made because their events
+# were lost. compares replaying one event per missing snapshot with a single
+# reconcile sweep, in API calls and wall time.
+def setup(args):
+    instances = ['db-%04d' % i for i in range(args.instances)]
+    stub_aws.configure_environment(
+        rds_instances=','.join(instances),
+        automated_snapshot_maximum_copies=str(args.snapshots)
+    )
+    aws = stub_aws.StubAws(latency=args.latency).install()
+
+    rng = random.Random(args.seed)
+    missing = []
+    for instance in instances:
+        for i in range(args.snapshots):
+            snapshot = aws.add_automated_snapshot('us-east-1', instance, i)
+            if rng.random() < args.missing_rate:
+                missing.append(snapshot)
+            else:
+                aws.add_copy('us-west-2', instance, i)
+    aws.reset_calls()
+    return aws, missing
+
+
+def run_events(args):
+    aws, missing = setup(args)
+    import lambda_function
+    started = time.perf_counter()
+    with stub_aws.quiet():
+        for snapshot in missing:
+            lambda_function.lambda_handler(stub_aws.snapshot_event(snapshot), None)
+    return aws, missing, time.perf_counter() - started
+
+
+def run_reconcile(args):
+    aws, missing = setup(args)
+    import lambda_function
+    started = time.perf_counter()
+    with stub_aws.quiet():
+        lambda_function.reconcile_handler({'region': 'us-east-1'}, None)
+    return aws, missing, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--instances', type=int, default=500)
+    parser.add_argument('--snapshots', type=int, default=7)
+    parser.add_argument('--missing-rate', type=float, default=0.05)
+    parser.add_argument('--latency', type=float, default=0.002)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    print('%10s %8s %8s %10s %10s %10s' % ('mode', 'missing', 'copies', 'describe', 'api calls', 'elapsed'))
+    for mode, run in (('per-event', run_events), ('reconcile', run_reconcile)):
+        aws, missing, elapsed = run(args)
+        copied = set(aws.snapshots['instance']['us-west-2'])
+        not_copied = [
+            snapshot for snapshot in missing
+            if snapshot['DBSnapshotIdentifier'].replace(':', '-') + '-autocopied' not in copied
+        ]
+        if not_copied:
+            raise SystemExit('%s left %d snapshots uncopied' % (mode, len(not_copied)))
+        print('%10s %8d %8d %10d %10d %9.2fs' % (
+            mode, len(missing), aws.call_count('CopyDBSnapshot'), aws.call_count('DescribeDBSnapshots'),
+            aws.call_count(), elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+import argparse
+
+import stub_aws
+
+
+# counts RDS API calls made by one automated snapshot creation event while the
+# target region already holds N copies of the instance. the retention scan
+# should cost one describe page per 100 copies, and no per-copy tag lookups.
+def run(copies, page_size):
+    # retention limit above the number of copies, so only the scan is counted
+    stub_aws.configure_environment(
+        rds_instances='db-bench',
+        automated_snapshot_maximum_copies=str(copies + 2)
+    )
+    aws = stub_aws.StubAws(page_size=page_size).install()
+
+    for i in range(copies):
+        aws.add_copy('us-west-2', 'db-bench', i)
+
+    import rds_instance
+    rdsi = rds_instance.RdsInstance('us-east-1')
+    aws.reset_calls()
+    with stub_aws.quiet():
+        rdsi.test_function('db-bench')
+    return aws
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--copies', type=int, nargs='+', default=[5, 35, 100, 1000])
+    parser.add_argument('--page-size', type=int, default=100)
+    args = parser.parse_args()
+
+    print('%8s %10s %10s %8s %14s' % ('copies', 'describe', 'list_tags', 'total', 'n+1 baseline'))
+    for copies in args.copies:
+        aws = run(copies, args.page_size)
+        describe = aws.call_count('DescribeDBSnapshots')
+        list_tags = aws.call_count('ListTagsForResource')
+        print('%8d %10d %10d %8d %14d' % (
+            copies, describe, list_tags, describe + list_tags, describe + copies))
+
+
+if __name__ == '__main__':
+    main()
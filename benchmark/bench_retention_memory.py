@@ -0,0 +1,59 @@
+import argparse
+import time
+import tracemalloc
+
+import stub_aws
+
+
+# runs the retention step against a target region holding thousands of
+# automated copies, checks that exactly MAX-1 copies survive and reports the
+# peak memory of the scan, which should not grow with the number of copies.
+def run(copies, maximum_copies):
+    stub_aws.configure_environment(
+        rds_instances='db-bench',
+        automated_snapshot_maximum_copies=str(maximum_copies)
+    )
+    aws = stub_aws.StubAws().install()
+
+    # insert in shuffled order so pages are not sorted by creation time
+    for i in range(copies):
+        aws.add_copy('us-west-2', 'db-bench', (i * 7919) % copies)
+
+    import rds_instance
+    rdsi = rds_instance.RdsInstance('us-east-1')
+    aws.reset_calls()
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    with stub_aws.quiet():
+        rdsi.test_function('db-bench')
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    remaining = sorted(aws.snapshots['instance']['us-west-2'])
+    expected = sorted(
+        stub_aws.StubAws().add_copy('us-west-2', 'db-bench', i)['DBSnapshotIdentifier']
+        for i in range(copies - maximum_copies + 1, copies)
+    )
+    if remaining != expected:
+        raise SystemExit('retention kept %d copies, expected the newest %d' % (len(remaining), len(expected)))
+    return aws, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--copies', type=int, nargs='+', default=[1000, 5000, 20000])
+    parser.add_argument('--maximum-copies', type=int, default=8)
+    args = parser.parse_args()
+
+    print('%8s %10s %10s %10s %12s' % ('copies', 'describe', 'deleted', 'elapsed', 'peak KiB'))
+    for copies in args.copies:
+        aws, elapsed, peak = run(copies, args.maximum_copies)
+        print('%8d %10d %10d %9.2fs %12.1f' % (
+            copies, aws.call_count('DescribeDBSnapshots'), aws.call_count('DeleteDBSnapshot'),
+            elapsed, peak / 1024.0))
+
+
+if __name__ == '__main__':
+    main()
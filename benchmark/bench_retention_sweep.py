@@ -0,0 +1,99 @@
+import argparse
+import datetime
+import random
+import time
+
+import stub_aws
+
+
+# a fleet whose copies piled up: the retention limit was lowered, and some
+# databases were deleted or stopped taking snapshots. compares running the
+# per-database retention for every database one after another with one
+# retention_sweep_handler run, and checks that every database keeps at most
+# automated_snapshot_maximum_copies available copies and that the delta base
+# of a copy in progress is kept.
+def build_fleet(aws, args):
+    rng = random.Random(args.seed)
+    databases = ['db-%04d' % i for i in range(args.instances)]
+    bases = {}
+    for database in databases:
+        copies = rng.randint(1, args.old_copies)
+        for day in range(copies):
+            aws.add_copy('us-west-2', database, day)
+        if rng.random() < args.in_progress:
+            # the newest copy is the base of a copy still being created
+            aws.add_copy('us-west-2', database, copies, status='creating')
+            bases[database] = 'rds-%s-%s-autocopied' % (
+                database, (stub_aws.BASE_TIME + datetime.timedelta(days=copies - 1)).strftime('%Y-%m-%d-%H-%M'))
+    return databases, bases
+
+
+def check(aws, args, bases):
+    available = {}
+    for snapshot in aws.snapshots['instance']['us-west-2'].values():
+        if snapshot['Status'] == 'available':
+            available.setdefault(snapshot['DBInstanceIdentifier'], set()).add(snapshot['DBSnapshotIdentifier'])
+    errors = []
+    for database, identifiers in available.items():
+        if len(identifiers) > args.copies:
+            errors.append('%s keeps %d copies' % (database, len(identifiers)))
+    for database, base in bases.items():
+        if base not in available.get(database, ()):
+            errors.append('%s lost the delta base %s' % (database, base))
+    return errors
+
+
+def run(args, mode):
+    stub_aws.configure_environment(
+        rds_instances='db-*',
+        automated_snapshot_maximum_copies=str(args.copies)
+    )
+    aws = stub_aws.StubAws(latency=args.latency, page_size=100).install()
+    import rds_instance
+    import lambda_function
+    databases, bases = build_fleet(aws, args)
+    before = aws.count_snapshots('us-west-2')
+    aws.reset_calls()
+
+    started = time.time()
+    with stub_aws.quiet():
+        if mode == 'per-database':
+            handler = rds_instance.RdsInstance('us-east-1')
+            for database in databases:
+                handler.clean_copies_of_automated_snapshot(database, 'us-west-2', args.copies)
+        else:
+            lambda_function.retention_sweep_handler({'region': 'us-east-1'}, None)
+    elapsed = time.time() - started
+
+    return {
+        'before': before,
+        'deleted': aws.call_count('DeleteDBSnapshot'),
+        'describe': aws.call_count('DescribeDBSnapshots') + aws.call_count('DescribeDBClusterSnapshots'),
+        'elapsed': elapsed,
+        'errors': check(aws, args, bases)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--instances', type=int, default=500)
+    parser.add_argument('--old-copies', type=int, default=30)
+    parser.add_argument('--copies', type=int, default=7)
+    parser.add_argument('--in-progress', type=float, default=0.1)
+    parser.add_argument('--latency', type=float, default=0.002)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    print('%13s %8s %8s %10s %9s' % ('mode', 'copies', 'deleted', 'describes', 'elapsed'))
+    failures = []
+    for mode in ('per-database', 'sweep'):
+        result = run(args, mode)
+        print('%13s %8d %8d %10d %8.2fs' % (
+            mode, result['before'], result['deleted'], result['describe'], result['elapsed']))
+        failures.extend(mode + ': ' + error for error in result['errors'])
+    if failures:
+        raise SystemExit('\n'.join(failures[:20]))
+
+
+if __name__ == '__main__':
+    main()
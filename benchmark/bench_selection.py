@@ -0,0 +1,72 @@
+import argparse
+import random
+import time
+
+import stub_aws
+
+
+# an account where most snapshot events belong to databases that are not
+# protected. replays a mix of automated snapshot events and reports the RDS
+# calls made for the unprotected ones, which the selection index drops from
+# the raw event, and the cost of one lookup in the compiled index next to a
+# scan of the plain list.
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--databases', type=int, default=2000)
+    parser.add_argument('--protected', type=int, default=200)
+    parser.add_argument('--events', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    databases = ['db-%05d' % i for i in range(args.databases)]
+    protected = databases[:args.protected]
+    stub_aws.configure_environment(rds_instances=','.join(protected + ['reporting-*', 're:audit-[0-9]+']))
+    aws = stub_aws.StubAws().install()
+    import lambda_function
+    import selection
+
+    rng = random.Random(args.seed)
+    events = []
+    for i in range(args.events):
+        database = rng.choice(databases)
+        snapshot = aws.add_automated_snapshot('us-east-1', database, i)
+        events.append((database in protected, stub_aws.snapshot_event(snapshot)))
+    aws.reset_calls()
+
+    calls = {True: 0, False: 0}
+    counts = {True: 0, False: 0}
+    with stub_aws.quiet():
+        for is_protected, event in events:
+            before = aws.call_count()
+            lambda_function.process_event(event)
+            calls[is_protected] += aws.call_count() - before
+            counts[is_protected] += 1
+
+    print('%12s %8s %12s' % ('events', 'count', 'rds calls'))
+    print('%12s %8d %12d' % ('protected', counts[True], calls[True]))
+    print('%12s %8d %12d' % ('unprotected', counts[False], calls[False]))
+    if calls[False]:
+        raise SystemExit('unprotected events made RDS calls')
+
+    index = selection.index_for('rds_instances')
+    plain = protected + ['reporting-*', 're:audit-[0-9]+']
+    identifiers = [rng.choice(databases) for _ in range(10000)]
+    started = time.perf_counter()
+    for identifier in identifiers:
+        index.matches(identifier)
+    indexed = time.perf_counter() - started
+    started = time.perf_counter()
+    for identifier in identifiers:
+        identifier in plain
+    scanned = time.perf_counter() - started
+    print('lookup: %.2f us compiled index, %.2f us list scan of %d entries' % (
+        1e6 * indexed / len(identifiers), 1e6 * scanned / len(identifiers), len(plain)))
+
+    checks = {'reporting-eu': True, 'audit-42': True, 'audit-x': False, 'db-%05d' % args.protected: False}
+    for identifier, expected in checks.items():
+        if index.matches(identifier) != expected:
+            raise SystemExit('%s: expected match %s' % (identifier, expected))
+
+
+if __name__ == '__main__':
+    main()
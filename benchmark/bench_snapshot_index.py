@@ -0,0 +1,98 @@
+import argparse
+import os
+import tempfile
+
+import stub_aws
+
+
+# a fleet takes one automated snapshot per database per day for a number of
+# simulated days, with the copy tracker running the deferred retention.
+# compares the describe calls the target region sees per snapshot event when
+# retention scans the target region and when it reads the snapshot index,
+# next to the calls of one verification sweep, and checks that both modes
+# leave exactly automated_snapshot_maximum_copies copies of every database.
+def run(args, mode):
+    instances = ['db-%04d' % i for i in range(args.instances)]
+    stub_aws.configure_environment(
+        rds_instances=','.join(instances),
+        automated_snapshot_maximum_copies=str(args.copies)
+    )
+    directory = tempfile.mkdtemp()
+    os.environ['copy_tracker_path'] = os.path.join(directory, 'in_flight_copies.db')
+    os.environ.pop('copy_queue_path', None)
+    os.environ.pop('snapshot_index_path', None)
+    if mode == 'index':
+        os.environ['snapshot_index_path'] = os.path.join(directory, 'snapshot_index.db')
+
+    aws = stub_aws.StubAws(copy_base_seconds=args.copy_seconds).install()
+    import copy_scheduler
+    import copy_tracker
+    import lambda_function
+    import snapshot_index
+    copy_scheduler.reset()
+    copy_tracker.reset()
+    copy_tracker.now = lambda: aws.clock
+    snapshot_index.now = lambda: aws.clock
+
+    for instance in instances:
+        for day in range(args.copies):
+            aws.add_automated_snapshot('us-east-1', instance, day)
+            aws.add_copy('us-west-2', instance, day)
+
+    events = 0
+    describes = 0
+    for day in range(args.copies, args.copies + args.days):
+        snapshots = [aws.add_automated_snapshot('us-east-1', instance, day) for instance in instances]
+        aws.reset_calls()
+        with stub_aws.quiet():
+            for snapshot in snapshots:
+                lambda_function.lambda_handler(stub_aws.snapshot_event(snapshot), None)
+            aws.advance(args.copy_seconds)
+            lambda_function.track_handler({}, None)
+        events += len(snapshots)
+        # the tracker's own status poll is the same paginated describe in
+        # both modes and is counted too
+        describes += aws.call_count('DescribeDBSnapshots', 'us-west-2')
+        aws.advance(86400 - args.copy_seconds)
+
+    sweep = 0
+    if mode == 'index':
+        aws.reset_calls()
+        with stub_aws.quiet():
+            lambda_function.verify_index_handler({'region': 'us-east-1'}, None)
+        sweep = aws.call_count('DescribeDBSnapshots', 'us-west-2')
+
+    per_db = {}
+    for snapshot in aws.snapshots['instance']['us-west-2'].values():
+        per_db[snapshot['DBInstanceIdentifier']] = per_db.get(snapshot['DBInstanceIdentifier'], 0) + 1
+    wrong = [instance for instance in instances if per_db.get(instance) != args.copies]
+    return {
+        'events': events,
+        'describes': describes,
+        'sweep': sweep,
+        'wrong': len(wrong)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--instances', type=int, default=200)
+    parser.add_argument('--days', type=int, default=5)
+    parser.add_argument('--copies', type=int, default=7)
+    parser.add_argument('--copy-seconds', type=float, default=600.0)
+    args = parser.parse_args()
+
+    print('%6s %8s %18s %20s %14s' % ('mode', 'events', 'target describes', 'describes per event', 'sweep calls'))
+    failures = []
+    for mode in ('scan', 'index'):
+        result = run(args, mode)
+        print('%6s %8d %18d %20.2f %14d' % (
+            mode, result['events'], result['describes'], result['describes'] / float(result['events']), result['sweep']))
+        if result['wrong']:
+            failures.append('%s: %d databases do not keep %d copies' % (mode, result['wrong'], args.copies))
+    if failures:
+        raise SystemExit('\n'.join(failures))
+
+
+if __name__ == '__main__':
+    main()
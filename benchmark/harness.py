@@ -0,0 +1,295 @@
+import argparse
+import concurrent.futures
+import datetime
+import json
+import random
+import threading
+import time
+import tracemalloc
+
+import stub_aws
+
+
+# load-replay harness: replays synthetic or recorded EventBridge snapshot
+# events through lambda_handler against the in-memory RDS/SNS stub, and
+# reports events/sec, p50/p99 latency, API calls per event and peak memory.
+#
+# synthetic events mix creation, backup (a second event for a snapshot that
+# was already created) and deletion events of instances and clusters. a
+# recorded file holds one EventBridge event per line, or a JSON array; the
+# stub is seeded from the events themselves, so snapshots of any account
+# and region replay offline. --record writes the synthetic events to a file
+# that --replay reads back.
+#
+#   python harness.py --events 2000 --rate 200 --concurrency 20 --latency 0.02
+#   python harness.py --events 500 --record events.jsonl
+#   python harness.py --replay events.jsonl --throttle-rate 0.05
+SOURCE_REGION = 'us-east-1'
+AUTOMATED_SNAPSHOT_TIME_FORMAT = '%Y-%m-%d-%H-%M'
+
+MESSAGES = {
+    ('instance', 'created'): 'Automated snapshot created',
+    ('cluster', 'created'): 'Automated cluster snapshot created',
+    ('instance', 'deleted'): 'Deleted automated snapshot',
+    ('cluster', 'deleted'): 'Deleted automated snapshot'
+}
+
+
+def parse_mix(value):
+    # "creation=6,backup=2,deletion=2" -> [(category, weight)]
+    mix = []
+    for pair in value.split(','):
+        category, weight = pair.split('=')
+        mix.append((category.strip(), float(weight)))
+    return mix
+
+
+def automated_snapshot(kind, database, index):
+    keys = stub_aws.KINDS[kind]
+    created = stub_aws.BASE_TIME + datetime.timedelta(days=index)
+    snapshot_identifier = 'rds:%s-%s' % (database, created.strftime(AUTOMATED_SNAPSHOT_TIME_FORMAT))
+    return {
+        keys['id']: snapshot_identifier,
+        keys['arn']: 'arn:aws:rds:%s:%s:%s:%s' % (
+            SOURCE_REGION, stub_aws.ACCOUNT_ID, keys['arn_type'], snapshot_identifier)
+    }
+
+
+def synthetic_events(args):
+    rng = random.Random(args.seed)
+    categories, weights = zip(*parse_mix(args.mix))
+    created = {}
+    deleted = {}
+    events = []
+    for i in range(args.events):
+        kind = 'cluster' if rng.random() < args.cluster_share else 'instance'
+        database = '%s-%04d' % ('cluster' if kind == 'cluster' else 'db', rng.randrange(args.databases))
+        category = rng.choices(categories, weights)[0]
+        key = (kind, database)
+
+        if category == 'deletion':
+            # the oldest copy that is left, one of the --existing-copies
+            index = deleted.get(key, 0)
+            if index >= args.existing_copies:
+                category = 'creation'
+            else:
+                deleted[key] = index + 1
+                events.append(stub_aws.snapshot_event(
+                    automated_snapshot(kind, database, index), kind=kind,
+                    message=MESSAGES[(kind, 'deleted')], category='deletion'))
+                continue
+
+        if category == 'backup' and key in created:
+            # the second event RDS sends for a snapshot already announced
+            index = created[key]
+        else:
+            index = created.get(key, args.existing_copies - 1) + 1
+            created[key] = index
+        events.append(stub_aws.snapshot_event(
+            automated_snapshot(kind, database, index), kind=kind,
+            message=MESSAGES[(kind, 'created')], category=category))
+    return events
+
+
+def load_events(path):
+    with open(path) as f:
+        text = f.read().strip()
+    if text.startswith('['):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def record_events(events, path):
+    with open(path, 'w') as f:
+        for event in events:
+            f.write(json.dumps(event) + '\n')
+
+
+def event_kind(event):
+    return 'cluster' if event.get('detail-type') == 'RDS DB Cluster Snapshot Event' else 'instance'
+
+
+def parse_snapshot_identifier(snapshot_identifier):
+    # (database, create time) of an automated snapshot name, else (name, None)
+    name = snapshot_identifier[len('rds:'):] if snapshot_identifier.startswith('rds:') else None
+    if name is not None and len(name) > 17:
+        try:
+            created = datetime.datetime.strptime(name[-16:], AUTOMATED_SNAPSHOT_TIME_FORMAT)
+            return name[:-17], created.replace(tzinfo=datetime.timezone.utc)
+        except ValueError:
+            pass
+    return snapshot_identifier, None
+
+
+def seed(aws, events, args):
+    # the source snapshots of the creation events, the copies the deletion
+    # events remove, and --existing-copies older copies of every database
+    databases = set()
+    regions = args.regions.split(',')
+    for event in events:
+        detail = event['detail']
+        kind = event_kind(event)
+        snapshot_identifier = detail['SourceIdentifier']
+        database, created = parse_snapshot_identifier(snapshot_identifier)
+        automated = 'automated' in detail.get('Message', '').lower()
+        databases.add((kind, database))
+        if detail['EventCategories'][0] == 'deletion':
+            tags = [
+                {'Key': 'Source-Snapshot', 'Value': snapshot_identifier},
+                {'Key': 'Source-Snapshot-Type', 'Value': 'Automated' if automated else 'Manual'}
+            ]
+            for region in regions:
+                aws.add_snapshot(
+                    region, database, snapshot_identifier.replace(':', '-') + '-autocopied',
+                    created or stub_aws.BASE_TIME, kind=kind, snapshot_type='manual', tags=tags)
+        elif event['region'] not in regions:
+            aws.add_snapshot(
+                event['region'], database, snapshot_identifier, created or stub_aws.BASE_TIME, kind=kind,
+                snapshot_type='automated' if automated else 'manual',
+                allocated_storage=args.allocated_storage, arn=detail['SourceArn'])
+
+    for kind, database in databases:
+        for index in range(args.existing_copies):
+            for region in regions:
+                aws.add_copy(region, database, index, kind=kind)
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))]
+
+
+def replay(args, events):
+    stub_aws.configure_environment(
+        rds_instances='*',
+        rds_clusters='*',
+        dest_region=args.regions,
+        automated_snapshot_maximum_copies=str(args.maximum_copies)
+    )
+    aws = stub_aws.StubAws(
+        latency=args.latency, page_size=args.page_size, throttle_rate=args.throttle_rate,
+        seed=args.seed, copy_quota=args.copy_quota
+    ).install()
+    import lambda_function
+    lambda_function.ENGINE = args.engine
+    seed(aws, events, args)
+    aws.reset_calls()
+
+    latencies = [None] * len(events)
+    failures = []
+    failures_lock = threading.Lock()
+
+    def invoke(i, arrival):
+        started = time.perf_counter()
+        ok = True
+        try:
+            lambda_function.lambda_handler(events[i], None)
+        except SystemExit as e:
+            ok = e.code in (None, 0)
+        except Exception:
+            ok = False
+        # with a rate, latency is measured from the arrival, queueing included
+        latencies[i] = time.perf_counter() - (arrival if arrival is not None else started)
+        if not ok:
+            with failures_lock:
+                failures.append(i)
+
+    if not args.skip_memory:
+        tracemalloc.start()
+    with stub_aws.quiet(), concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        begin = time.perf_counter()
+        futures = []
+        for i in range(len(events)):
+            arrival = None
+            if args.rate:
+                arrival = begin + i / float(args.rate)
+                delay = arrival - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            futures.append(executor.submit(invoke, i, arrival))
+        concurrent.futures.wait(futures)
+        elapsed = time.perf_counter() - begin
+    peak_memory = None
+    if not args.skip_memory:
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    operations = {}
+    for (service, region, operation), count in aws.calls.items():
+        operations[operation] = operations.get(operation, 0) + count
+    categories = {}
+    for event in events:
+        key = event_kind(event) + '/' + event['detail']['EventCategories'][0]
+        categories[key] = categories.get(key, 0) + 1
+    calls = sum(operations.values())
+    return {
+        'events': len(events),
+        'categories': categories,
+        'engine': args.engine,
+        'elapsed_seconds': round(elapsed, 3),
+        'events_per_second': round(len(events) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 1),
+        'api_calls': calls,
+        'api_calls_per_event': round(calls / float(len(events)), 2),
+        'api_calls_by_operation': operations,
+        'throttled': sum(aws.throttled.values()),
+        'sns_published': len(aws.published),
+        'failed': len(failures),
+        'peak_memory_mb': round(peak_memory / 1048576.0, 2) if peak_memory is not None else None
+    }
+
+
+def print_report(result):
+    print('events:        %d (%s)' % (result['events'], ', '.join(
+        '%s %d' % (key, count) for key, count in sorted(result['categories'].items()))))
+    print('engine:        %s' % result['engine'])
+    print('elapsed:       %.2fs, %.1f events/sec' % (result['elapsed_seconds'], result['events_per_second']))
+    print('latency:       p50 %.1f ms, p99 %.1f ms' % (result['p50_ms'], result['p99_ms']))
+    print('api calls:     %d, %.2f per event (%s)' % (result['api_calls'], result['api_calls_per_event'], ', '.join(
+        '%s %d' % (operation, count) for operation, count in sorted(result['api_calls_by_operation'].items()))))
+    print('throttled:     %d, sns published: %d, failed events: %d' % (
+        result['throttled'], result['sns_published'], result['failed']))
+    if result['peak_memory_mb'] is not None:
+        print('peak memory:   %.2f MB (tracemalloc, during the replay)' % result['peak_memory_mb'])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--events', type=int, default=1000)
+    parser.add_argument('--databases', type=int, default=100)
+    parser.add_argument('--cluster-share', type=float, default=0.3)
+    parser.add_argument('--mix', default='creation=6,backup=2,deletion=2')
+    parser.add_argument('--existing-copies', type=int, default=7)
+    parser.add_argument('--maximum-copies', type=int, default=7)
+    parser.add_argument('--allocated-storage', type=int, default=20)
+    parser.add_argument('--regions', default='us-west-2')
+    parser.add_argument('--rate', type=float, default=0.0, help='events per second, 0 replays as fast as possible')
+    parser.add_argument('--concurrency', type=int, default=1, help='invocations in flight')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every RDS call')
+    parser.add_argument('--throttle-rate', type=float, default=0.0)
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--copy-quota', type=int, default=None)
+    parser.add_argument('--engine', default='sync', choices=('sync', 'async'))
+    parser.add_argument('--replay', help='file of recorded events to replay instead of synthetic ones')
+    parser.add_argument('--record', help='write the synthetic events to this file')
+    parser.add_argument('--skip-memory', action='store_true', help='do not trace memory, tracemalloc slows the replay')
+    parser.add_argument('--max-failed', type=int, default=None, help='exit with an error above this many failed events')
+    parser.add_argument('--json', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    events = load_events(args.replay) if args.replay else synthetic_events(args)
+    if args.record:
+        record_events(events, args.record)
+    result = replay(args, events)
+    if args.json:
+        print(json.dumps(result, indent=2, sort_keys=True))
+    else:
+        print_report(result)
+    if args.max_failed is not None and result['failed'] > args.max_failed:
+        raise SystemExit('%d events failed' % result['failed'])
+
+
+if __name__ == '__main__':
+    main()
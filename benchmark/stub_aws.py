@@ -0,0 +1,428 @@
+import bisect
+import contextlib
+import copy
+import datetime
+import itertools
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+
+
+# in-memory stand-in for the RDS and SNS APIs used by the lambda function.
+# plugged in through aws_clients.set_client_factory so the benchmarks run
+# offline, without boto3 or credentials.
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda-function')
+if LAMBDA_DIR not in sys.path:
+    sys.path.insert(0, LAMBDA_DIR)
+
+ACCOUNT_ID = '123456789012'
+BASE_TIME = datetime.datetime(2020, 6, 1, tzinfo=datetime.timezone.utc)
+
+DEFAULT_ENVIRONMENT = {
+    'automated_delete_manual_snapshot': 'yes',
+    'automated_snapshot_maximum_copies': '7',
+    'dest_region': 'us-west-2',
+    'rds_instances': '',
+    'rds_clusters': '',
+    'kms_key_id': 'arn:aws:kms:us-west-2:123456789012:key/benchmark',
+    'encrypt_rds_instance_snapshot': 'no',
+    'sns_topic_arn': 'arn:aws:sns:us-east-1:123456789012:benchmark'
+}
+
+
+@contextlib.contextmanager
+def quiet():
+    # hides the lambda function's prints while a benchmark is timing it
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def configure_environment(**overrides):
+    for key, value in DEFAULT_ENVIRONMENT.items():
+        os.environ[key] = value
+    for key, value in overrides.items():
+        os.environ[key] = value
+
+
+class StubClientError(Exception):
+    code = 'InternalFailure'
+
+    def __init__(self, operation_name, message='', code=None):
+        self.response = {'Error': {'Code': code or self.code, 'Message': message}}
+        self.operation_name = operation_name
+        super().__init__('An error occurred (%s) when calling the %s operation: %s' % (
+            self.response['Error']['Code'], operation_name, message))
+
+
+def _fault(name, code=None):
+    return type(name, (StubClientError,), {'code': code or name.replace('Fault', '')})
+
+
+class StubRdsExceptions:
+    ClientError = StubClientError
+    DBSnapshotNotFoundFault = _fault('DBSnapshotNotFoundFault', 'DBSnapshotNotFound')
+    DBClusterSnapshotNotFoundFault = _fault('DBClusterSnapshotNotFoundFault', 'DBClusterSnapshotNotFoundFault')
+    DBSnapshotAlreadyExistsFault = _fault('DBSnapshotAlreadyExistsFault', 'DBSnapshotAlreadyExists')
+    DBClusterSnapshotAlreadyExistsFault = _fault('DBClusterSnapshotAlreadyExistsFault', 'DBClusterSnapshotAlreadyExistsFault')
+    SnapshotQuotaExceededFault = _fault('SnapshotQuotaExceededFault', 'SnapshotQuotaExceeded')
+
+
+KINDS = {
+    'instance': {
+        'list': 'DBSnapshots',
+        'id': 'DBSnapshotIdentifier',
+        'arn': 'DBSnapshotArn',
+        'source': 'DBInstanceIdentifier',
+        'encrypted': 'Encrypted',
+        'arn_type': 'snapshot',
+        'not_found': StubRdsExceptions.DBSnapshotNotFoundFault,
+        'exists': StubRdsExceptions.DBSnapshotAlreadyExistsFault
+    },
+    'cluster': {
+        'list': 'DBClusterSnapshots',
+        'id': 'DBClusterSnapshotIdentifier',
+        'arn': 'DBClusterSnapshotArn',
+        'source': 'DBClusterIdentifier',
+        'encrypted': 'StorageEncrypted',
+        'arn_type': 'cluster-snapshot',
+        'not_found': StubRdsExceptions.DBClusterSnapshotNotFoundFault,
+        'exists': StubRdsExceptions.DBClusterSnapshotAlreadyExistsFault
+    }
+}
+
+
+def public(snapshot):
+    # copy of a stored snapshot without the stub's private bookkeeping keys
+    return copy.deepcopy(dict((key, value) for key, value in snapshot.items() if not key.startswith('_')))
+
+
+class StubAws:
+    def __init__(self, latency=0.0, page_size=100, throttle_rate=0.0, throttled_operations=None, seed=0,
+                 copy_quota=None, copy_base_seconds=60.0, copy_seconds_per_gb=0.0):
+        self.latency = latency
+        self.page_size = page_size
+        # copies in progress allowed per target region, and the simulated time
+        # a copy takes; advance() moves the simulated clock
+        self.copy_quota = copy_quota
+        self.copy_base_seconds = copy_base_seconds
+        self.copy_seconds_per_gb = copy_seconds_per_gb
+        self.clock = 0.0
+        self.completed_copies = []
+        # fraction of calls to throttled_operations (all operations if None)
+        # that fail with a Throttling error
+        self.throttle_rate = throttle_rate
+        self.throttled_operations = throttled_operations
+        self.random = random.Random(seed)
+        self.throttled = Counter()
+        self.snapshots = {'instance': defaultdict(dict), 'cluster': defaultdict(dict)}
+        self.ordered_identifiers = {'instance': defaultdict(list), 'cluster': defaultdict(list)}
+        self.by_arn = {}
+        self.calls = Counter()
+        self.clients_created = Counter()
+        self.published = []
+        self.lock = threading.RLock()
+
+    # wiring
+
+    def client_factory(self, service, region, config):
+        with self.lock:
+            self.clients_created[(service, region)] += 1
+        if service == 'rds':
+            return StubRdsClient(self, region)
+        if service == 'sns':
+            return StubSnsClient(self, region)
+        raise ValueError('no stub for service ' + service)
+
+    def install(self):
+        import aws_clients
+        import idempotency
+        import snapshot_index
+        aws_clients.set_client_factory(self.client_factory)
+        # copies recorded against an earlier stub do not exist in this one
+        idempotency.reset()
+        snapshot_index.reset()
+        return self
+
+    def record_call(self, service, region, operation):
+        with self.lock:
+            self.calls[(service, region, operation)] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.throttle_rate and (self.throttled_operations is None or operation in self.throttled_operations):
+            with self.lock:
+                throttle = self.random.random() < self.throttle_rate
+                if throttle:
+                    self.throttled[operation] += 1
+            if throttle:
+                raise StubClientError(operation, 'Rate exceeded', code='Throttling')
+
+    def call_count(self, operation=None, region=None):
+        with self.lock:
+            return sum(
+                count for (service, call_region, call_operation), count in self.calls.items()
+                if (operation is None or call_operation == operation)
+                and (region is None or call_region == region)
+            )
+
+    def reset_calls(self):
+        with self.lock:
+            self.calls.clear()
+            self.throttled.clear()
+
+    # fixtures
+
+    def add_snapshot(self, region, source_identifier, snapshot_identifier, created=None,
+                     kind='instance', snapshot_type='automated', status='available',
+                     encrypted=False, allocated_storage=20, tags=None, kms_key_id=None, arn=None):
+        keys = KINDS[kind]
+        snapshot = {
+            keys['id']: snapshot_identifier,
+            keys['source']: source_identifier,
+            keys['arn']: arn or 'arn:aws:rds:%s:%s:%s:%s' % (region, ACCOUNT_ID, keys['arn_type'], snapshot_identifier),
+            'SnapshotType': snapshot_type,
+            'Status': status,
+            keys['encrypted']: encrypted,
+            'AllocatedStorage': allocated_storage,
+            'PercentProgress': 100 if status == 'available' else 0,
+            'TagList': list(tags or [])
+        }
+        if kms_key_id:
+            snapshot['KmsKeyId'] = kms_key_id
+        if created is not None:
+            snapshot['SnapshotCreateTime'] = created
+        with self.lock:
+            self.store(kind, region, snapshot)
+        return snapshot
+
+    def add_automated_snapshot(self, region, source_identifier, index, kind='instance', **kwargs):
+        created = BASE_TIME + datetime.timedelta(days=index)
+        snapshot_identifier = 'rds:%s-%s' % (source_identifier, created.strftime('%Y-%m-%d-%H-%M'))
+        return self.add_snapshot(region, source_identifier, snapshot_identifier, created, kind=kind, **kwargs)
+
+    def add_copy(self, region, source_identifier, index, kind='instance', source_type='Automated', **kwargs):
+        created = BASE_TIME + datetime.timedelta(days=index)
+        source_snapshot_identifier = 'rds:%s-%s' % (source_identifier, created.strftime('%Y-%m-%d-%H-%M'))
+        tags = [
+            {'Key': 'Source-Snapshot', 'Value': source_snapshot_identifier},
+            {'Key': 'Source-Snapshot-Type', 'Value': source_type}
+        ]
+        return self.add_snapshot(
+            region, source_identifier, source_snapshot_identifier.replace(':', '-') + '-autocopied',
+            created, kind=kind, snapshot_type='manual', tags=tags, **kwargs)
+
+    def complete_copies(self, region=None):
+        with self.lock:
+            for kind in KINDS:
+                for snapshot_region, snapshots in self.snapshots[kind].items():
+                    if region is not None and snapshot_region != region:
+                        continue
+                    for snapshot in snapshots.values():
+                        if snapshot['Status'] != 'available':
+                            snapshot['Status'] = 'available'
+                            snapshot['PercentProgress'] = 100
+                            snapshot.setdefault('SnapshotCreateTime', snapshot.pop('_SourceCreateTime', BASE_TIME))
+
+    def store(self, kind, region, snapshot):
+        snapshot_identifier = snapshot[KINDS[kind]['id']]
+        if snapshot_identifier not in self.snapshots[kind][region]:
+            bisect.insort(self.ordered_identifiers[kind][region], snapshot_identifier)
+        self.snapshots[kind][region][snapshot_identifier] = snapshot
+        self.by_arn[snapshot[KINDS[kind]['arn']]] = (kind, snapshot)
+
+    def remove(self, kind, region, snapshot_identifier):
+        snapshot = self.snapshots[kind][region].pop(snapshot_identifier, None)
+        if snapshot is not None:
+            ordered = self.ordered_identifiers[kind][region]
+            del ordered[bisect.bisect_left(ordered, snapshot_identifier)]
+            self.by_arn.pop(snapshot[KINDS[kind]['arn']], None)
+        return snapshot
+
+    def copies_in_progress(self, region):
+        with self.lock:
+            return sum(
+                1 for kind in KINDS for snapshot in self.snapshots[kind][region].values()
+                if snapshot['SnapshotType'] == 'manual' and snapshot['Status'] != 'available'
+            )
+
+    def copy_duration(self, snapshot):
+        return self.copy_base_seconds + self.copy_seconds_per_gb * snapshot.get('AllocatedStorage', 0)
+
+    def advance(self, seconds):
+        # moves the simulated clock and completes the copies that are done
+        with self.lock:
+            self.clock += seconds
+            for kind in KINDS:
+                for region, snapshots in self.snapshots[kind].items():
+                    for snapshot in snapshots.values():
+                        if snapshot['Status'] == 'available' or '_CopyStartedAt' not in snapshot:
+                            continue
+                        elapsed = self.clock - snapshot['_CopyStartedAt']
+                        duration = self.copy_duration(snapshot)
+                        if elapsed >= duration:
+                            snapshot['Status'] = 'available'
+                            snapshot['PercentProgress'] = 100
+                            snapshot['SnapshotCreateTime'] = snapshot.pop('_SourceCreateTime', BASE_TIME)
+                            self.completed_copies.append((region, snapshot[KINDS[kind]['id']], self.clock))
+                        else:
+                            snapshot['PercentProgress'] = int(100 * elapsed / duration)
+
+    def find_by_arn(self, arn):
+        with self.lock:
+            return self.by_arn.get(arn, (None, None))
+
+    def count_snapshots(self, region, kind='instance'):
+        with self.lock:
+            return len(self.snapshots[kind][region])
+
+
+class StubRdsClient:
+    exceptions = StubRdsExceptions
+
+    def __init__(self, aws, region):
+        self.__aws = aws
+        self.region = region
+
+    def __describe(self, kind, operation, snapshot_identifier=None, source_identifier=None,
+                   snapshot_type=None, marker=None, max_records=None):
+        keys = KINDS[kind]
+        self.__aws.record_call('rds', self.region, operation)
+        with self.__aws.lock:
+            snapshots = self.__aws.snapshots[kind][self.region]
+            if snapshot_identifier is not None:
+                snapshot = snapshots.get(snapshot_identifier)
+                if snapshot is None:
+                    raise keys['not_found'](operation, snapshot_identifier + ' not found')
+                return {keys['list']: [public(snapshot)]}
+
+            # markers are the last identifier of the previous page, so deleting
+            # snapshots between pages does not shift the next page
+            page_size = min(max_records or self.__aws.page_size, self.__aws.page_size)
+            ordered = self.__aws.ordered_identifiers[kind][self.region]
+            page = []
+            has_more = False
+            for snapshot_identifier in itertools.islice(ordered, bisect.bisect_right(ordered, marker or ''), None):
+                snapshot = snapshots[snapshot_identifier]
+                if source_identifier is not None and snapshot[keys['source']] != source_identifier:
+                    continue
+                if snapshot_type is not None and snapshot['SnapshotType'] != snapshot_type:
+                    continue
+                if len(page) == page_size:
+                    has_more = True
+                    break
+                page.append(public(snapshot))
+
+        response = {keys['list']: page}
+        if has_more:
+            response['Marker'] = page[-1][keys['id']]
+        return response
+
+    def describe_db_snapshots(self, DBSnapshotIdentifier=None, DBInstanceIdentifier=None,
+                              SnapshotType=None, Marker=None, MaxRecords=None, **kwargs):
+        return self.__describe('instance', 'DescribeDBSnapshots', DBSnapshotIdentifier,
+                               DBInstanceIdentifier, SnapshotType, Marker, MaxRecords)
+
+    def describe_db_cluster_snapshots(self, DBClusterSnapshotIdentifier=None, DBClusterIdentifier=None,
+                                      SnapshotType=None, Marker=None, MaxRecords=None, **kwargs):
+        return self.__describe('cluster', 'DescribeDBClusterSnapshots', DBClusterSnapshotIdentifier,
+                               DBClusterIdentifier, SnapshotType, Marker, MaxRecords)
+
+    def __copy(self, kind, operation, source_arn, target_identifier, tags, kms_key_id):
+        keys = KINDS[kind]
+        self.__aws.record_call('rds', self.region, operation)
+        source_kind, source = self.__aws.find_by_arn(source_arn)
+        if source is None or source_kind != kind:
+            raise keys['not_found'](operation, source_arn + ' not found')
+        with self.__aws.lock:
+            snapshots = self.__aws.snapshots[kind][self.region]
+            if target_identifier in snapshots:
+                raise keys['exists'](operation, target_identifier + ' already exists')
+            if self.__aws.copy_quota is not None and self.__aws.copies_in_progress(self.region) >= self.__aws.copy_quota:
+                raise StubRdsExceptions.SnapshotQuotaExceededFault(
+                    operation, 'too many concurrent snapshot copies in ' + self.region)
+            target = copy.deepcopy(source)
+            target.update({
+                keys['id']: target_identifier,
+                keys['arn']: 'arn:aws:rds:%s:%s:%s:%s' % (self.region, ACCOUNT_ID, keys['arn_type'], target_identifier),
+                'SnapshotType': 'manual',
+                'Status': 'creating',
+                'PercentProgress': 0,
+                'TagList': list(source.get('TagList', [])) + list(tags or [])
+            })
+            target['_SourceCreateTime'] = target.pop('SnapshotCreateTime', BASE_TIME)
+            target['_CopyStartedAt'] = self.__aws.clock
+            if kms_key_id:
+                target['KmsKeyId'] = kms_key_id
+            self.__aws.store(kind, self.region, target)
+        return {keys['list'][:-1]: public(target)}
+
+    def copy_db_snapshot(self, SourceDBSnapshotIdentifier, TargetDBSnapshotIdentifier, Tags=None,
+                         KmsKeyId=None, **kwargs):
+        return self.__copy('instance', 'CopyDBSnapshot', SourceDBSnapshotIdentifier,
+                           TargetDBSnapshotIdentifier, Tags, KmsKeyId)
+
+    def copy_db_cluster_snapshot(self, SourceDBClusterSnapshotIdentifier, TargetDBClusterSnapshotIdentifier,
+                                 Tags=None, KmsKeyId=None, **kwargs):
+        return self.__copy('cluster', 'CopyDBClusterSnapshot', SourceDBClusterSnapshotIdentifier,
+                           TargetDBClusterSnapshotIdentifier, Tags, KmsKeyId)
+
+    def __delete(self, kind, operation, snapshot_identifier):
+        keys = KINDS[kind]
+        self.__aws.record_call('rds', self.region, operation)
+        with self.__aws.lock:
+            snapshot = self.__aws.remove(kind, self.region, snapshot_identifier)
+        if snapshot is None:
+            raise keys['not_found'](operation, snapshot_identifier + ' not found')
+        return {keys['list'][:-1]: public(snapshot)}
+
+    def delete_db_snapshot(self, DBSnapshotIdentifier):
+        return self.__delete('instance', 'DeleteDBSnapshot', DBSnapshotIdentifier)
+
+    def delete_db_cluster_snapshot(self, DBClusterSnapshotIdentifier):
+        return self.__delete('cluster', 'DeleteDBClusterSnapshot', DBClusterSnapshotIdentifier)
+
+    def list_tags_for_resource(self, ResourceName, **kwargs):
+        self.__aws.record_call('rds', self.region, 'ListTagsForResource')
+        kind, snapshot = self.__aws.find_by_arn(ResourceName)
+        return {'TagList': list(snapshot.get('TagList', [])) if snapshot else []}
+
+
+class StubSnsClient:
+    def __init__(self, aws, region):
+        self.__aws = aws
+        self.region = region
+
+    def publish(self, TopicArn=None, Message=None, Subject=None, **kwargs):
+        self.__aws.record_call('sns', self.region, 'Publish')
+        with self.__aws.lock:
+            self.__aws.published.append({'TopicArn': TopicArn, 'Message': Message, 'Subject': Subject})
+        return {'MessageId': str(len(self.__aws.published))}
+
+
+def snapshot_event(snapshot, region='us-east-1', kind='instance', message=None, category='creation'):
+    keys = KINDS[kind]
+    if message is None:
+        if kind == 'instance':
+            message = 'Automated snapshot created'
+        else:
+            message = 'Automated cluster snapshot created'
+    return {
+        'version': '0',
+        'id': 'benchmark-' + snapshot[keys['id']],
+        'detail-type': 'RDS DB Snapshot Event' if kind == 'instance' else 'RDS DB Cluster Snapshot Event',
+        'source': 'aws.rds',
+        'account': ACCOUNT_ID,
+        'time': '2020-06-01T00:00:00Z',
+        'region': region,
+        'resources': [snapshot[keys['arn']]],
+        'detail': {
+            'EventCategories': [category],
+            'SourceType': 'SNAPSHOT' if kind == 'instance' else 'CLUSTER_SNAPSHOT',
+            'SourceArn': snapshot[keys['arn']],
+            'Date': '2020-06-01T00:00:00.000Z',
+            'SourceIdentifier': snapshot[keys['id']],
+            'Message': message
+        }
+    }
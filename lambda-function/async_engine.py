@@ -0,0 +1,74 @@
+import asyncio
+import concurrent.futures
+import functools
+import os
+import aws_clients
+import retention
+
+
+# asyncio engine of the copy path, selected with engine=async. the source
+# describe and the retention scans of the target regions run at once, and
+# the expired copies of every region are deleted in the same event loop.
+#
+# boto3 has no asyncio API and aiobotocore is not packaged with the function,
+# so each AWS call runs the shared boto3 client on the loop's executor
+# through run_in_executor (asyncio.to_thread needs python 3.9, and the
+# function runs on python3.8). the loop only schedules them; a semaphore of
+# async_max_concurrency bounds the calls in flight, and the executor is
+# sized to match. keep it at or below max_pool_connections.
+ASYNC_MAX_CONCURRENCY = int(os.environ.get('async_max_concurrency', '16'))
+
+
+class Engine:
+    def __init__(self, max_concurrency=None):
+        self.MAX_CONCURRENCY = max_concurrency or ASYNC_MAX_CONCURRENCY
+        self.__semaphore = asyncio.Semaphore(self.MAX_CONCURRENCY)
+
+    async def call(self, function, *args):
+        async with self.__semaphore:
+            return await asyncio.get_running_loop().run_in_executor(None, functools.partial(function, *args))
+
+    def start(self, function, *args):
+        # runs the call in the background; await the task for its result. a
+        # task nobody awaits, because its event stopped early, does not log
+        # its error
+        task = asyncio.ensure_future(self.call(function, *args))
+        task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        return task
+
+    async def delete_snapshots(self, delete_snapshot, snapshot_identifiers, max_attempts=None):
+        # retention.delete_snapshots for the event loop: one task per delete,
+        # with the same shared backoff when RDS throttles
+        max_attempts = max_attempts or retention.DELETE_MAX_ATTEMPTS
+        backoff = retention.AdaptiveBackoff()
+
+        async def delete(snapshot_identifier):
+            for attempt in range(1, max_attempts + 1):
+                await asyncio.sleep(backoff.next_delay())
+                try:
+                    await self.call(delete_snapshot, snapshot_identifier)
+                    backoff.succeeded()
+                    return snapshot_identifier, None
+                except Exception as e:
+                    if aws_clients.is_throttling(e) and attempt < max_attempts:
+                        backoff.throttled()
+                        continue
+                    return snapshot_identifier, e
+
+        deleted = []
+        failed = []
+        for snapshot_identifier, error in await asyncio.gather(
+                *(delete(snapshot_identifier) for snapshot_identifier in snapshot_identifiers)):
+            if error is None:
+                deleted.append(snapshot_identifier)
+            else:
+                failed.append((snapshot_identifier, error))
+        return deleted, failed
+
+
+def run(coroutine):
+    async def main():
+        asyncio.get_running_loop().set_default_executor(
+            concurrent.futures.ThreadPoolExecutor(max_workers=ASYNC_MAX_CONCURRENCY))
+        return await coroutine
+    return asyncio.run(main())
@@ -0,0 +1,157 @@
+import os
+import threading
+import time
+import metrics
+
+
+# process-wide registry of AWS clients, shared by every invocation of a warm
+# lambda container. clients are created lazily on first use and reuse their
+# connection pool (and TLS sessions) across events.
+MAX_POOL_CONNECTIONS = int(os.environ.get('max_pool_connections', '20'))
+
+_clients = {}
+_lock = threading.Lock()
+_client_factory = None
+
+
+def _config_key(config):
+    if not config:
+        return ()
+    return tuple(sorted((name, repr(value)) for name, value in config.items()))
+
+
+def _default_client_factory(service, region, config):
+    import boto3
+    from botocore.config import Config
+
+    options = {
+        'max_pool_connections': MAX_POOL_CONNECTIONS,
+        'tcp_keepalive': True
+    }
+    options.update(config or {})
+    return boto3.client(service, region_name=region, config=Config(**options))
+
+
+def get_client(service, region=None, config=None):
+    key = (service, region, _config_key(config))
+    client = _clients.get(key)
+    if client is not None:
+        return client
+
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            factory = _client_factory or _default_client_factory
+            if metrics.ENABLED:
+                started = time.perf_counter()
+                client = factory(service, region, config)
+                # a client made without a region takes the one of the session;
+                # metric dimensions must be strings
+                region_name = region or getattr(getattr(client, 'meta', None), 'region_name', None) or 'default'
+                client = _instrument(client, service, region_name)
+                metrics.record_client_setup(service, region_name, time.perf_counter() - started)
+            else:
+                client = factory(service, region, config)
+            _clients[key] = client
+    return client
+
+
+def _instrument(client, service, region):
+    events = getattr(getattr(client, 'meta', None), 'events', None)
+    if events is None:
+        return _InstrumentedClient(client, service, region)
+
+    # botocore client: time each call between the before-call and after-call
+    # hooks, which span every retry attempt of the call
+    operation_names = dict((api_name, method) for method, api_name in client.meta.method_to_api_mapping.items())
+
+    def before_call(context, **kwargs):
+        context['metrics_started'] = time.perf_counter()
+
+    def needs_retry(request_dict=None, response=None, **kwargs):
+        if response is not None and response[1].get('Error', {}).get('Code') in THROTTLING_ERROR_CODES:
+            context = request_dict['context']
+            context['metrics_throttles'] = context.get('metrics_throttles', 0) + 1
+
+    def after_call(model, parsed, context, **kwargs):
+        started = context.get('metrics_started')
+        if started is None:
+            return
+        metrics.record_call(
+            service, region, operation_names.get(model.name, model.name), time.perf_counter() - started,
+            parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0),
+            context.get('metrics_throttles', 0),
+            parsed.get('Error', {}).get('Code', '')
+        )
+
+    events.register('before-call', before_call)
+    events.register('needs-retry', needs_retry)
+    events.register('after-call', after_call)
+    return client
+
+
+class _InstrumentedClient:
+    # same timing for clients without botocore hooks, such as the local stubs
+    def __init__(self, client, service, region):
+        self.__client = client
+        self.__service = service
+        self.__region = region
+
+    def __getattr__(self, name):
+        attribute = getattr(self.__client, name)
+        if name.startswith('_') or not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                result = attribute(*args, **kwargs)
+            except Exception as e:
+                throttled = is_throttling(e)
+                metrics.record_call(self.__service, self.__region, name, time.perf_counter() - started,
+                                    0, 1 if throttled else 0, error_code(e))
+                raise
+            metrics.record_call(self.__service, self.__region, name, time.perf_counter() - started)
+            return result
+        return call
+
+
+def set_client_factory(factory):
+    # used by local stubs and benchmarks to replace boto3.client
+    global _client_factory
+    with _lock:
+        _client_factory = factory
+        _clients.clear()
+
+
+def clear():
+    with _lock:
+        _clients.clear()
+
+
+THROTTLING_ERROR_CODES = (
+    'Throttling',
+    'ThrottlingException',
+    'RequestLimitExceeded',
+    'TooManyRequestsException'
+)
+
+
+def error_code(e):
+    return getattr(e, 'response', {}).get('Error', {}).get('Code', '')
+
+
+def is_throttling(e):
+    return error_code(e) in THROTTLING_ERROR_CODES
+
+
+def paginate(client, operation, result_key, **params):
+    # yields every item of a Marker paginated describe call, one page at a time
+    params.setdefault('MaxRecords', 100)
+    while True:
+        res = getattr(client, operation)(**params)
+        for item in res[result_key]:
+            yield item
+        if not res.get('Marker'):
+            break
+        params['Marker'] = res['Marker']
@@ -0,0 +1,332 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import aws_clients
+import idempotency
+import selection
+import sns_client
+
+
+# admission control for cross-region copies. RDS only allows a limited number
+# of copies in progress per target region, so copy requests are written to a
+# durable pending queue and only started while the target region has free
+# slots. the queue is a DynamoDB table (copy_queue_table) or, for local runs
+# and tests, a SQLite file (copy_queue_path). the scheduler is off when
+# neither is set and copies are started right away as before.
+MAX_CONCURRENT_COPIES = int(os.environ.get('max_concurrent_copies', '20'))
+COPY_DRAIN_POLL_SECONDS = int(os.environ.get('copy_drain_poll_seconds', '30'))
+# order in which queued copies start: priority (copy_priorities, then the
+# smallest snapshot first, then arrival) or arrival
+COPY_ORDER = os.environ.get('copy_order', 'priority')
+
+COPY_QUOTA_ERROR_CODES = (
+    'SnapshotQuotaExceeded',
+    'SnapshotQuotaExceededFault',
+    'DBClusterSnapshotQuotaExceeded'
+) + aws_clients.THROTTLING_ERROR_CODES
+
+ALREADY_EXISTS_ERROR_CODES = (
+    'DBSnapshotAlreadyExists',
+    'DBClusterSnapshotAlreadyExistsFault'
+)
+
+IN_PROGRESS_STATUSES = ('creating', 'copying', 'pending')
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+class SqliteCopyQueue:
+    def __init__(self, path):
+        self.PATH = path
+        with self.__connect() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS pending_copies ('
+                ' region TEXT NOT NULL,'
+                ' target_snapshot_identifier TEXT NOT NULL,'
+                ' enqueued_at REAL NOT NULL,'
+                ' request TEXT NOT NULL,'
+                ' priority INTEGER NOT NULL DEFAULT 0,'
+                ' allocated_storage INTEGER NOT NULL DEFAULT 0,'
+                ' PRIMARY KEY (region, target_snapshot_identifier))'
+            )
+            columns = [row[1] for row in connection.execute('PRAGMA table_info(pending_copies)')]
+            for column in ('priority', 'allocated_storage'):
+                # queue files created before the copy order
+                if column not in columns:
+                    connection.execute('ALTER TABLE pending_copies ADD COLUMN ' + column + ' INTEGER NOT NULL DEFAULT 0')
+
+    def __connect(self):
+        return sqlite3.connect(self.PATH, timeout=30)
+
+    def push(self, request):
+        with self.__connect() as connection:
+            connection.execute(
+                'INSERT OR IGNORE INTO pending_copies'
+                ' (region, target_snapshot_identifier, enqueued_at, request, priority, allocated_storage)'
+                ' VALUES (?, ?, ?, ?, ?, ?)',
+                (request['region'], request['target_snapshot_identifier'], request['enqueued_at'], json.dumps(request),
+                 request.get('priority', 0), request.get('allocated_storage', 0))
+            )
+
+    def first(self, region, limit):
+        with self.__connect() as connection:
+            rows = connection.execute(
+                'SELECT request FROM pending_copies WHERE region = ?'
+                ' ORDER BY priority, allocated_storage, enqueued_at LIMIT ?',
+                (region, limit)
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def claim(self, request):
+        # removes the request; only the caller that removed it may start it
+        with self.__connect() as connection:
+            cursor = connection.execute(
+                'DELETE FROM pending_copies WHERE region = ? AND target_snapshot_identifier = ?',
+                (request['region'], request['target_snapshot_identifier'])
+            )
+        return cursor.rowcount == 1
+
+    def count(self, region):
+        with self.__connect() as connection:
+            return connection.execute(
+                'SELECT COUNT(*) FROM pending_copies WHERE region = ?', (region,)
+            ).fetchone()[0]
+
+
+class DynamoDbCopyQueue:
+    # table with partition key "region" (S) and sort key "queue_key" (S)
+    def __init__(self, table_name):
+        self.TABLE_NAME = table_name
+        self.__dynamodb_client = aws_clients.get_client('dynamodb')
+
+    def __queue_key(self, request):
+        # the sort key is the copy order, so a query returns the next copies
+        if 'priority' not in request:
+            # queued before the copy order
+            return '%017.6f#%s' % (request['enqueued_at'], request['target_snapshot_identifier'])
+        return '%04d#%010d#%017.6f#%s' % (
+            request['priority'], request['allocated_storage'], request['enqueued_at'],
+            request['target_snapshot_identifier'])
+
+    def push(self, request):
+        self.__dynamodb_client.put_item(
+            TableName = self.TABLE_NAME,
+            Item = {
+                'region': {'S': request['region']},
+                'queue_key': {'S': self.__queue_key(request)},
+                'request': {'S': json.dumps(request)}
+            }
+        )
+
+    def first(self, region, limit):
+        res = self.__dynamodb_client.query(
+            TableName = self.TABLE_NAME,
+            KeyConditionExpression = '#region = :region',
+            ExpressionAttributeNames = {'#region': 'region'},
+            ExpressionAttributeValues = {':region': {'S': region}},
+            ScanIndexForward = True,
+            Limit = limit
+        )
+        return [json.loads(item['request']['S']) for item in res['Items']]
+
+    def claim(self, request):
+        try:
+            self.__dynamodb_client.delete_item(
+                TableName = self.TABLE_NAME,
+                Key = {
+                    'region': {'S': request['region']},
+                    'queue_key': {'S': self.__queue_key(request)}
+                },
+                ConditionExpression = 'attribute_exists(queue_key)'
+            )
+        except Exception as e:
+            if aws_clients.error_code(e) == 'ConditionalCheckFailedException':
+                return False
+            raise
+        return True
+
+    def count(self, region):
+        res = self.__dynamodb_client.query(
+            TableName = self.TABLE_NAME,
+            KeyConditionExpression = '#region = :region',
+            ExpressionAttributeNames = {'#region': 'region'},
+            ExpressionAttributeValues = {':region': {'S': region}},
+            Select = 'COUNT'
+        )
+        return res['Count']
+
+
+class CopyScheduler:
+    def __init__(self, queue, max_concurrent_copies=None):
+        self.MAX_CONCURRENT_COPIES = max_concurrent_copies or MAX_CONCURRENT_COPIES
+        self.__queue = queue
+        self.__lock = threading.Lock()
+
+    def submit(self, kind, source_snapshot_info, src_region, region):
+        request = self.enqueue(kind, source_snapshot_info, src_region, region)
+        started, failed = self.drain(region, request['target_snapshot_identifier'])
+        for started_request in started:
+            if started_request['target_snapshot_identifier'] == request['target_snapshot_identifier']:
+                return {'target_snapshot_identifer': request['target_snapshot_identifier'], 'state': 'started'}
+        for failed_request, e in failed:
+            if failed_request['target_snapshot_identifier'] == request['target_snapshot_identifier']:
+                raise e
+        return {'target_snapshot_identifer': request['target_snapshot_identifier'], 'state': 'queued'}
+
+    def enqueue(self, kind, source_snapshot_info, src_region, region):
+        # queues the copy without draining; the caller drains the region
+        request = {
+            'kind': kind,
+            'region': region,
+            'source_region': src_region,
+            'target_snapshot_identifier': source_snapshot_info['source_snapshot_identifier'].replace(":","-") + '-autocopied',
+            'source_snapshot_info': source_snapshot_info,
+            'enqueued_at': time.time()
+        }
+        request['priority'], request['allocated_storage'] = copy_order(kind, source_snapshot_info)
+        self.__queue.push(request)
+        return request
+
+    def in_flight(self, region):
+        # copies in progress in the target region, from one paginated describe
+        # per snapshot kind; copies made outside this solution count too
+        rds_tar_client = aws_clients.get_client('rds', region)
+        count = 0
+        for operation, result_key in (('describe_db_snapshots', 'DBSnapshots'),
+                                      ('describe_db_cluster_snapshots', 'DBClusterSnapshots')):
+            for snapshot in aws_clients.paginate(rds_tar_client, operation, result_key, SnapshotType = 'manual'):
+                if snapshot.get('Status') in IN_PROGRESS_STATUSES:
+                    count += 1
+        return count
+
+    def drain(self, region, submitted=None):
+        # starts queued copies in copy order while the region has free slots;
+        # returns (started requests, [(failed request, error)]). a failed copy
+        # leaves the queue and is notified, except the submitted one, whose
+        # error submit raises to its event
+        started = []
+        failed = []
+        handlers = []
+        with self.__lock:
+            slots = self.MAX_CONCURRENT_COPIES - self.in_flight(region)
+            if slots <= 0:
+                return started, failed
+
+            for request in self.__queue.first(region, slots):
+                if not self.__queue.claim(request):
+                    continue
+                try:
+                    handler = _start_copy(request)
+                except Exception as e:
+                    code = aws_clients.error_code(e)
+                    if code in COPY_QUOTA_ERROR_CODES:
+                        # the region is full after all: put it back and wait
+                        self.__queue.push(request)
+                        break
+                    if code not in ALREADY_EXISTS_ERROR_CODES:
+                        print('ERROR: failed to start copy ' + request['target_snapshot_identifier'])
+                        print(e)
+                        failed.append((request, e))
+                    continue
+                request['started_at'] = time.time()
+                started.append(request)
+                handlers.append(handler)
+                # repeated events of a queued snapshot are only dropped once it started
+                idempotency.mark_copied(request['source_snapshot_info'], region)
+
+        if started or failed:
+            print(region + ': started ' + str(len(started)) + ' queued copies, ' + str(self.__queue.count(region)) + ' still pending')
+        for request, e in failed:
+            if request['target_snapshot_identifier'] != submitted:
+                sns_client.SnsClient().error_notification(
+                    e, region + ': queued copy of ' + request['source_snapshot_info']['source_snapshot_arn'])
+        for request, handler in zip(started, handlers):
+            # the copy has started whatever happens here, so an error is only
+            # notified and the other started copies still get their step
+            try:
+                _clean_copies(handler, request)
+            except Exception as e:
+                print('ERROR: failed to record started copy ' + request['target_snapshot_identifier'])
+                print(e)
+                sns_client.SnsClient().error_notification(
+                    e, region + ': after queued copy of ' + request['source_snapshot_info']['source_snapshot_arn'])
+        return started, failed
+
+    def drain_all(self, regions, context=None, poll_seconds=None):
+        # drain loop for the scheduled handler: keeps starting copies as slots
+        # free up until the queue is empty or the invocation runs out of time
+        poll_seconds = COPY_DRAIN_POLL_SECONDS if poll_seconds is None else poll_seconds
+        started = 0
+        failed = 0
+        while True:
+            pending = 0
+            for region in regions:
+                region_started, region_failed = self.drain(region)
+                started += len(region_started)
+                failed += len(region_failed)
+                pending += self.pending(region)
+            if not pending or context is None:
+                break
+            if context.get_remaining_time_in_millis() < (poll_seconds + 30) * 1000:
+                break
+            time.sleep(poll_seconds)
+        return {'started': started, 'failed': failed, 'pending': pending}
+
+    def pending(self, region):
+        return self.__queue.count(region)
+
+
+def copy_order(kind, source_snapshot_info):
+    # (priority, allocated storage in GiB): queued copies start in this order,
+    # so a large snapshot does not hold a copy slot ahead of small critical
+    # databases. the size comes from the source describe; unknown sizes count
+    # as 0. with copy_order=arrival every copy gets (0, 0)
+    if COPY_ORDER == 'arrival':
+        return 0, 0
+    db_identifier = source_snapshot_info.get('db_instance_identifier' if kind == 'instance' else 'db_cluster_identifier')
+    priority = min(selection.priority_of(db_identifier), 9999)
+    return priority, int(source_snapshot_info.get('allocated_storage') or 0)
+
+
+def _handler_for(request):
+    if request['kind'] == 'instance':
+        import rds_instance
+        return rds_instance.RdsInstance(request['source_region'])
+    import rds_cluster
+    return rds_cluster.RdsCluster(request['source_region'])
+
+
+def _start_copy(request):
+    handler = _handler_for(request)
+    handler.copy_snapshot_to_region(request['source_snapshot_info'], request['source_region'], request['region'])
+    return handler
+
+
+def _clean_copies(handler, request):
+    handler.after_copy_started(request['source_snapshot_info'], request['source_region'], request['region'], request['enqueued_at'])
+
+
+def get_scheduler():
+    global _scheduler
+    if _scheduler is not None:
+        return _scheduler
+
+    table_name = os.environ.get('copy_queue_table')
+    path = os.environ.get('copy_queue_path')
+    if not table_name and not path:
+        return None
+
+    with _scheduler_lock:
+        if _scheduler is None:
+            queue = DynamoDbCopyQueue(table_name) if table_name else SqliteCopyQueue(path)
+            _scheduler = CopyScheduler(queue)
+    return _scheduler
+
+
+def reset():
+    global _scheduler
+    with _scheduler_lock:
+        _scheduler = None
@@ -0,0 +1,252 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import aws_clients
+import metrics
+import sns_client
+
+
+# tracking mode: every started copy is recorded as in flight, and a scheduled
+# poll follows them until they are available. a poll makes one paginated
+# describe per target region and snapshot kind, whatever the number of copies.
+# completed copies emit duration, throughput and queue time metrics and run
+# the retention step, which is deferred until the copy is done. failed or
+# vanished copies are notified and counted in CopyFailed. records live
+# in a DynamoDB table (copy_tracker_table) or, for local runs and tests, a
+# SQLite file (copy_tracker_path); tracking is off when neither is set.
+FAILED_STATUSES = ('failed', 'incompatible-restore', 'incompatible-parameters')
+
+# clock for the recorded times; the benchmarks swap in a simulated one
+now = time.time
+
+_tracker = None
+_tracker_lock = threading.Lock()
+
+
+class SqliteCopyStore:
+    def __init__(self, path):
+        self.PATH = path
+        with self.__connect() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS in_flight_copies ('
+                ' region TEXT NOT NULL,'
+                ' target_snapshot_identifier TEXT NOT NULL,'
+                ' record TEXT NOT NULL,'
+                ' PRIMARY KEY (region, target_snapshot_identifier))'
+            )
+
+    def __connect(self):
+        return sqlite3.connect(self.PATH, timeout=30)
+
+    def put(self, record):
+        with self.__connect() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO in_flight_copies VALUES (?, ?, ?)',
+                (record['region'], record['target_snapshot_identifier'], json.dumps(record))
+            )
+
+    def all(self):
+        with self.__connect() as connection:
+            rows = connection.execute('SELECT record FROM in_flight_copies').fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def remove(self, record):
+        with self.__connect() as connection:
+            connection.execute(
+                'DELETE FROM in_flight_copies WHERE region = ? AND target_snapshot_identifier = ?',
+                (record['region'], record['target_snapshot_identifier'])
+            )
+
+
+class DynamoDbCopyStore:
+    # table with partition key "region" (S) and sort key "target_snapshot_identifier" (S)
+    def __init__(self, table_name):
+        self.TABLE_NAME = table_name
+        self.__dynamodb_client = aws_clients.get_client('dynamodb')
+
+    def put(self, record):
+        self.__dynamodb_client.put_item(
+            TableName = self.TABLE_NAME,
+            Item = {
+                'region': {'S': record['region']},
+                'target_snapshot_identifier': {'S': record['target_snapshot_identifier']},
+                'record': {'S': json.dumps(record)}
+            }
+        )
+
+    def all(self):
+        # copies in flight are bounded by the copy quota, so a scan stays small
+        records = []
+        params = {'TableName': self.TABLE_NAME}
+        while True:
+            res = self.__dynamodb_client.scan(**params)
+            records.extend(json.loads(item['record']['S']) for item in res['Items'])
+            if 'LastEvaluatedKey' not in res:
+                break
+            params['ExclusiveStartKey'] = res['LastEvaluatedKey']
+        return records
+
+    def remove(self, record):
+        self.__dynamodb_client.delete_item(
+            TableName = self.TABLE_NAME,
+            Key = {
+                'region': {'S': record['region']},
+                'target_snapshot_identifier': {'S': record['target_snapshot_identifier']}
+            }
+        )
+
+
+KINDS = {
+    'instance': ('describe_db_snapshots', 'DBSnapshots', 'DBSnapshotIdentifier'),
+    'cluster': ('describe_db_cluster_snapshots', 'DBClusterSnapshots', 'DBClusterSnapshotIdentifier')
+}
+
+
+class CopyTracker:
+    def __init__(self, store):
+        self.__store = store
+
+    def track(self, kind, source_snapshot_info, src_region, region, copy_mode=None, enqueued_at=None):
+        started_at = now()
+        self.__store.put({
+            'kind': kind,
+            'region': region,
+            'source_region': src_region,
+            'target_snapshot_identifier': source_snapshot_info['source_snapshot_identifier'].replace(":","-") + '-autocopied',
+            'source_snapshot_info': source_snapshot_info,
+            'copy_mode': copy_mode,
+            'enqueued_at': enqueued_at or started_at,
+            'started_at': started_at,
+            'percent_progress': 0
+        })
+
+    def untrack(self, region, target_snapshot_identifier):
+        # the copy was deleted on purpose, by a deletion event
+        self.__store.remove({'region': region, 'target_snapshot_identifier': target_snapshot_identifier})
+
+    def poll(self):
+        # one status cycle over every copy in flight; returns the completed ones
+        records = self.__store.all()
+        groups = {}
+        for record in records:
+            groups.setdefault((record['region'], record['kind']), []).append(record)
+
+        completed = []
+        failed = []
+        available = {}
+        for (region, kind), group in groups.items():
+            operation, result_key, id_key = KINDS[kind]
+            tracked = dict((record['target_snapshot_identifier'], record) for record in group)
+            snapshots = {}
+            for snapshot in aws_clients.paginate(
+                    aws_clients.get_client('rds', region), operation, result_key, SnapshotType = 'manual'):
+                if snapshot[id_key] in tracked:
+                    snapshots[snapshot[id_key]] = snapshot
+
+            polled_at = now()
+            for target_snapshot_identifier, record in tracked.items():
+                snapshot = snapshots.get(target_snapshot_identifier)
+                if snapshot is None or snapshot.get('Status') in FAILED_STATUSES:
+                    record['status'] = snapshot.get('Status') if snapshot else 'not-found'
+                    failed.append(record)
+                elif snapshot.get('Status') == 'available':
+                    # kept from an earlier poll whose retention failed
+                    record.setdefault('completed_at', polled_at)
+                    record['allocated_storage'] = snapshot.get('AllocatedStorage', 0)
+                    completed.append(record)
+                    available[(region, target_snapshot_identifier)] = snapshot
+                elif snapshot.get('PercentProgress', 0) != record['percent_progress']:
+                    record['percent_progress'] = snapshot.get('PercentProgress', 0)
+                    self.__store.put(record)
+
+        # each record on its own, so one failing retention does not lose the
+        # others. a record is only removed once it is handled; a completed
+        # copy whose retention failed stays for the next poll
+        for record in completed:
+            try:
+                _run_deferred_retention(record, available[(record['region'], record['target_snapshot_identifier'])])
+                _emit_copy_metrics(record)
+                self.__store.remove(record)
+            except Exception as e:
+                print('ERROR: retention after copy ' + record['target_snapshot_identifier'] + ' in ' + record['region'] + ' failed')
+                sns_client.SnsClient().error_notification(e, record['region'] + ': retention after copy ' + record['target_snapshot_identifier'])
+                self.__store.put(record)
+        for record in failed:
+            try:
+                print('ERROR: copy ' + record['target_snapshot_identifier'] + ' in ' + record['region'] + ' ended as ' + record['status'])
+                metrics.put('CopyFailed', 1, 'Count', Region = record['region'])
+                sns_client.SnsClient().error_notification(
+                    'copy ' + record['target_snapshot_identifier'] + ' ended as ' + record['status'],
+                    record['region'] + ': copy of ' + record['source_snapshot_info']['source_snapshot_arn']
+                )
+                self.__store.remove(record)
+            except Exception as e:
+                sns_client.SnsClient().error_notification(e, record['region'] + ': failed copy ' + record['target_snapshot_identifier'])
+
+        in_flight = len(records) - len(completed) - len(failed)
+        print('tracked copies: ' + str(len(completed)) + ' completed, ' + str(len(failed)) + ' failed, ' + str(in_flight) + ' in flight')
+        return completed, failed
+
+
+def _emit_copy_metrics(record):
+    duration = max(record['completed_at'] - record['started_at'], 1.0)
+    queue_seconds = record['started_at'] - record['enqueued_at']
+    throughput = record['allocated_storage'] / (duration / 60.0)
+    metrics.put('CopyDuration', duration, 'Seconds', Region = record['region'])
+    metrics.put('CopyQueueTime', queue_seconds, 'Seconds', Region = record['region'])
+    metrics.put('CopyThroughputGbPerMinute', throughput, 'None', Region = record['region'])
+    source_snapshot_info = record['source_snapshot_info']
+    print(json.dumps({
+        'copy_completed': record['target_snapshot_identifier'],
+        'region': record['region'],
+        'db_identifier': source_snapshot_info.get('db_instance_identifier') or source_snapshot_info.get('db_cluster_identifier'),
+        'copy_mode': record.get('copy_mode'),
+        'duration_seconds': round(duration, 1),
+        'queue_seconds': round(queue_seconds, 1),
+        'allocated_storage_gb': record['allocated_storage'],
+        'throughput_gb_per_minute': round(throughput, 3)
+    }))
+
+
+def _handler_for(record):
+    if record['kind'] == 'instance':
+        import rds_instance
+        return rds_instance.RdsInstance(record['source_region'])
+    import rds_cluster
+    return rds_cluster.RdsCluster(record['source_region'])
+
+
+def _run_deferred_retention(record, snapshot):
+    source_snapshot_info = record['source_snapshot_info']
+    if source_snapshot_info['source_snapshot_type'] != 'Automated':
+        return
+    handler = _handler_for(record)
+    db_identifier = source_snapshot_info.get('db_instance_identifier') or source_snapshot_info.get('db_cluster_identifier')
+    handler.index_copy(db_identifier, record['region'], snapshot)
+    # the new copy is available now, so it counts as one of the kept copies
+    handler.clean_copies_of_automated_snapshot(db_identifier, record['region'], int(handler.AUTOMATED_SNAPSHOT_MAXIMUM_COPIES))
+
+
+def get_tracker():
+    global _tracker
+    if _tracker is not None:
+        return _tracker
+
+    table_name = os.environ.get('copy_tracker_table')
+    path = os.environ.get('copy_tracker_path')
+    if not table_name and not path:
+        return None
+
+    with _tracker_lock:
+        if _tracker is None:
+            store = DynamoDbCopyStore(table_name) if table_name else SqliteCopyStore(path)
+            _tracker = CopyTracker(store)
+    return _tracker
+
+
+def reset():
+    global _tracker
+    with _tracker_lock:
+        _tracker = None
@@ -0,0 +1,170 @@
+import collections
+import os
+import sqlite3
+import threading
+import time
+import aws_clients
+import selection
+
+
+# drops repeated snapshot events. EventBridge delivers at least once, and RDS
+# sends both a creation and a backup event for the same snapshot, so a copy
+# to a target region is recorded under source snapshot arn + target region
+# once it is started. a manual snapshot can be deleted and re-created under
+# the same name, so its key also holds the snapshot create time and it is
+# only checked after the source describe. repeats are answered from an
+# in-process LRU and, when idempotency_table (DynamoDB) or idempotency_path
+# (SQLite) is set, from a durable store shared by every container.
+# idempotency_ttl_seconds=0 turns it off.
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get('idempotency_ttl_seconds', '86400'))
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get('idempotency_cache_size', '4096'))
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+class SqliteIdempotencyStore:
+    def __init__(self, path):
+        self.PATH = path
+        with self.__connect() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS copied_snapshots ('
+                ' idempotency_key TEXT PRIMARY KEY,'
+                ' expires_at REAL NOT NULL)'
+            )
+
+    def __connect(self):
+        return sqlite3.connect(self.PATH, timeout=30)
+
+    def get(self, key):
+        # expiry time of the key, or None
+        with self.__connect() as connection:
+            row = connection.execute(
+                'SELECT expires_at FROM copied_snapshots WHERE idempotency_key = ?', (key,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def put(self, key, expires_at):
+        with self.__connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO copied_snapshots VALUES (?, ?)', (key, expires_at))
+
+
+class DynamoDbIdempotencyStore:
+    # table with partition key "idempotency_key" (S); enable DynamoDB TTL on
+    # the "expires_at" attribute to have old keys removed
+    def __init__(self, table_name):
+        self.TABLE_NAME = table_name
+        self.__dynamodb_client = aws_clients.get_client('dynamodb')
+
+    def get(self, key):
+        res = self.__dynamodb_client.get_item(
+            TableName = self.TABLE_NAME,
+            Key = {'idempotency_key': {'S': key}},
+            ConsistentRead = True
+        )
+        item = res.get('Item')
+        return float(item['expires_at']['N']) if item else None
+
+    def put(self, key, expires_at):
+        self.__dynamodb_client.put_item(
+            TableName = self.TABLE_NAME,
+            Item = {
+                'idempotency_key': {'S': key},
+                'expires_at': {'N': str(int(expires_at))}
+            }
+        )
+
+
+class IdempotencyCache:
+    def __init__(self, store=None, ttl_seconds=None, size=None):
+        self.TTL_SECONDS = IDEMPOTENCY_TTL_SECONDS if ttl_seconds is None else ttl_seconds
+        self.SIZE = size or IDEMPOTENCY_CACHE_SIZE
+        self.__store = store
+        self.__entries = collections.OrderedDict()
+        self.__lock = threading.Lock()
+
+    def seen(self, key):
+        now = time.time()
+        with self.__lock:
+            expires_at = self.__entries.get(key)
+            if expires_at is not None:
+                if expires_at > now:
+                    self.__entries.move_to_end(key)
+                    return True
+                del self.__entries[key]
+
+        if self.__store is None:
+            return False
+        # DynamoDB removes expired items late, so the expiry is checked here
+        expires_at = self.__store.get(key)
+        if expires_at is None or expires_at <= now:
+            return False
+        self.__remember(key, expires_at)
+        return True
+
+    def mark(self, key):
+        expires_at = time.time() + self.TTL_SECONDS
+        self.__remember(key, expires_at)
+        if self.__store is not None:
+            self.__store.put(key, expires_at)
+
+    def __remember(self, key, expires_at):
+        with self.__lock:
+            self.__entries[key] = expires_at
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.SIZE:
+                self.__entries.popitem(last=False)
+
+
+def copy_key(source_snapshot_arn, region, snapshot_create_time=None):
+    # automated snapshot names hold their create time and are never reused;
+    # None when the key of a manual snapshot needs its create time
+    if selection.db_identifier_of_snapshot(source_snapshot_arn.split(':', 6)[-1]) is not None:
+        return source_snapshot_arn + '|' + region
+    if not snapshot_create_time:
+        return None
+    return source_snapshot_arn + '|' + snapshot_create_time + '|' + region
+
+
+def regions_to_copy(source_snapshot_arn, regions, snapshot_create_time=None):
+    # the target regions this snapshot was not copied to yet
+    cache = get_cache()
+    if cache is None or not source_snapshot_arn:
+        return list(regions)
+    keys = [(region, copy_key(source_snapshot_arn, region, snapshot_create_time)) for region in regions]
+    return [region for region, key in keys if key is None or not cache.seen(key)]
+
+
+def mark_copied(source_snapshot_info, region):
+    cache = get_cache()
+    if cache is None:
+        return
+    key = copy_key(source_snapshot_info['source_snapshot_arn'], region, source_snapshot_info.get('source_snapshot_create_time'))
+    if key is not None:
+        cache.mark(key)
+
+
+def get_cache():
+    global _cache
+    if _cache is not None:
+        return _cache
+    if IDEMPOTENCY_TTL_SECONDS <= 0:
+        return None
+
+    with _cache_lock:
+        if _cache is None:
+            table_name = os.environ.get('idempotency_table')
+            path = os.environ.get('idempotency_path')
+            store = None
+            if table_name:
+                store = DynamoDbIdempotencyStore(table_name)
+            elif path:
+                store = SqliteIdempotencyStore(path)
+            _cache = IdempotencyCache(store)
+    return _cache
+
+
+def reset():
+    global _cache
+    with _cache_lock:
+        _cache = None
@@ -1,39 +1,303 @@
 import json
 import os
-import rds_instance
-import rds_cluster
+import metrics
+import selection
+import sns_client
 
 
+# cold start: only json, os, metrics, selection and sns_client are loaded
+# with the module. the RDS modules, and boto3 with them, are imported on
+# first use, after the raw event has passed _skip_reason, so ignored events
+# never pay for them.
+BATCH_MAX_WORKERS = int(os.environ.get('batch_max_workers', '10'))
+# copy path engine: sync (default) or async, see async_engine
+ENGINE = os.environ.get('engine', 'sync')
+
+SNAPSHOT_DETAIL_TYPES = {
+    'RDS DB Snapshot Event': 'rds_instances',
+    'RDS DB Cluster Snapshot Event': 'rds_clusters'
+}
+
+SNAPSHOT_KINDS = {
+    'RDS DB Snapshot Event': 'instance',
+    'RDS DB Cluster Snapshot Event': 'cluster'
+}
+
+SNAPSHOT_ARN_KINDS = {
+    'snapshot': 'instance',
+    'cluster-snapshot': 'cluster'
+}
+
+SNAPSHOT_KIND_CACHE_SIZE = 4096
+_snapshot_kinds = {}
+
+IN_PROGRESS_MESSAGES = (
+    'Creating automated snapshot',
+    'Creating manual snapshot',
+    'Creating automated cluster snapshot',
+    'Creating manual cluster snapshot'
+)
+
+
+@metrics.instrumented('lambda_handler')
+@sns_client.digested('lambda_handler')
 def lambda_handler(event, context):
     print(event)
     # TODO implement
+    process_event(event)
+
+    return {
+        'statusCode': 200,
+        'body': json.dumps('SUCESSED: Completed copied RDS snapshot to destination region')
+    }
+
+
+@metrics.instrumented('lambda_batch_handler')
+@sns_client.digested('lambda_batch_handler')
+def lambda_batch_handler(event, context):
+    # SQS event source with ReportBatchItemFailures: each record body is an
+    # RDS snapshot event, and only the failed records are retried
+    import concurrent.futures
+    records = event.get('Records', [])
+    batch_item_failures = []
+    if not records:
+        return {'batchItemFailures': batch_item_failures}
+
+    max_workers = min(BATCH_MAX_WORKERS, len(records))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(_process_record, record): record for record in records}
+        for future in concurrent.futures.as_completed(futures):
+            if not future.result():
+                batch_item_failures.append({'itemIdentifier': futures[future]['messageId']})
+
+    print('processed ' + str(len(records)) + ' records, ' + str(len(batch_item_failures)) + ' failed')
+    return {'batchItemFailures': batch_item_failures}
+
+
+@metrics.instrumented('reconcile_handler')
+@sns_client.digested('reconcile_handler')
+def reconcile_handler(event, context):
+    # scheduled event: copy every snapshot that is missing in the target regions
+    import reconcile
+    reconciler = reconcile.Reconciler(event.get('region') or os.environ['AWS_REGION'])
+    return reconciler.reconcile()
+
+
+@metrics.instrumented('drain_handler')
+@sns_client.digested('drain_handler')
+def drain_handler(event, context):
+    # scheduled event: start queued copies as copy slots free up
+    import copy_scheduler
+    import target_regions
+    scheduler = copy_scheduler.get_scheduler()
+    if scheduler is None:
+        print('copy scheduler is not configured')
+        return {'started': 0, 'failed': 0, 'pending': 0}
+    result = scheduler.drain_all(target_regions.names(), context)
+    print(result)
+    return result
+
+
+@metrics.instrumented('track_handler')
+@sns_client.digested('track_handler')
+def track_handler(event, context):
+    # scheduled event: poll copies in flight, report the finished ones and run
+    # their deferred retention
+    import copy_scheduler
+    import copy_tracker
+    tracker = copy_tracker.get_tracker()
+    if tracker is None:
+        print('copy tracker is not configured')
+        return {'completed': 0, 'failed': 0}
+    completed, failed = tracker.poll()
+    scheduler = copy_scheduler.get_scheduler()
+    if scheduler is not None and completed:
+        # finished copies free their slots for queued ones
+        for region in set(record['region'] for record in completed):
+            scheduler.drain(region)
+    return {'completed': len(completed), 'failed': len(failed)}
+
+
+@metrics.instrumented('verify_index_handler')
+@sns_client.digested('verify_index_handler')
+def verify_index_handler(event, context):
+    # scheduled event: rescan the target regions and rebuild the snapshot index
+    import snapshot_index
+    import target_regions
+    if snapshot_index.get_index() is None:
+        print('snapshot index is not configured')
+        return {}
+    src_region = event.get('region') or os.environ['AWS_REGION']
+    handlers = []
+    if selection.index_for('rds_instances'):
+        import rds_instance
+        handlers.append(('instance', rds_instance.RdsInstance(src_region)))
+    if selection.index_for('rds_clusters'):
+        import rds_cluster
+        handlers.append(('cluster', rds_cluster.RdsCluster(src_region)))
+    result = {}
+    for kind, handler in handlers:
+        for region in target_regions.names():
+            copies_by_db = handler.verify_snapshot_index(region)
+            result[region + '/' + kind] = sum(len(copies) for copies in copies_by_db.values())
+            print(region + ': indexed ' + str(result[region + '/' + kind]) + ' ' + kind + ' copies of ' + str(len(copies_by_db)) + ' databases')
+    return result
+
+
+@metrics.instrumented('retention_sweep_handler')
+@sns_client.digested('retention_sweep_handler')
+def retention_sweep_handler(event, context):
+    # scheduled event: apply the retention policy to the copies of every
+    # database in every target region, whether or not it still backs up
+    import time
+    import rds_cluster
+    import rds_instance
+    import target_regions
+    started = time.time()
+    src_region = event.get('region') or os.environ['AWS_REGION']
+    regions = target_regions.names()
+    result = {'databases': 0, 'copies': 0, 'deleted': 0, 'failed': 0}
+    for handler in (rds_instance.RdsInstance(src_region), rds_cluster.RdsCluster(src_region)):
+        results = target_regions.run_in_parallel(handler.sweep_expired_copies, regions)
+        for region in regions:
+            swept, e = results[region]
+            if e is not None:
+                print(region + ': ERROR: retention sweep failed: ' + str(e))
+                result['failed'] += 1
+                continue
+            result['databases'] += swept['databases']
+            result['copies'] += swept['copies']
+            result['deleted'] += len(swept['deleted'])
+            result['failed'] += len(swept['failed'])
+    result['elapsed'] = round(time.time() - started, 3)
+    print(result)
+    return result
+
+
+def _process_record(record):
+    try:
+        process_event(json.loads(record['body']))
+    except SystemExit as e:
+        # the copy and delete paths still stop with sys.exit
+        return e.code in (None, 0)
+    except Exception as e:
+        print("ERROR: failed to process record " + record['messageId'])
+        print(e)
+        return False
+    return True
+
+
+def _snapshot_kind(event):
+    # instance or cluster, from the detail type or else the ARN resource type
+    kind = SNAPSHOT_KINDS.get(event.get('detail-type'))
+    if kind is not None:
+        return kind
+    detail = event.get('detail') or {}
+    arn = (detail.get('SourceArn') or '').split(':', 6)
+    if len(arn) == 7 and arn[5] in SNAPSHOT_ARN_KINDS:
+        return SNAPSHOT_ARN_KINDS[arn[5]]
+    return _look_up_snapshot_kind(detail.get('SourceIdentifier') or '')
+
+
+def _look_up_snapshot_kind(snapshot_identifier):
+    # neither tells: describe the copy in the first target region, as a
+    # cluster copy and then as an instance copy. a database keeps its kind,
+    # so the kind of a copy that was found is cached per database
+    key = selection.db_identifier_of_snapshot(snapshot_identifier) or snapshot_identifier
+    if key in _snapshot_kinds:
+        return _snapshot_kinds[key]
+
+    import aws_clients
+    import target_regions
+    rds_tar_client = aws_clients.get_client('rds', target_regions.names()[0])
+    target_snapshot_identifier = snapshot_identifier.replace(":","-") + '-autocopied'
+    try:
+        rds_tar_client.describe_db_cluster_snapshots(
+            DBClusterSnapshotIdentifier = target_snapshot_identifier
+        )
+        kind = 'cluster'
+    except Exception as e:
+        if aws_clients.error_code(e) != 'DBClusterSnapshotNotFoundFault':
+            raise
+        try:
+            rds_tar_client.describe_db_snapshots(
+                DBSnapshotIdentifier = target_snapshot_identifier
+            )
+            kind = 'instance'
+        except Exception as e:
+            if aws_clients.error_code(e) != 'DBSnapshotNotFound':
+                raise
+            # no copy of either kind, e.g. retention deleted it already: there
+            # is nothing to delete, and nothing is learned about the database
+            return 'instance'
+    if len(_snapshot_kinds) >= SNAPSHOT_KIND_CACHE_SIZE:
+        _snapshot_kinds.clear()
+    _snapshot_kinds[key] = kind
+    return kind
+
+
+def _skip_reason(event):
+    # decided from the raw event dict alone, before any RDS module or client
+    # is loaded; returns None for the events that need work
+    detail = event.get('detail') or {}
+    event_categories = detail.get('EventCategories') or [None]
+    event_category = event_categories[0]
+    if event_category == 'deletion':
+        return None
+    if event_category not in ('creation', 'backup'):
+        return 'event category ' + str(event_category) + ' is not handled'
+
+    databases_variable = SNAPSHOT_DETAIL_TYPES.get(event.get('detail-type'))
+    if databases_variable is None:
+        return 'detail type ' + str(event.get('detail-type')) + ' is not handled'
+    if detail.get('Message') in IN_PROGRESS_MESSAGES:
+        return 'snapshot is not in available state'
+    index = selection.index_for(databases_variable)
+    if not index:
+        return databases_variable + ' is empty'
+    db_identifier = selection.db_identifier_of_event(event)
+    if db_identifier is not None and not index.matches(db_identifier):
+        return db_identifier + ' is not in ' + databases_variable
+    return None
+
+
+def process_event(event):
+    skip_reason = _skip_reason(event)
+    if skip_reason is not None:
+        print('skip event: ' + skip_reason)
+        return
+
     event_category = event['detail']['EventCategories'][0]
     event_detail_type = event['detail-type']
-    
+
     # rdsi = rds_instance.RdsInstance(event['region'])
     # rdsi.test_function('iot-data')
     # return(0)
 
     # event handler
-    if event_category == 'creation':
-        if event_detail_type == 'RDS DB Snapshot Event':
-            rdsi = rds_instance.RdsInstance(event['region'])
-            rdsi.copy_instance_snapshot(event)
-        elif event_detail_type == 'RDS DB Cluster Snapshot Event':
-            rdsi = rds_cluster.RdsCluster(event['region'])
-            rdsi.copy_cluster_snapshot(event)
-    elif event_category == 'backup':
+    if event_category == 'creation' or event_category == 'backup':
         if event_detail_type == 'RDS DB Snapshot Event':
+            import rds_instance
             rdsi = rds_instance.RdsInstance(event['region'])
-            rdsi.copy_instance_snapshot(event)
+            if ENGINE == 'async':
+                import async_engine
+                async_engine.run(rdsi.copy_instance_snapshot_async(event))
+            else:
+                rdsi.copy_instance_snapshot(event)
         elif event_detail_type == 'RDS DB Cluster Snapshot Event':
+            import rds_cluster
             rdsi = rds_cluster.RdsCluster(event['region'])
-            rdsi.copy_cluster_snapshot(event)
+            if ENGINE == 'async':
+                import async_engine
+                async_engine.run(rdsi.copy_cluster_snapshot_async(event))
+            else:
+                rdsi.copy_cluster_snapshot(event)
     elif event_category == 'deletion':
-        rdsi = rds_instance.RdsInstance(event['region'])
-        rdsi.delete_instance_snapshot(event)
-    
-    return {
-        'statusCode': 200,
-        'body': json.dumps('SUCESSED: Completed copied RDS snapshot to destination region')
-    }
+        if _snapshot_kind(event) == 'cluster':
+            import rds_cluster
+            rdsi = rds_cluster.RdsCluster(event['region'])
+            rdsi.delete_cluster_snapshot(event)
+        else:
+            import rds_instance
+            rdsi = rds_instance.RdsInstance(event['region'])
+            rdsi.delete_instance_snapshot(event)
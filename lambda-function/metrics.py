@@ -0,0 +1,136 @@
+import functools
+import json
+import os
+import threading
+import time
+
+
+# per invocation metrics in CloudWatch Embedded Metric Format. when enabled,
+# every AWS client records the latency, retries, throttles and errors of its
+# calls (see aws_clients), and each handler prints the EMF documents once at
+# the end of the invocation. when disabled, handlers and clients are left
+# untouched, so the hot path pays nothing.
+ENABLED = os.environ.get('emit_metrics', 'no') == 'yes'
+NAMESPACE = os.environ.get('metrics_namespace', 'RdsSnapshotCopy')
+
+# EMF accepts at most 100 values per metric in one document
+MAX_VALUES = 100
+
+_lock = threading.Lock()
+_calls = {}
+_client_setup = []
+_values = {}
+
+
+def record_call(service, region, operation, seconds, retries=0, throttles=0, error_code=''):
+    with _lock:
+        call = _calls.get((service, region, operation))
+        if call is None:
+            call = _calls[(service, region, operation)] = {'latency': [], 'retries': 0, 'throttles': 0, 'errors': 0}
+        call['latency'].append(seconds * 1000)
+        call['retries'] += retries
+        call['throttles'] += throttles
+        if error_code:
+            call['errors'] += 1
+
+
+def record_client_setup(service, region, seconds):
+    with _lock:
+        _client_setup.append(seconds * 1000)
+
+
+def put(name, value, unit='Count', **dimensions):
+    # application metric, such as a copy duration, emitted with the next flush
+    if not ENABLED:
+        return
+    key = tuple(sorted(dimensions.items()))
+    with _lock:
+        _values.setdefault(key, {}).setdefault((name, unit), []).append(value)
+
+
+def _document(dimensions, metrics, properties=None):
+    document = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': NAMESPACE,
+                'Dimensions': [sorted(dimensions)],
+                'Metrics': [{'Name': name, 'Unit': unit} for name, unit, value in metrics]
+            }]
+        }
+    }
+    document.update(dimensions)
+    document.update(properties or {})
+    for name, unit, value in metrics:
+        document[name] = value
+    return document
+
+
+def _chunks(values):
+    return [values[i:i + MAX_VALUES] for i in range(0, len(values), MAX_VALUES)] or [[]]
+
+
+def flush(handler, seconds):
+    # prints the documents of this invocation and starts over; returns them
+    global _calls, _client_setup, _values
+    with _lock:
+        calls, client_setup, values = _calls, _client_setup, _values
+        _calls, _client_setup, _values = {}, [], {}
+
+    documents = []
+    aws_time_by_operation = {}
+    for (service, region, operation), call in sorted(calls.items()):
+        dimensions = {'Service': service, 'Region': region, 'Operation': operation}
+        for i, latency in enumerate(_chunks(call['latency'])):
+            metrics = [('Latency', 'Milliseconds', latency)]
+            if i == 0:
+                metrics += [
+                    ('Calls', 'Count', len(call['latency'])),
+                    ('Retries', 'Count', call['retries']),
+                    ('Throttles', 'Count', call['throttles']),
+                    ('Errors', 'Count', call['errors'])
+                ]
+            documents.append(_document(dimensions, metrics))
+        aws_time_by_operation[operation] = aws_time_by_operation.get(operation, 0.0) + sum(call['latency'])
+
+    for key, metrics in sorted(values.items()):
+        for (name, unit), metric_values in sorted(metrics.items()):
+            for chunk in _chunks(metric_values):
+                documents.append(_document(dict(key), [(name, unit, chunk)]))
+
+    # handler breakdown: wall time, and the time summed over AWS calls and
+    # client setup; calls made by worker threads overlap, so the sums can
+    # exceed the duration
+    documents.append(_document({'Handler': handler}, [
+        ('Duration', 'Milliseconds', seconds * 1000),
+        ('AwsCallTime', 'Milliseconds', sum(aws_time_by_operation.values())),
+        ('ClientSetupTime', 'Milliseconds', sum(client_setup)),
+        ('ApiCalls', 'Count', sum(len(call['latency']) for call in calls.values())),
+        ('Retries', 'Count', sum(call['retries'] for call in calls.values())),
+        ('Throttles', 'Count', sum(call['throttles'] for call in calls.values())),
+        ('Errors', 'Count', sum(call['errors'] for call in calls.values()))
+    ], {
+        'AwsCallTimeByOperation': dict((operation, round(ms, 3)) for operation, ms in aws_time_by_operation.items()),
+        'ClientsCreated': len(client_setup)
+    }))
+
+    for document in documents:
+        print(json.dumps(document))
+    return documents
+
+
+def instrumented(handler):
+    # handler decorator; returns the function itself when metrics are off
+    def decorator(function):
+        if not ENABLED:
+            return function
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                flush(handler, time.perf_counter() - started)
+        return wrapper
+    return decorator
@@ -1,33 +1,51 @@
 import json
-import boto3
 import os
 import sys
+import aws_clients
+import copy_scheduler
+import copy_tracker
+import idempotency
+import retention
+import selection
+import snapshot_index
 import sns_client
+import target_regions
 
 
 class RdsCluster:
     def __init__(self, src_region):
         self.AUTOMATED_DELETE_MANUAL_SNAPSHOT = os.environ['automated_delete_manual_snapshot']
         self.AUTOMATED_SNAPSHOT_MAXIMUM_COPIES = os.environ['automated_snapshot_maximum_copies']
-        self.DEST_REGION = os.environ['dest_region']
-        self.RDS_CLUSTERS = os.environ['rds_clusters'].split(',')
-        self.KMS_KEY_ID = os.environ['kms_key_id']
+        self.DEST_REGIONS = target_regions.names()
+        self.RDS_CLUSTERS = selection.index_for('rds_clusters')
+        self.KMS_KEY_IDS = target_regions.kms_key_ids(self.DEST_REGIONS)
 
         self.__sns_client = sns_client.SnsClient()
         
         try:
-            self.__rds_src_client = boto3.client('rds', region_name=src_region)
-            self.__rds_tar_client = boto3.client('rds', self.DEST_REGION)
+            self.__rds_src_client = aws_clients.get_client('rds', src_region)
+            self.__rds_tar_clients = dict(
+                (region, aws_clients.get_client('rds', region)) for region in self.DEST_REGIONS
+            )
         except Exception as e:
             print("ERROR: failed to connect to RDS")
             # print(e)
-            self.__sns_client.error_notification(e)
+            self.__sns_client.error_notification(e, 'RDS clients')
             sys.exit(1)
             
-    def test_function(self, db_cluster_identifier):
-        self.__clean_copies_of_automated_snapshot(db_cluster_identifier)
+    def test_function(self, db_cluster_identifier, region=None):
+        return self.clean_copies_of_automated_snapshot(db_cluster_identifier, region or self.DEST_REGIONS[0])
             
     def copy_cluster_snapshot(self, event):
+        # target regions that already got this automated snapshot are skipped before any AWS call
+        regions = idempotency.regions_to_copy(event['detail'].get('SourceArn'), self.DEST_REGIONS)
+        if not regions:
+            print('skip duplicate event: ' + event['detail']['SourceArn'] + ' is already copied')
+            return{
+                'statusCode': 200,
+                'body': json.dumps('snapshot is already copied')
+            }
+        
         source_snapshot_info = self.__get_source_snapshot_info(event)
         
         if source_snapshot_info['message'] == 'Creating automated cluster snapshot' or source_snapshot_info['message'] == 'Creating manual cluster snapshot':
@@ -35,61 +53,340 @@ class RdsCluster:
             sys.exit(0)
         
         # break if source cluster is not in RDS_CLUSTERS list
-        if source_snapshot_info['db_cluster_identifier'] not in self.RDS_CLUSTERS:
+        if not self.RDS_CLUSTERS.matches(source_snapshot_info['db_cluster_identifier']):
             print('cluster ' + source_snapshot_info['db_cluster_identifier'] + ' is not in RDS_CLUSTERS list')
             return{
                 'statusCode': 200,
                 'body': json.dumps('instance is not in RDS_CLUSTERS list')
             }
         
-        # else, copy snapshot to target region
-        target_snapshot_identifer = source_snapshot_info['source_snapshot_identifier'].replace(":","-") + '-autocopied'
-        try:
-            if source_snapshot_info['is_encrypted']:
-                self.__rds_tar_client.copy_db_snapshot(
-                    SourceDBSnapshotIdentifier = source_snapshot_info['source_snapshot_arn'],
-                    TargetDBSnapshotIdentifier = target_snapshot_identifer,
-                    Tags = [
-                        {
-                            'Key': 'Source-Snapshot',
-                            'Value': source_snapshot_info['source_snapshot_arn']
-                        },
-                        {
-                            'Key': 'Source-Snapshot-Type',
-                            'Value': source_snapshot_info['source_snapshot_type']
-                        }
-                    ],
-                    CopyTags = True,
-                    SourceRegion = event['region'],
-                    KmsKeyId = self.KMS_KEY_ID
-                )
+        if source_snapshot_info['source_snapshot_type'] == 'Manual':
+            # a manual snapshot can be deleted and re-created under the same
+            # arn, so it is only checked once its create time is known
+            regions = idempotency.regions_to_copy(
+                source_snapshot_info['source_snapshot_arn'], regions, source_snapshot_info['source_snapshot_create_time']
+            )
+            if not regions:
+                print('skip duplicate event: ' + source_snapshot_info['source_snapshot_arn'] + ' is already copied')
+                return{
+                    'statusCode': 200,
+                    'body': json.dumps('snapshot is already copied')
+                }
+        
+        # else, copy snapshot to every target region, from the single source lookup above
+        results = target_regions.run_in_parallel(
+            lambda region: self.__copy_to_region(source_snapshot_info, event['region'], region),
+            regions
+        )
+        
+        return self.__report_copies(source_snapshot_info, regions, results)
+    
+    async def copy_cluster_snapshot_async(self, event):
+        # engine=async: the steps of copy_cluster_snapshot in one event loop. an
+        # automated snapshot names its database, so the retention scans of the
+        # target regions start together with the source describe
+        regions = idempotency.regions_to_copy(event['detail'].get('SourceArn'), self.DEST_REGIONS)
+        if not regions:
+            print('skip duplicate event: ' + event['detail']['SourceArn'] + ' is already copied')
+            return{
+                'statusCode': 200,
+                'body': json.dumps('snapshot is already copied')
+            }
+        
+        # only the async copy path loads asyncio
+        import asyncio
+        import async_engine
+        engine = async_engine.Engine()
+        db_cluster_identifier = selection.db_identifier_of_event(event)
+        scans = {}
+        if db_cluster_identifier is not None and self.__retention_at_copy_start():
+            scans = dict(
+                (region, engine.start(self.__list_automated_copies, db_cluster_identifier, region))
+                for region in regions
+            )
+        source_snapshot_info = await engine.call(self.__get_source_snapshot_info, event)
+        if source_snapshot_info['db_cluster_identifier'] != db_cluster_identifier:
+            scans = {}
+        
+        if source_snapshot_info['message'] == 'Creating automated cluster snapshot' or source_snapshot_info['message'] == 'Creating manual cluster snapshot':
+            print('snapshot is not in available state')
+            sys.exit(0)
+        
+        # break if source cluster is not in RDS_CLUSTERS list
+        if not self.RDS_CLUSTERS.matches(source_snapshot_info['db_cluster_identifier']):
+            print('cluster ' + source_snapshot_info['db_cluster_identifier'] + ' is not in RDS_CLUSTERS list')
+            return{
+                'statusCode': 200,
+                'body': json.dumps('instance is not in RDS_CLUSTERS list')
+            }
+        
+        if source_snapshot_info['source_snapshot_type'] == 'Manual':
+            # a manual snapshot can be deleted and re-created under the same
+            # arn, so it is only checked once its create time is known
+            regions = idempotency.regions_to_copy(
+                source_snapshot_info['source_snapshot_arn'], regions, source_snapshot_info['source_snapshot_create_time']
+            )
+            if not regions:
+                print('skip duplicate event: ' + source_snapshot_info['source_snapshot_arn'] + ' is already copied')
+                return{
+                    'statusCode': 200,
+                    'body': json.dumps('snapshot is already copied')
+                }
+        
+        outcomes = await asyncio.gather(
+            *(self.__copy_to_region_async(engine, source_snapshot_info, event['region'], region, scans.get(region)) for region in regions),
+            return_exceptions=True
+        )
+        results = dict(
+            (region, (None, outcome) if isinstance(outcome, Exception) else (outcome, None))
+            for region, outcome in zip(regions, outcomes)
+        )
+        return self.__report_copies(source_snapshot_info, regions, results)
+    
+    def __report_copies(self, source_snapshot_info, regions, results):
+        failed_regions = [region for region in regions if results[region][1] is not None]
+        for region in regions:
+            result, e = results[region]
+            if e is None:
+                print(region + ': ' + result['state'] + ' ' + result['target_snapshot_identifer'])
+                if result['state'] != 'queued':
+                    # a queued copy is marked by the scheduler when it starts
+                    idempotency.mark_copied(source_snapshot_info, region)
             else:
-                self.__rds_tar_client.copy_db_cluster_snapshot(
-                    SourceDBClusterSnapshotIdentifier = source_snapshot_info['source_snapshot_arn'],
-                    TargetDBClusterSnapshotIdentifier = target_snapshot_identifer,
-                    Tags = [
-                        {
-                            'Key': 'Source-Snapshot',
-                            'Value': source_snapshot_info['source_snapshot_arn']
-                        },
-                        {
-                            'Key': 'Source-Snapshot-Type',
-                            'Value': source_snapshot_info['source_snapshot_type']
-                        }
-                    ],
-                    CopyTags = True,
-                    SourceRegion = event['region']
-                )
-        except Exception as e:
-            # print("ERROR:")
-            # print(e)
-            self.__sns_client.error_notification(e)
+                print(region + ': ERROR: ' + str(e))
+        
+        if failed_regions:
+            for region in failed_regions:
+                self.__sns_client.error_notification(results[region][1], region + ': copy of ' + source_snapshot_info['source_snapshot_arn'])
             sys.exit(1)
         
-        if source_snapshot_info['source_snapshot_type'] == 'Automated':    
-            self.__clean_copies_of_automated_snapshot(source_snapshot_info['db_cluster_identifier'])
+        return dict((region, results[region][0]) for region in regions)
+    
+    def __retention_at_copy_start(self):
+        return (
+            copy_scheduler.get_scheduler() is None
+            and copy_tracker.get_tracker() is None
+            and self.AUTOMATED_SNAPSHOT_MAXIMUM_COPIES != '0'
+        )
+    
+    def __list_automated_copies(self, db_cluster_identifier, region):
+        return list(self.__automated_copies(db_cluster_identifier, region))
+    
+    async def __copy_to_region_async(self, engine, source_snapshot_info, src_region, region, listing):
+        if listing is None:
+            # scheduler, tracker or manual snapshot: the step is run as in the sync engine
+            return await engine.call(self.__copy_to_region, source_snapshot_info, src_region, region)
+        
+        try:
+            target_snapshot_identifer = await engine.call(self.copy_snapshot_to_region, source_snapshot_info, src_region, region)
+        except Exception as e:
+            if aws_clients.error_code(e) not in copy_scheduler.ALREADY_EXISTS_ERROR_CODES:
+                raise
+            # a repeated event got here first; its retention already ran
+            return {'target_snapshot_identifer': source_snapshot_info['source_snapshot_identifier'].replace(":","-") + '-autocopied', 'state': 'exists'}
+        
+        result = {'target_snapshot_identifer': target_snapshot_identifer, 'state': 'copied'}
+        await engine.call(self.record_copy_started, source_snapshot_info, region)
+        copies = await listing
+        if target_snapshot_identifer not in set(copy['target_snapshot_identifer'] for copy in copies):
+            # listed before the copy started; like the sync scan sees it, the
+            # new copy is in progress and protects its delta base
+            copies.append({
+                'target_snapshot_identifer': target_snapshot_identifer,
+                'target_snapshot_created_time': None,
+                'target_snapshot_status': 'creating'
+            })
+        
+        db_cluster_identifier = source_snapshot_info['db_cluster_identifier']
+        scan = retention.ExpiredCopies(copies, int(self.AUTOMATED_SNAPSHOT_MAXIMUM_COPIES) - 1)
+        expired_snapshots = [automated_snapshot['target_snapshot_identifer'] for automated_snapshot in scan]
+        deleted, failed = await engine.delete_snapshots(
+            lambda target_snapshot_identifier: self.__delete_expired_copy(target_snapshot_identifier, region),
+            expired_snapshots
+        )
+        await engine.call(self.__unindex, db_cluster_identifier, [region], deleted)
+        result['retention'] = self.__report_retention(db_cluster_identifier, region, scan, deleted, failed)
+        result['copy_mode'] = self.log_copy_mode(source_snapshot_info, region, result['retention'])
+        return result
+    
+    def __copy_to_region(self, source_snapshot_info, src_region, region):
+        scheduler = copy_scheduler.get_scheduler()
+        if scheduler is not None:
+            # queued until the target region has a free copy slot; retention
+            # runs when the copy is started
+            return scheduler.submit('cluster', source_snapshot_info, src_region, region)
+        
+        try:
+            target_snapshot_identifer = self.copy_snapshot_to_region(source_snapshot_info, src_region, region)
+        except Exception as e:
+            if aws_clients.error_code(e) not in copy_scheduler.ALREADY_EXISTS_ERROR_CODES:
+                raise
+            # a repeated event got here first; its retention already ran
+            return {'target_snapshot_identifer': source_snapshot_info['source_snapshot_identifier'].replace(":","-") + '-autocopied', 'state': 'exists'}
+        
+        result = {'target_snapshot_identifer': target_snapshot_identifer, 'state': 'copied'}
+        result.update(self.after_copy_started(source_snapshot_info, src_region, region))
+        return result
+    
+    def after_copy_started(self, source_snapshot_info, src_region, region, enqueued_at=None, run_retention=True):
+        # run_retention=False: the caller runs retention itself, as the reconcile
+        # sweep does once per database
+        result = {}
+        self.record_copy_started(source_snapshot_info, region)
+        tracker = copy_tracker.get_tracker()
+        if tracker is not None:
+            print("Tracking mode: retention runs when the copy is available")
+        elif not run_retention:
+            print("Retention is left to the caller")
+        elif source_snapshot_info['source_snapshot_type'] == 'Automated':
+            result['retention'] = self.clean_copies_of_automated_snapshot(source_snapshot_info['db_cluster_identifier'], region)
         else:
             print("Manual snapshot: Skip clean copies of automated snapshot")
+        result['copy_mode'] = self.log_copy_mode(source_snapshot_info, region, result.get('retention'))
+        if tracker is not None:
+            tracker.track('cluster', source_snapshot_info, src_region, region, result['copy_mode'], enqueued_at)
+        return result
+    
+    def record_copy_started(self, source_snapshot_info, region):
+        # the copy enters the snapshot index in progress; the tracker or the
+        # verification sweep marks it available
+        index = snapshot_index.get_index()
+        if index is None or source_snapshot_info['source_snapshot_type'] != 'Automated':
+            return
+        index.put(region, 'cluster', source_snapshot_info['db_cluster_identifier'], {
+            'target_snapshot_identifer': source_snapshot_info['source_snapshot_identifier'].replace(":","-") + '-autocopied',
+            'target_snapshot_created_time': None,
+            'target_snapshot_status': 'creating',
+            'target_snapshot_kms_key_id': self.__copy_kms_key_id(source_snapshot_info, region),
+            'target_snapshot_allocated_storage': source_snapshot_info.get('allocated_storage'),
+            'db_identifier': source_snapshot_info['db_cluster_identifier']
+        })
+    
+    def index_copy(self, db_cluster_identifier, region, target_snapshot):
+        # called by the copy tracker when a copy is available
+        index = snapshot_index.get_index()
+        if index is not None:
+            index.put(region, 'cluster', db_cluster_identifier, self.__copy_entry(target_snapshot))
+    
+    def verify_snapshot_index(self, region):
+        # rescans every copy in the target region and rebuilds the index from it
+        copies_by_db = {}
+        for copy in self.__iter_automated_copies_of_snapshots(None, region):
+            copies_by_db.setdefault(copy['db_identifier'], []).append(copy)
+        snapshot_index.get_index().replace_region(region, 'cluster', copies_by_db)
+        return copies_by_db
+    
+    def sweep_expired_copies(self, region):
+        # fleet-wide retention: one pass over every automated copy in the
+        # region, grouped by database, so databases that stopped taking
+        # snapshots are cleaned too. every expired copy goes through one
+        # bounded delete pool
+        if self.AUTOMATED_SNAPSHOT_MAXIMUM_COPIES == '0':
+            return {'databases': 0, 'copies': 0, 'deleted': [], 'failed': []}
+        
+        copies_by_db = {}
+        for copy in self.__iter_automated_copies_of_snapshots(None, region):
+            copies_by_db.setdefault(copy['db_identifier'], []).append(copy)
+        
+        # no copy is being started here, so the full policy is kept
+        keep = int(self.AUTOMATED_SNAPSHOT_MAXIMUM_COPIES)
+        expired = {}
+        for db_identifier, copies in copies_by_db.items():
+            for copy in retention.ExpiredCopies(copies, keep):
+                expired[copy['target_snapshot_identifer']] = db_identifier
+        deleted, failed = retention.delete_snapshots(
+            lambda target_snapshot_identifier: self.__delete_expired_copy(target_snapshot_identifier, region),
+            list(expired)
+        )
+        
+        index = snapshot_index.get_index()
+        if index is not None:
+            # the pass above listed the whole region, so it also verifies the index
+            deleted_identifiers = set(deleted)
+            index.replace_region(region, 'cluster', dict(
+                (db_identifier, [copy for copy in copies if copy['target_snapshot_identifer'] not in deleted_identifiers])
+                for db_identifier, copies in copies_by_db.items()
+            ))
+        
+        print(region + ': swept ' + str(len(copies_by_db)) + ' databases, deleted ' + str(len(deleted)) + ' expired cluster copies')
+        if failed:
+            for snapshot_identifier, e in failed:
+                self.__sns_client.error_notification(e, region + ': retention sweep delete of ' + snapshot_identifier)
+        return {
+            'databases': len(copies_by_db),
+            'copies': sum(len(copies) for copies in copies_by_db.values()),
+            'deleted': deleted,
+            'failed': [snapshot_identifier for snapshot_identifier, e in failed]
+        }
+    
+    def copy_snapshot_to_region(self, source_snapshot_info, src_region, region):
+        rds_tar_client = self.__rds_tar_clients[region]
+        target_snapshot_identifer = source_snapshot_info['source_snapshot_identifier'].replace(":","-") + '-autocopied'
+        params = {
+            'SourceDBClusterSnapshotIdentifier': source_snapshot_info['source_snapshot_arn'],
+            'TargetDBClusterSnapshotIdentifier': target_snapshot_identifer,
+            'Tags': [
+                {
+                    'Key': 'Source-Snapshot',
+                    'Value': source_snapshot_info['source_snapshot_arn']
+                },
+                {
+                    'Key': 'Source-Snapshot-Type',
+                    'Value': source_snapshot_info['source_snapshot_type']
+                }
+            ],
+            'CopyTags': True,
+            'SourceRegion': src_region
+        }
+        kms_key_id = self.__copy_kms_key_id(source_snapshot_info, region)
+        if kms_key_id:
+            params['KmsKeyId'] = kms_key_id
+        rds_tar_client.copy_db_cluster_snapshot(**params)
+        return target_snapshot_identifer
+    
+    def __copy_kms_key_id(self, source_snapshot_info, region):
+        if not source_snapshot_info['is_encrypted']:
+            return None
+        if not self.KMS_KEY_IDS[region]:
+            # without KmsKeyId, RDS would make an unencrypted copy
+            raise ValueError('kms_key_id has no key for target region ' + region)
+        return self.KMS_KEY_IDS[region]
+    
+    def log_copy_mode(self, source_snapshot_info, region, retention_result=None):
+        # RDS copies incrementally when an earlier copy of the same database is
+        # still available in the target region, encrypted with the same key.
+        # the delta base is read from the retention scan or the snapshot index;
+        # no describe is made only for this log line
+        if retention_result and 'delta_base' in retention_result:
+            delta_base = retention_result['delta_base']
+        else:
+            index = snapshot_index.get_index()
+            copies = None
+            if index is not None:
+                copies = index.copies(region, 'cluster', source_snapshot_info['db_cluster_identifier'])
+            if copies is None:
+                print(region + ': copy of ' + source_snapshot_info['source_snapshot_identifier'] + ' started (copy mode unknown, no retention scan)')
+                return None
+            delta_base = self.find_delta_base(copies)
+        kms_key_id = self.__copy_kms_key_id(source_snapshot_info, region)
+        
+        if delta_base is None:
+            copy_mode = 'full'
+            reason = 'no available copy of ' + source_snapshot_info['db_cluster_identifier']
+        elif kms_key_id and delta_base['target_snapshot_kms_key_id'] not in (None, kms_key_id):
+            copy_mode = 'full'
+            reason = 'delta base ' + delta_base['target_snapshot_identifer'] + ' uses another KMS key'
+        else:
+            copy_mode = 'incremental'
+            reason = 'delta base ' + delta_base['target_snapshot_identifer']
+        print(region + ': ' + copy_mode + ' copy of ' + source_snapshot_info['source_snapshot_identifier'] + ' (' + reason + ')')
+        return copy_mode
+    
+    def find_delta_base(self, copies):
+        scan = retention.ExpiredCopies(copies, 0)
+        for expired_snapshot in scan:
+            pass
+        return scan.delta_base
     
     def delete_cluster_snapshot(self, event):
         source_snapshot_info = self.__get_source_snapshot_info(event)
@@ -111,18 +408,37 @@ class RdsCluster:
                     'body': json.dumps('skip manual snapshot')
                 }
                 sys.exit(0)
-                
-        try:
-            self.__rds_tar_client.delete_db_cluster_snapshot(
-                DBClusterSnapshotIdentifier = target_snapshot_identifer
-            )
-        except Exception as e:
+        
+        results = target_regions.run_in_parallel(
+            lambda region: self.__delete_target_snapshot(target_snapshot_identifer, region),
+            self.DEST_REGIONS
+        )
+        
+        # a copy that is not found was never made, there is nothing to delete
+        failed_regions = [
+            region for region in self.DEST_REGIONS
+            if results[region][1] is not None
+            and not isinstance(results[region][1], self.__rds_tar_clients[region].exceptions.DBClusterSnapshotNotFoundFault)
+        ]
+        self.__unindex(
+            selection.db_identifier_of_snapshot(source_snapshot_info['source_snapshot_identifier']),
+            [region for region in self.DEST_REGIONS if region not in failed_regions],
+            [target_snapshot_identifer]
+        )
+        tracker = copy_tracker.get_tracker()
+        if tracker is not None:
+            # a copy deleted while in progress did not fail
+            for region in self.DEST_REGIONS:
+                if region not in failed_regions:
+                    tracker.untrack(region, target_snapshot_identifer)
+        
+        if failed_regions:
             # print("ERROR: failed to delete backup snapshot")
-            # print(e)
-            self.__sns_client.error_notification(e)
+            for region in failed_regions:
+                self.__sns_client.error_notification(results[region][1], region + ': delete of ' + target_snapshot_identifer)
             sys.exit(1)
             
-    def __clean_copies_of_automated_snapshot(self, db_cluster_identifier):
+    def clean_copies_of_automated_snapshot(self, db_cluster_identifier, region, keep=None):
         if self.AUTOMATED_SNAPSHOT_MAXIMUM_COPIES == '0':
             print('skip clean snapshots')
             return{
@@ -131,53 +447,124 @@ class RdsCluster:
             }
         else:
             print('cleaning rds cluster snapshots')
-            automated_snapshots = self.__get_automated_copies_of_snapshots(db_cluster_identifier)
-            for i in automated_snapshots:
-                print(i)
-            automated_snapshot_number = len(automated_snapshots)
-            if automated_snapshot_number >= int(self.AUTOMATED_SNAPSHOT_MAXIMUM_COPIES):
-                for i in range((int(self.AUTOMATED_SNAPSHOT_MAXIMUM_COPIES)-1), automated_snapshot_number):
-                    try:
-                        print(automated_snapshots[i]['target_snapshot_identifer'])
-                        self.__rds_tar_client.delete_db_cluster_snapshot(
-                            DBClusterSnapshotIdentifier = automated_snapshots[i]['target_snapshot_identifer']
-                        )
-                    except Exception as e:
-                        # print("ERROR: failed to delete backup snapshot")
-                        # print(e)
-                        self.__sns_client.error_notification(e)
-                        sys.exit(1)
-        
-    def __get_automated_copies_of_snapshots(self, db_cluster_identifier):
-        target_snapshots = []
-        # try?
-        res = self.__rds_tar_client.describe_db_cluster_snapshots(
-            DBClusterIdentifier = db_cluster_identifier
-        )['DBClusterSnapshots']
-        
-        for target_snapshot in res:
-            target_tags = self.__rds_tar_client.list_tags_for_resource(
-                ResourceName = target_snapshot['DBClusterSnapshotArn']
-            )['TagList']
+            if keep is None:
+                # the copy just started takes the last slot
+                keep = int(self.AUTOMATED_SNAPSHOT_MAXIMUM_COPIES) - 1
+            scan = retention.ExpiredCopies(self.__automated_copies(db_cluster_identifier, region), keep)
+            expired_snapshots = (automated_snapshot['target_snapshot_identifer'] for automated_snapshot in scan)
+            deleted, failed = retention.delete_snapshots(
+                lambda target_snapshot_identifier: self.__delete_expired_copy(target_snapshot_identifier, region),
+                expired_snapshots
+            )
+            self.__unindex(db_cluster_identifier, [region], deleted)
+            return self.__report_retention(db_cluster_identifier, region, scan, deleted, failed)
+    
+    def __report_retention(self, db_cluster_identifier, region, scan, deleted, failed):
+        print(region + ': deleted ' + str(len(deleted)) + ' expired copies of ' + db_cluster_identifier)
+        if failed:
+            for snapshot_identifier, e in failed:
+                self.__sns_client.error_notification(e, region + ': expired copy ' + snapshot_identifier + ' of ' + db_cluster_identifier)
+        return {
+            'deleted': deleted,
+            'failed': [snapshot_identifier for snapshot_identifier, e in failed],
+            'delta_base': scan.delta_base
+        }
+    
+    def __delete_target_snapshot(self, target_snapshot_identifier, region):
+        self.__rds_tar_clients[region].delete_db_cluster_snapshot(
+            DBClusterSnapshotIdentifier = target_snapshot_identifier
+        )
+        
+    def __delete_expired_copy(self, target_snapshot_identifier, region):
+        try:
+            self.__delete_target_snapshot(target_snapshot_identifier, region)
+        except self.__rds_tar_clients[region].exceptions.DBClusterSnapshotNotFoundFault:
+            # already deleted, by the retention of a concurrent event or by a deletion event
+            pass
+    
+    def __unindex(self, db_cluster_identifier, regions, target_snapshot_identifiers):
+        index = snapshot_index.get_index()
+        if index is None or not db_cluster_identifier or not target_snapshot_identifiers:
+            return
+        for region in regions:
+            index.remove(region, 'cluster', db_cluster_identifier, target_snapshot_identifiers)
+    
+    def __automated_copies(self, db_cluster_identifier, region):
+        index = snapshot_index.get_index()
+        if index is None:
+            return self.__iter_automated_copies_of_snapshots(db_cluster_identifier, region)
+        
+        copies = index.copies(region, 'cluster', db_cluster_identifier)
+        if copies is None:
+            # first retention of this database in the region: one scan fills the index
+            copies = list(self.__iter_automated_copies_of_snapshots(db_cluster_identifier, region))
+            index.replace(region, 'cluster', db_cluster_identifier, copies)
+            return copies
+        
+        current = []
+        for copy in copies:
+            if snapshot_index.is_stale(copy):
+                copy = self.__refresh_indexed_copy(copy, db_cluster_identifier, region)
+            if copy is not None:
+                current.append(copy)
+        return current
+    
+    def __refresh_indexed_copy(self, copy, db_cluster_identifier, region):
+        # describes a copy the index has held in progress for too long
+        index = snapshot_index.get_index()
+        try:
+            res = self.__rds_tar_clients[region].describe_db_cluster_snapshots(
+                DBClusterSnapshotIdentifier = copy['target_snapshot_identifer']
+            )
+        except self.__rds_tar_clients[region].exceptions.DBClusterSnapshotNotFoundFault:
+            index.remove(region, 'cluster', db_cluster_identifier, [copy['target_snapshot_identifer']])
+            return None
+        copy = self.__copy_entry(res['DBClusterSnapshots'][0])
+        index.put(region, 'cluster', db_cluster_identifier, copy)
+        return copy
+    
+    def __copy_entry(self, target_snapshot):
+        return {
+            'target_snapshot_identifer': target_snapshot['DBClusterSnapshotIdentifier'],
+            'target_snapshot_created_time': target_snapshot.get('SnapshotCreateTime'),
+            'target_snapshot_status': target_snapshot.get('Status', 'available'),
+            'target_snapshot_kms_key_id': target_snapshot.get('KmsKeyId'),
+            'target_snapshot_allocated_storage': target_snapshot.get('AllocatedStorage'),
+            'db_identifier': target_snapshot.get('DBClusterIdentifier')
+        }
+    
+    def __iter_automated_copies_of_snapshots(self, db_cluster_identifier, region):
+        # copies are manual snapshots in the target region, and describe
+        # responses already carry their TagList. without a database, every
+        # copy in the region is listed
+        params = {
+            'SnapshotType': 'manual',
+            'MaxRecords': 100
+        }
+        if db_cluster_identifier is not None:
+            params['DBClusterIdentifier'] = db_cluster_identifier
+        while True:
+            res = self.__rds_tar_clients[region].describe_db_cluster_snapshots(**params)
             
-            if "SnapshotCreateTime" not in target_snapshot:
-                continue
-            else:
-                for tag in target_tags:
-                    if tag['Key'] == 'Source-Snapshot-Type' and tag['Value'] == 'Automated':
-                        target_snapshots.append(
-                            {
-                                'target_snapshot_identifer': target_snapshot['DBClusterSnapshotIdentifier'],
-                                'target_snapshot_created_time': target_snapshot['SnapshotCreateTime']
-                            }
-                        )
-                        break
-                    else:
-                        continue
-                
-        target_snapshots.sort(key=lambda x: x.get('target_snapshot_created_time'), reverse=True)
+            for target_snapshot in res['DBClusterSnapshots']:
+                # copies in progress are yielded too, so retention can protect
+                # the copy they are based on
+                if self.__is_automated_copy(target_snapshot, target_snapshot['DBClusterSnapshotIdentifier']):
+                    yield self.__copy_entry(target_snapshot)
+            
+            if not res.get('Marker'):
+                break
+            params['Marker'] = res['Marker']
 
-        return target_snapshots
+    def __is_automated_copy(self, target_snapshot, target_snapshot_identifier):
+        if 'TagList' in target_snapshot:
+            for tag in target_snapshot['TagList']:
+                if tag['Key'] == 'Source-Snapshot-Type':
+                    return tag['Value'] == 'Automated'
+            return False
+        # no TagList in the response: automated source snapshots are named
+        # rds:<db>-<date>, so their copies are rds-<db>-<date>-autocopied
+        return target_snapshot_identifier.startswith('rds-') and target_snapshot_identifier.endswith('-autocopied')
     
     def __get_rds_cluster_identifier(self, source_snapshot_identifier, region):
         try:
@@ -187,14 +574,23 @@ class RdsCluster:
         
             return {
                 'db_cluster_identifier': res['DBClusterSnapshots'][0]['DBClusterIdentifier'],
+                'allocated_storage': res['DBClusterSnapshots'][0].get('AllocatedStorage'),
+                'snapshot_create_time': str(res['DBClusterSnapshots'][0].get('SnapshotCreateTime') or ''),
                 'is_encrypted': res['DBClusterSnapshots'][0]['StorageEncrypted']
             }
         except Exception as e:
-            # print('Failed to get rds cluster identifier')
-            # print(e)
-            self.__sns_client.error_notification(e)
+            if aws_clients.error_code(e) != 'DBClusterSnapshotNotFoundFault':
+                # e.g. throttled: fail the event, so batch mode retries it
+                # instead of taking the snapshot for an unprotected one
+                print('ERROR: failed to describe source snapshot ' + source_snapshot_identifier)
+                self.__sns_client.error_notification(e, region + ': describe of ' + source_snapshot_identifier)
+                sys.exit(1)
+            # deleted before its event was handled: nothing left to copy
+            print('source snapshot ' + source_snapshot_identifier + ' no longer exists')
             return {
                 'db_cluster_identifier': '',
+                'allocated_storage': None,
+                'snapshot_create_time': '',
                 'is_encrypted': ''
             }
     
@@ -208,15 +604,23 @@ class RdsCluster:
         
         db_cluster_identifier = ''
         is_encrypted = ''
+        allocated_storage = None
+        snapshot_create_time = ''
         
         if message == 'Automated cluster snapshot created':
             source_snapshot_type = 'Automated'
-            db_cluster_identifier = self.__get_rds_cluster_identifier(source_snapshot_identifier, region)
-            is_encrypted = ''
+            rds_cluster_info = self.__get_rds_cluster_identifier(source_snapshot_identifier, region)
+            db_cluster_identifier = rds_cluster_info['db_cluster_identifier']
+            is_encrypted = rds_cluster_info['is_encrypted']
+            allocated_storage = rds_cluster_info['allocated_storage']
+            snapshot_create_time = rds_cluster_info['snapshot_create_time']
         elif message == 'Manual cluster snapshot created':
             source_snapshot_type = 'Manual'
-            db_cluster_identifier = self.__get_rds_cluster_identifier(source_snapshot_identifier, region)
-            is_encrypted = ''
+            rds_cluster_info = self.__get_rds_cluster_identifier(source_snapshot_identifier, region)
+            db_cluster_identifier = rds_cluster_info['db_cluster_identifier']
+            is_encrypted = rds_cluster_info['is_encrypted']
+            allocated_storage = rds_cluster_info['allocated_storage']
+            snapshot_create_time = rds_cluster_info['snapshot_create_time']
         elif message == 'Deleted automated snapshot':
             source_snapshot_type = 'Automated'
         elif message == 'Deleted manual snapshot':
@@ -234,7 +638,9 @@ class RdsCluster:
                 'message': message,
                 'event_categories': event_categories,
                 'source_snapshot_type': source_snapshot_type,
-                'is_encrypted': is_encrypted
+                'is_encrypted': is_encrypted,
+                'allocated_storage': allocated_storage,
+                'source_snapshot_create_time': snapshot_create_time
             }
         )
     
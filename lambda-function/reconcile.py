@@ -0,0 +1,200 @@
+import concurrent.futures
+import os
+import time
+import aws_clients
+import copy_scheduler
+import copy_tracker
+import rds_cluster
+import rds_instance
+import retention
+import selection
+import sns_client
+import target_regions
+
+
+# backfill sweep: lists the source snapshots of every protected instance and
+# cluster once, lists the *-autocopied copies of every target region once,
+# and copies whatever is missing. this catches snapshots whose event was lost.
+RECONCILE_MAX_WORKERS = int(os.environ.get('reconcile_max_workers', '8'))
+
+KINDS = {
+    'instance': {
+        'describe': 'describe_db_snapshots',
+        'list': 'DBSnapshots',
+        'id': 'DBSnapshotIdentifier',
+        'arn': 'DBSnapshotArn',
+        'source': 'DBInstanceIdentifier',
+        'encrypted': 'Encrypted',
+        'info_key': 'db_instance_identifier',
+        'protected': 'rds_instances'
+    },
+    'cluster': {
+        'describe': 'describe_db_cluster_snapshots',
+        'list': 'DBClusterSnapshots',
+        'id': 'DBClusterSnapshotIdentifier',
+        'arn': 'DBClusterSnapshotArn',
+        'source': 'DBClusterIdentifier',
+        'encrypted': 'StorageEncrypted',
+        'info_key': 'db_cluster_identifier',
+        'protected': 'rds_clusters'
+    }
+}
+
+
+class Reconciler:
+    def __init__(self, src_region):
+        self.SRC_REGION = src_region
+        self.DEST_REGIONS = target_regions.names()
+        self.AUTOMATED_SNAPSHOT_MAXIMUM_COPIES = int(os.environ['automated_snapshot_maximum_copies'])
+        self.__sns_client = sns_client.SnsClient()
+        self.__rds_src_client = aws_clients.get_client('rds', src_region)
+        self.__rds_tar_clients = dict(
+            (region, aws_clients.get_client('rds', region)) for region in self.DEST_REGIONS
+        )
+        self.__handlers = {
+            'instance': rds_instance.RdsInstance(src_region),
+            'cluster': rds_cluster.RdsCluster(src_region)
+        }
+
+    def reconcile(self):
+        started = time.time()
+        missing = []
+        for kind, keys in KINDS.items():
+            protected = selection.index_for(keys['protected'])
+            if not protected:
+                continue
+            expected = self.__list_source_snapshots(kind, protected)
+            for region in self.DEST_REGIONS:
+                existing = self.__list_target_copies(kind, region)
+                for target_snapshot_identifier, source_snapshot_info in expected.items():
+                    if target_snapshot_identifier not in existing:
+                        missing.append((kind, region, source_snapshot_info))
+
+        print('reconcile: ' + str(len(missing)) + ' missing copies')
+        scheduler = copy_scheduler.get_scheduler()
+        failed = []
+        failed_to_start = 0
+        pending = 0
+        if scheduler is not None:
+            # behind the copy quota like any other copy; retention runs as the
+            # scheduler starts them, and the drain notifies those that fail
+            copied, failed_to_start, pending = self.__queue_missing(scheduler, missing)
+            cleaned = 0
+        else:
+            # the workers take the copies in the order of the copy scheduler
+            missing.sort(key = lambda item: copy_scheduler.copy_order(item[0], item[2]))
+            copied, failed = self.__copy_missing(missing)
+            cleaned = self.__clean_copied(copied)
+
+        if failed:
+            for kind, region, source_snapshot_info, e in failed:
+                self.__sns_client.error_notification(e, region + ': reconcile copy of ' + source_snapshot_info['source_snapshot_arn'])
+
+        result = {
+            'missing': len(missing),
+            'copied': len(copied),
+            'pending': pending,
+            'failed': len(failed) + failed_to_start,
+            'retention_runs': cleaned,
+            'elapsed': round(time.time() - started, 3)
+        }
+        print(result)
+        return result
+
+    def __list_source_snapshots(self, kind, protected):
+        # one paginated pass per snapshot type; automated snapshots older than
+        # the retention limit would be deleted again right away, so only the
+        # newest ones of each database are expected in the target regions
+        keys = KINDS[kind]
+        expected = {}
+        for snapshot_type in ('automated', 'manual'):
+            snapshots = (
+                snapshot for snapshot in aws_clients.paginate(
+                    self.__rds_src_client, keys['describe'], keys['list'], SnapshotType = snapshot_type)
+                if protected.matches(snapshot[keys['source']])
+                and snapshot.get('Status') == 'available'
+                and 'SnapshotCreateTime' in snapshot
+            )
+            keep = self.AUTOMATED_SNAPSHOT_MAXIMUM_COPIES if snapshot_type == 'automated' else 0
+            newest = retention.newest_per_group(snapshots, keys['source'], 'SnapshotCreateTime', keep)
+            for source_snapshots in newest.values():
+                for snapshot in source_snapshots:
+                    target_snapshot_identifier = snapshot[keys['id']].replace(':', '-') + '-autocopied'
+                    expected[target_snapshot_identifier] = {
+                        'source_snapshot_arn': snapshot[keys['arn']],
+                        'source_snapshot_identifier': snapshot[keys['id']],
+                        keys['info_key']: snapshot[keys['source']],
+                        'source_snapshot_type': 'Automated' if snapshot_type == 'automated' else 'Manual',
+                        'is_encrypted': snapshot.get(keys['encrypted'], False),
+                        'allocated_storage': snapshot.get('AllocatedStorage'),
+                        'source_snapshot_create_time': str(snapshot['SnapshotCreateTime'])
+                    }
+        return expected
+
+    def __list_target_copies(self, kind, region):
+        keys = KINDS[kind]
+        return set(
+            snapshot[keys['id']] for snapshot in aws_clients.paginate(
+                self.__rds_tar_clients[region], keys['describe'], keys['list'], SnapshotType = 'manual')
+            if snapshot[keys['id']].endswith('-autocopied')
+        )
+
+    def __queue_missing(self, scheduler, missing):
+        # queues every missing copy, then drains each region once
+        for kind, region, source_snapshot_info in missing:
+            scheduler.enqueue(kind, source_snapshot_info, self.SRC_REGION, region)
+        copied = []
+        failed = 0
+        pending = 0
+        for region in sorted(set(region for kind, region, source_snapshot_info in missing)):
+            started, region_failed = scheduler.drain(region)
+            copied.extend((request['kind'], region, request['source_snapshot_info']) for request in started)
+            failed += len(region_failed)
+            pending += scheduler.pending(region)
+        return copied, failed, pending
+
+    def __copy_missing(self, missing):
+        copied = []
+        failed = []
+        if not missing:
+            return copied, failed
+
+        def copy(kind, region, source_snapshot_info):
+            self.__handlers[kind].copy_snapshot_to_region(source_snapshot_info, self.SRC_REGION, region)
+            # indexed and tracked like the copy of an event; retention runs
+            # below, once per database
+            self.__handlers[kind].after_copy_started(source_snapshot_info, self.SRC_REGION, region, run_retention=False)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=RECONCILE_MAX_WORKERS) as executor:
+            futures = dict((executor.submit(copy, *item), item) for item in missing)
+            for future in concurrent.futures.as_completed(futures):
+                kind, region, source_snapshot_info = futures[future]
+                try:
+                    future.result()
+                    copied.append(futures[future])
+                except Exception as e:
+                    if aws_clients.error_code(e) in ('DBSnapshotAlreadyExists', 'DBClusterSnapshotAlreadyExistsFault'):
+                        continue
+                    failed.append((kind, region, source_snapshot_info, e))
+        return copied, failed
+
+    def __clean_copied(self, copied):
+        # retention keeps MAX-1 copies next to the copy being created, so it
+        # only runs for databases that received a new automated copy
+        databases = set(
+            (kind, region, source_snapshot_info[KINDS[kind]['info_key']])
+            for kind, region, source_snapshot_info in copied
+            if source_snapshot_info['source_snapshot_type'] == 'Automated'
+        )
+        if not databases or self.AUTOMATED_SNAPSHOT_MAXIMUM_COPIES == 0:
+            return 0
+        if copy_tracker.get_tracker() is not None:
+            # deferred until each copy is available, as for the copies of events
+            return 0
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=RECONCILE_MAX_WORKERS) as executor:
+            list(executor.map(
+                lambda database: self.__handlers[database[0]].clean_copies_of_automated_snapshot(database[2], database[1]),
+                databases
+            ))
+        return len(databases)
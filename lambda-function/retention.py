@@ -0,0 +1,154 @@
+import concurrent.futures
+import heapq
+import os
+import random
+import threading
+import time
+import aws_clients
+
+
+DELETE_MAX_WORKERS = int(os.environ.get('delete_max_workers', '8'))
+DELETE_MAX_ATTEMPTS = int(os.environ.get('delete_max_attempts', '6'))
+
+
+class ExpiredCopies:
+    # iterates over every copy except the newest `keep` available ones,
+    # holding at most `keep` copies in memory however long the stream is.
+    #
+    # copies still being created are never expired, and they do not count
+    # against `keep`. while one is in progress, the newest available copy
+    # is never expired either. RDS copies a snapshot incrementally from the
+    # previous copy in the target region, so deleting that copy too early
+    # turns the transfer into a full copy.
+    def __init__(self, copies, keep):
+        self.__copies = copies
+        self.__keep = keep
+        self.delta_base = None
+        self.pending = 0
+
+    def __iter__(self):
+        newest = []
+        base = None
+        held = None
+        for order, copy in enumerate(self.__copies):
+            if copy.get('target_snapshot_status', 'available') != 'available' or copy['target_snapshot_created_time'] is None:
+                self.pending += 1
+                continue
+
+            entry = (copy['target_snapshot_created_time'], order, copy)
+            if base is None or entry > base:
+                # a newer base was found: the previous one is an ordinary copy again
+                if held is not None:
+                    yield held[2]
+                    held = None
+                base = entry
+
+            if self.__keep <= 0:
+                evicted = entry
+            elif len(newest) < self.__keep:
+                heapq.heappush(newest, entry)
+                continue
+            else:
+                evicted = heapq.heappushpop(newest, entry)
+
+            if evicted is base:
+                held = evicted
+            else:
+                yield evicted[2]
+
+        self.delta_base = base[2] if base is not None else None
+        if held is not None:
+            if self.pending:
+                print('keep ' + held[2]['target_snapshot_identifer'] + ': delta base of a copy in progress')
+            else:
+                yield held[2]
+
+
+class AdaptiveBackoff:
+    # delay shared by all delete workers: every throttled call doubles it and
+    # every successful call halves it, so the pool slows down as a whole
+    def __init__(self, base_delay=0.2, max_delay=10.0):
+        self.BASE_DELAY = base_delay
+        self.MAX_DELAY = max_delay
+        self.__delay = 0.0
+        self.__lock = threading.Lock()
+
+    def throttled(self):
+        with self.__lock:
+            self.__delay = min(self.MAX_DELAY, max(self.BASE_DELAY, self.__delay * 2))
+
+    def succeeded(self):
+        with self.__lock:
+            self.__delay = self.__delay / 2 if self.__delay > self.BASE_DELAY else 0.0
+
+    def next_delay(self):
+        delay = self.__delay
+        return random.uniform(delay / 2, delay) if delay else 0.0
+
+    def wait(self):
+        delay = self.next_delay()
+        if delay:
+            time.sleep(delay)
+
+
+def _delete_with_retry(delete_snapshot, snapshot_identifier, backoff, max_attempts):
+    for attempt in range(1, max_attempts + 1):
+        backoff.wait()
+        try:
+            delete_snapshot(snapshot_identifier)
+            backoff.succeeded()
+            return snapshot_identifier, None
+        except Exception as e:
+            if aws_clients.is_throttling(e) and attempt < max_attempts:
+                backoff.throttled()
+                continue
+            return snapshot_identifier, e
+
+
+def delete_snapshots(delete_snapshot, snapshot_identifiers, max_workers=None, max_attempts=None):
+    # deletes every identifier with a bounded worker pool and never stops on
+    # the first error; returns (deleted identifiers, [(identifier, error)])
+    max_workers = max_workers or DELETE_MAX_WORKERS
+    max_attempts = max_attempts or DELETE_MAX_ATTEMPTS
+    backoff = AdaptiveBackoff()
+    deleted = []
+    failed = []
+
+    def collect(done):
+        for future in done:
+            snapshot_identifier, error = future.result()
+            if error is None:
+                deleted.append(snapshot_identifier)
+            else:
+                failed.append((snapshot_identifier, error))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = set()
+        for snapshot_identifier in snapshot_identifiers:
+            # only keep a couple of deletes queued per worker, so identifiers
+            # can keep streaming in from a paginated scan
+            if len(pending) >= max_workers * 2:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                collect(done)
+            pending.add(executor.submit(
+                _delete_with_retry, delete_snapshot, snapshot_identifier, backoff, max_attempts))
+        collect(concurrent.futures.wait(pending)[0])
+
+    return deleted, failed
+
+
+def newest_per_group(items, group_key, created_key, keep):
+    # {group: newest `keep` items of the group, newest first}, built in one
+    # pass holding at most `keep` items per group (every item when keep <= 0)
+    groups = {}
+    for order, item in enumerate(items):
+        entry = (item[created_key], order, item)
+        newest = groups.setdefault(item[group_key], [])
+        if keep <= 0 or len(newest) < keep:
+            heapq.heappush(newest, entry)
+        elif entry > newest[0]:
+            heapq.heapreplace(newest, entry)
+    return dict(
+        (group, [entry[2] for entry in sorted(newest, reverse=True)])
+        for group, newest in groups.items()
+    )
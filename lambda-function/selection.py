@@ -0,0 +1,149 @@
+import fnmatch
+import json
+import os
+import re
+
+
+# protected databases. rds_instances and rds_clusters hold comma separated
+# entries: exact identifiers, glob patterns such as prod-* or db-0?, or
+# regular expressions written as re:<expression>. each list is compiled once
+# per container into a set lookup plus one combined pattern.
+GLOB_CHARACTERS = ('*', '?', '[')
+
+# automated snapshots are named rds:<db identifier>-YYYY-MM-DD-HH-MM; manual
+# snapshot names say nothing about their database
+AUTOMATED_SNAPSHOT_IDENTIFIER = re.compile(r'^rds:(?P<db_identifier>.+)-\d{4}-\d{2}-\d{2}-\d{2}-\d{2}$')
+
+_indexes = {}
+_priorities = {}
+
+
+class SelectionIndex:
+    def __init__(self, value):
+        self.EXACT = set()
+        self.GLOBS = []
+        self.REGEXES = []
+        for entry in value.split(','):
+            entry = entry.strip()
+            if not entry:
+                continue
+            if entry.startswith('re:'):
+                self.REGEXES.append(entry[3:])
+            elif any(character in entry for character in GLOB_CHARACTERS):
+                self.GLOBS.append(entry)
+            else:
+                self.EXACT.add(entry)
+
+        patterns = [fnmatch.translate(glob) for glob in self.GLOBS]
+        patterns += ['(?:' + regex + r')\Z' for regex in self.REGEXES]
+        self.__pattern = re.compile('|'.join(patterns)) if patterns else None
+
+    def __bool__(self):
+        return bool(self.EXACT or self.GLOBS or self.REGEXES)
+
+    def matches(self, db_identifier):
+        if db_identifier in self.EXACT:
+            return True
+        return self.__pattern is not None and self.__pattern.match(db_identifier) is not None
+
+
+def index_for(variable):
+    # cached per value, so a changed environment compiles a new index
+    value = os.environ.get(variable, '')
+    index = _indexes.get((variable, value))
+    if index is None:
+        index = _indexes[(variable, value)] = SelectionIndex(value)
+    return index
+
+
+class PriorityIndex:
+    # copy_priorities holds comma separated <entry>=<priority> pairs, where an
+    # entry is written as in rds_instances; the first matching pair wins and
+    # a lower number is copied first. unlisted databases get the default.
+    def __init__(self, value, default=5):
+        self.DEFAULT = default
+        self.PRIORITIES = []
+        for pair in value.split(','):
+            pair = pair.strip()
+            if not pair:
+                continue
+            entry, _, priority = pair.rpartition('=')
+            if not entry or not priority.strip().isdigit():
+                raise ValueError('copy_priorities: expected <database>=<priority>, got ' + pair)
+            self.PRIORITIES.append((SelectionIndex(entry), int(priority)))
+
+    def priority(self, db_identifier):
+        if db_identifier:
+            for index, priority in self.PRIORITIES:
+                if index.matches(db_identifier):
+                    return priority
+        return self.DEFAULT
+
+
+def priority_of(db_identifier):
+    # cached per value, like index_for
+    value = os.environ.get('copy_priorities', '')
+    default = int(os.environ.get('copy_default_priority', '5'))
+    index = _priorities.get((value, default))
+    if index is None:
+        index = _priorities[(value, default)] = PriorityIndex(value, default)
+    return index.priority(db_identifier)
+
+
+def db_identifier_of_snapshot(snapshot_identifier):
+    match = AUTOMATED_SNAPSHOT_IDENTIFIER.match(snapshot_identifier or '')
+    return match.group('db_identifier') if match else None
+
+
+def db_identifier_of_event(event):
+    # the database of a snapshot event, from the raw event alone; None when
+    # the snapshot name does not tell
+    detail = event.get('detail') or {}
+    snapshot_identifier = detail.get('SourceIdentifier')
+    if not snapshot_identifier and detail.get('SourceArn'):
+        snapshot_identifier = detail['SourceArn'].split(':', 6)[-1]
+    return db_identifier_of_snapshot(snapshot_identifier)
+
+
+def _source_identifier_filters(index):
+    # EventBridge matchers for the snapshot names of protected databases, or
+    # None when a pattern has no EventBridge equivalent
+    filters = [{'prefix': 'rds:' + db_identifier + '-'} for db_identifier in sorted(index.EXACT)]
+    for glob in index.GLOBS:
+        if '?' in glob or '[' in glob or '**' in glob:
+            return None
+        filters.append({'wildcard': 'rds:' + glob + '-*'})
+    if index.REGEXES:
+        return None
+    # manual snapshots of any database still reach the function
+    filters.append({'anything-but': {'prefix': 'rds:'}})
+    return filters
+
+
+def event_pattern(instances, clusters):
+    # event rule pattern that only lets through deletions and the snapshot
+    # events of protected databases; the function still checks every event,
+    # so matching a little too much is harmless
+    rules = [{
+        'detail-type': ['RDS DB Snapshot Event', 'RDS DB Cluster Snapshot Event'],
+        'detail': {'EventCategories': ['deletion']}
+    }]
+    for detail_type, index in (('RDS DB Snapshot Event', SelectionIndex(instances)),
+                               ('RDS DB Cluster Snapshot Event', SelectionIndex(clusters))):
+        if not index:
+            continue
+        detail = {'EventCategories': ['creation', 'backup']}
+        filters = _source_identifier_filters(index)
+        if filters is not None:
+            detail['SourceIdentifier'] = filters
+        rules.append({'detail-type': [detail_type], 'detail': detail})
+    return {'source': ['aws.rds'], '$or': rules}
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='print the event rule pattern for the protected databases')
+    parser.add_argument('--instances', default=os.environ.get('rds_instances', ''))
+    parser.add_argument('--clusters', default=os.environ.get('rds_clusters', ''))
+    args = parser.parse_args()
+    print(json.dumps(event_pattern(args.instances, args.clusters), indent=2))
@@ -0,0 +1,255 @@
+import datetime
+import json
+import os
+import sqlite3
+import threading
+import time
+import aws_clients
+
+
+# index of the automated copies in the target regions, per region, snapshot
+# kind and source database: identifier, create time, type, status, size and
+# KMS key. the copy, retention, delete, tracker and reconcile paths keep it
+# current, so retention reads it instead of describing the target region.
+# a database enters the index with one scan the first time it is cleaned,
+# and the verification sweep (verify_index_handler) rescans whole regions.
+# the index is a DynamoDB table (snapshot_index_table) or, for local runs and
+# tests, a SQLite file (snapshot_index_path); it is off when neither is set.
+#
+# copies still in progress are only marked available by the copy tracker or
+# the sweep; entries pending for longer than snapshot_index_refresh_seconds
+# are described again by retention, so the index never stalls without them.
+SNAPSHOT_INDEX_REFRESH_SECONDS = int(os.environ.get('snapshot_index_refresh_seconds', '3600'))
+
+# clock for the recorded times; the benchmarks swap in a simulated one
+now = time.time
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def _dump(copy):
+    copy = dict(copy)
+    created_time = copy.get('target_snapshot_created_time')
+    if isinstance(created_time, datetime.datetime):
+        copy['target_snapshot_created_time'] = created_time.isoformat()
+    copy.setdefault('indexed_at', now())
+    return json.dumps(copy)
+
+
+def _load(text):
+    copy = json.loads(text)
+    if copy.get('target_snapshot_created_time'):
+        copy['target_snapshot_created_time'] = datetime.datetime.fromisoformat(copy['target_snapshot_created_time'])
+    return copy
+
+
+def is_stale(copy):
+    # a copy the index still holds as in progress after the refresh period
+    if copy.get('target_snapshot_status') == 'available' and copy.get('target_snapshot_created_time') is not None:
+        return False
+    return copy.get('indexed_at', 0) < now() - SNAPSHOT_INDEX_REFRESH_SECONDS
+
+
+class SqliteSnapshotIndex:
+    def __init__(self, path):
+        self.PATH = path
+        with self.__connect() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS snapshot_copies ('
+                ' region TEXT NOT NULL,'
+                ' kind TEXT NOT NULL,'
+                ' db_identifier TEXT NOT NULL,'
+                ' target_snapshot_identifier TEXT NOT NULL,'
+                ' copy TEXT NOT NULL,'
+                ' PRIMARY KEY (region, kind, target_snapshot_identifier))'
+            )
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS snapshot_copies_by_db ON snapshot_copies (region, kind, db_identifier)'
+            )
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS indexed_databases ('
+                ' region TEXT NOT NULL,'
+                ' kind TEXT NOT NULL,'
+                ' db_identifier TEXT NOT NULL,'
+                ' verified_at REAL NOT NULL,'
+                ' PRIMARY KEY (region, kind, db_identifier))'
+            )
+
+    def __connect(self):
+        return sqlite3.connect(self.PATH, timeout=30)
+
+    def copies(self, region, kind, db_identifier):
+        # the indexed copies of a database, or None if it is not indexed yet
+        with self.__connect() as connection:
+            indexed = connection.execute(
+                'SELECT 1 FROM indexed_databases WHERE region = ? AND kind = ? AND db_identifier = ?',
+                (region, kind, db_identifier)
+            ).fetchone()
+            if indexed is None:
+                return None
+            rows = connection.execute(
+                'SELECT copy FROM snapshot_copies WHERE region = ? AND kind = ? AND db_identifier = ?',
+                (region, kind, db_identifier)
+            ).fetchall()
+        return [_load(row[0]) for row in rows]
+
+    def put(self, region, kind, db_identifier, copy):
+        with self.__connect() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO snapshot_copies VALUES (?, ?, ?, ?, ?)',
+                (region, kind, db_identifier, copy['target_snapshot_identifer'], _dump(copy))
+            )
+
+    def remove(self, region, kind, db_identifier, target_snapshot_identifiers):
+        with self.__connect() as connection:
+            connection.executemany(
+                'DELETE FROM snapshot_copies WHERE region = ? AND kind = ? AND target_snapshot_identifier = ?',
+                [(region, kind, target_snapshot_identifier) for target_snapshot_identifier in target_snapshot_identifiers]
+            )
+
+    def replace(self, region, kind, db_identifier, copies):
+        with self.__connect() as connection:
+            self.__replace(connection, region, kind, db_identifier, copies)
+
+    def replace_region(self, region, kind, copies_by_db):
+        # result of a full rescan; indexed databases without copies are kept
+        # as indexed, with no copies
+        with self.__connect() as connection:
+            indexed = set(row[0] for row in connection.execute(
+                'SELECT db_identifier FROM indexed_databases WHERE region = ? AND kind = ?', (region, kind)
+            ))
+            for db_identifier in indexed | set(copies_by_db):
+                self.__replace(connection, region, kind, db_identifier, copies_by_db.get(db_identifier, []))
+
+    def __replace(self, connection, region, kind, db_identifier, copies):
+        connection.execute(
+            'DELETE FROM snapshot_copies WHERE region = ? AND kind = ? AND db_identifier = ?',
+            (region, kind, db_identifier)
+        )
+        connection.executemany(
+            'INSERT OR REPLACE INTO snapshot_copies VALUES (?, ?, ?, ?, ?)',
+            [(region, kind, db_identifier, copy['target_snapshot_identifer'], _dump(copy)) for copy in copies]
+        )
+        connection.execute(
+            'INSERT OR REPLACE INTO indexed_databases VALUES (?, ?, ?, ?)',
+            (region, kind, db_identifier, now())
+        )
+
+
+class DynamoDbSnapshotIndex:
+    # table with partition key "copy_group" (S), region#kind#database, and
+    # sort key "target_snapshot_identifier" (S). the item with sort key
+    # "#indexed" marks a database as indexed.
+    INDEXED_MARKER = '#indexed'
+
+    def __init__(self, table_name):
+        self.TABLE_NAME = table_name
+        self.__dynamodb_client = aws_clients.get_client('dynamodb')
+
+    def __copy_group(self, region, kind, db_identifier):
+        return region + '#' + kind + '#' + db_identifier
+
+    def __items(self, copy_group):
+        params = {
+            'TableName': self.TABLE_NAME,
+            'KeyConditionExpression': 'copy_group = :copy_group',
+            'ExpressionAttributeValues': {':copy_group': {'S': copy_group}},
+            'ConsistentRead': True
+        }
+        while True:
+            res = self.__dynamodb_client.query(**params)
+            for item in res['Items']:
+                yield item
+            if 'LastEvaluatedKey' not in res:
+                break
+            params['ExclusiveStartKey'] = res['LastEvaluatedKey']
+
+    def copies(self, region, kind, db_identifier):
+        copies = []
+        indexed = False
+        for item in self.__items(self.__copy_group(region, kind, db_identifier)):
+            if item['target_snapshot_identifier']['S'] == self.INDEXED_MARKER:
+                indexed = True
+            else:
+                copies.append(_load(item['copy']['S']))
+        return copies if indexed else None
+
+    def put(self, region, kind, db_identifier, copy):
+        self.__dynamodb_client.put_item(
+            TableName = self.TABLE_NAME,
+            Item = {
+                'copy_group': {'S': self.__copy_group(region, kind, db_identifier)},
+                'target_snapshot_identifier': {'S': copy['target_snapshot_identifer']},
+                'copy': {'S': _dump(copy)}
+            }
+        )
+
+    def remove(self, region, kind, db_identifier, target_snapshot_identifiers):
+        for target_snapshot_identifier in target_snapshot_identifiers:
+            self.__dynamodb_client.delete_item(
+                TableName = self.TABLE_NAME,
+                Key = {
+                    'copy_group': {'S': self.__copy_group(region, kind, db_identifier)},
+                    'target_snapshot_identifier': {'S': target_snapshot_identifier}
+                }
+            )
+
+    def replace(self, region, kind, db_identifier, copies):
+        copy_group = self.__copy_group(region, kind, db_identifier)
+        current = set(copy['target_snapshot_identifer'] for copy in copies)
+        stale = [
+            item['target_snapshot_identifier']['S'] for item in self.__items(copy_group)
+            if item['target_snapshot_identifier']['S'] not in current
+            and item['target_snapshot_identifier']['S'] != self.INDEXED_MARKER
+        ]
+        self.remove(region, kind, db_identifier, stale)
+        for copy in copies:
+            self.put(region, kind, db_identifier, copy)
+        self.__dynamodb_client.put_item(
+            TableName = self.TABLE_NAME,
+            Item = {
+                'copy_group': {'S': copy_group},
+                'target_snapshot_identifier': {'S': self.INDEXED_MARKER},
+                'verified_at': {'N': str(now())}
+            }
+        )
+
+    def replace_region(self, region, kind, copies_by_db):
+        prefix = region + '#' + kind + '#'
+        indexed = set()
+        params = {
+            'TableName': self.TABLE_NAME,
+            'FilterExpression': 'begins_with(copy_group, :prefix) AND target_snapshot_identifier = :marker',
+            'ExpressionAttributeValues': {':prefix': {'S': prefix}, ':marker': {'S': self.INDEXED_MARKER}}
+        }
+        while True:
+            res = self.__dynamodb_client.scan(**params)
+            indexed.update(item['copy_group']['S'][len(prefix):] for item in res['Items'])
+            if 'LastEvaluatedKey' not in res:
+                break
+            params['ExclusiveStartKey'] = res['LastEvaluatedKey']
+        for db_identifier in indexed | set(copies_by_db):
+            self.replace(region, kind, db_identifier, copies_by_db.get(db_identifier, []))
+
+
+def get_index():
+    global _index
+    if _index is not None:
+        return _index
+
+    table_name = os.environ.get('snapshot_index_table')
+    path = os.environ.get('snapshot_index_path')
+    if not table_name and not path:
+        return None
+
+    with _index_lock:
+        if _index is None:
+            _index = DynamoDbSnapshotIndex(table_name) if table_name else SqliteSnapshotIndex(path)
+    return _index
+
+
+def reset():
+    global _index
+    with _index_lock:
+        _index = None
@@ -1,22 +1,160 @@
-import json
-import boto3
+import collections
+import functools
 import os
 import sys
+import threading
+import metrics
 
 
+# errors reported during a handler invocation are not published one by one.
+# they are buffered in a process-wide digest, deduplicated by error class and
+# resource, and sent as one message when the invocation ends. a timer sends
+# the digest error_digest_flush_margin_ms before the lambda timeout, so it is
+# not lost when the invocation is killed. every failure is counted in the
+# Errors metric. outside an invocation, errors are published right away.
+ERROR_DIGEST_MAX_ENTRIES = int(os.environ.get('error_digest_max_entries', '50'))
+ERROR_DIGEST_FLUSH_MARGIN_MS = int(os.environ.get('error_digest_flush_margin_ms', '3000'))
+SUBJECT = 'Auto Copy RDS Snapshot To X Region Notification'
+
 class SnsClient:
     def __init__(self):
         self.SNS_TOPIC_ARN = os.environ.get('sns_topic_arn')
-        try:
-            self.__sns_client = boto3.client('sns')
-        except Exception as e:
-            print("ERROR: failed to connect to SNS")
-            error_notification(e)
-            sys.exit(1)
-        
-    def error_notification(self, e):
-        self.__sns_client.publish(
+        self.__sns_client = None
+
+    def __client(self):
+        # created on the first notification; most invocations never send one
+        if self.__sns_client is None:
+            import aws_clients
+            try:
+                self.__sns_client = aws_clients.get_client('sns')
+            except Exception as e:
+                print("ERROR: failed to connect to SNS")
+                print(e)
+                sys.exit(1)
+        return self.__sns_client
+
+    def error_notification(self, e, resource=None):
+        # resource names what failed, such as "us-west-2: copy of <arn>"
+        if not _digest.add(e, resource):
+            self.publish(str(e) if resource is None else resource + ': ' + str(e))
+
+    def publish(self, message):
+        self.__client().publish(
             TopicArn = self.SNS_TOPIC_ARN,
-            Message = str(e),
-            Subject = 'Auto Copy RDS Snapshot To X Region Notification'
-        )
\ No newline at end of file
+            Message = message,
+            Subject = SUBJECT
+        )
+
+
+def _error_class(e):
+    if isinstance(e, str):
+        return 'Error'
+    import aws_clients
+    return aws_clients.error_code(e) or type(e).__name__
+
+
+class ErrorDigest:
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__entries = collections.OrderedDict()
+        self.__failures = 0
+        self.__invocations = 0
+        self.__handler = None
+        self.__timer = None
+
+    def start(self, handler, context):
+        get_remaining_time_in_millis = getattr(context, 'get_remaining_time_in_millis', None)
+        with self.__lock:
+            self.__invocations += 1
+            self.__handler = handler
+            if self.__timer is not None or get_remaining_time_in_millis is None:
+                return
+            seconds = (get_remaining_time_in_millis() - ERROR_DIGEST_FLUSH_MARGIN_MS) / 1000.0
+            if seconds > 0:
+                self.__timer = threading.Timer(seconds, self.flush)
+                self.__timer.daemon = True
+                self.__timer.start()
+
+    def add(self, e, resource=None):
+        # False outside an invocation: the caller publishes right away
+        error_class = _error_class(e)
+        metrics.put('Errors', 1, 'Count', ErrorClass = error_class)
+        with self.__lock:
+            if not self.__invocations:
+                return False
+            self.__failures += 1
+            key = (error_class, resource or '')
+            if key in self.__entries:
+                self.__entries[key][0] += 1
+            else:
+                self.__entries[key] = [1, str(e)]
+        return True
+
+    def end(self):
+        with self.__lock:
+            self.__invocations -= 1
+            if self.__invocations:
+                # concurrent invocations in one process share the digest
+                return
+            timer = self.__timer
+            self.__timer = None
+        if timer is not None:
+            timer.cancel()
+        self.flush()
+
+    def flush(self):
+        with self.__lock:
+            entries = self.__entries
+            failures = self.__failures
+            handler = self.__handler
+            self.__entries = collections.OrderedDict()
+            self.__failures = 0
+        if not entries:
+            return
+        message = _digest_message(handler, failures, entries)
+        try:
+            # the sns client itself is shared through aws_clients
+            SnsClient().publish(message)
+        except (Exception, SystemExit) as e:
+            print("ERROR: failed to send the error digest")
+            print(e)
+            print(message)
+
+
+def _digest_message(handler, failures, entries):
+    classes = collections.Counter()
+    for (error_class, resource), (count, text) in entries.items():
+        classes[error_class] += count
+    lines = [
+        str(handler) + ': ' + str(failures) + ' errors, ' + str(len(entries)) + ' distinct',
+        ', '.join(error_class + ' ' + str(count) for error_class, count in classes.most_common()),
+        ''
+    ]
+    for (error_class, resource), (count, text) in list(entries.items())[:ERROR_DIGEST_MAX_ENTRIES]:
+        lines.append(
+            '[' + str(count) + 'x] ' + error_class + ' ' + (resource + ': ' if resource else '') + text
+        )
+    if len(entries) > ERROR_DIGEST_MAX_ENTRIES:
+        lines.append('... and ' + str(len(entries) - ERROR_DIGEST_MAX_ENTRIES) + ' more distinct errors')
+    return '\n'.join(lines)
+
+
+_digest = ErrorDigest()
+
+
+def digested(handler):
+    # handler decorator: the errors of the invocation are sent as one digest
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(event, context):
+            _digest.start(handler, context)
+            try:
+                return function(event, context)
+            finally:
+                _digest.end()
+        return wrapper
+    return decorator
+
+
+def flush():
+    _digest.flush()
@@ -0,0 +1,47 @@
+import concurrent.futures
+import json
+import os
+
+
+# dest_region holds one region or a comma separated list of regions. kms_key_id
+# is either a single key arn used in every region, or a map of region to key
+# arn written as a JSON object or as "region=arn,region=arn". a region left
+# out of the map has no key, and its encrypted copies fail.
+def names():
+    return [region.strip() for region in os.environ['dest_region'].split(',') if region.strip()]
+
+
+def kms_key_ids(regions):
+    value = os.environ.get('kms_key_id', '').strip()
+    if value.startswith('{'):
+        key_ids = json.loads(value)
+    elif '=' in value:
+        key_ids = dict(
+            (region.strip(), key_id.strip())
+            for region, key_id in (pair.split('=', 1) for pair in value.split(',') if pair.strip())
+        )
+    else:
+        return dict((region, value) for region in regions)
+    return dict((region, key_ids.get(region, '')) for region in regions)
+
+
+def run_in_parallel(function, regions):
+    # calls function(region) for every region at once; returns
+    # {region: (result, error)} so one failed region does not hide the others
+    results = {}
+    if len(regions) == 1:
+        region = regions[0]
+        try:
+            results[region] = (function(region), None)
+        except Exception as e:
+            results[region] = (None, e)
+        return results
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(regions)) as executor:
+        futures = dict((executor.submit(function, region), region) for region in regions)
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                results[futures[future]] = (future.result(), None)
+            except Exception as e:
+                results[futures[future]] = (None, e)
+    return results